@@ -13,12 +13,13 @@
 #    under the License.
 
 import os
+import time
 
 from oslo_concurrency import lockutils
 from oslo_log import log as logging
-from oslo_service import loopingcall
 
 from os_brick import exception
+from os_brick import executor
 from os_brick.i18n import _
 from os_brick import initiator
 from os_brick.initiator.connectors import base
@@ -29,6 +30,15 @@ synchronized = lockutils.synchronized_with_prefix('os-brick-')
 
 LOG = logging.getLogger(__name__)
 
+# Seconds between checks for the presence of the volume's device links
+DEVICE_POLL_INTERVAL = 0.1
+# Seconds to wait after the first rescan, it doubles after each rescan
+RESCAN_INITIAL_BACKOFF = 1
+# Maximum seconds to wait between rescans
+RESCAN_MAX_BACKOFF = 16
+# Seconds to wait for the removed paths to disappear on disconnect
+REMOVAL_WAIT_TIMEOUT = 5
+
 
 class FibreChannelConnector(base.BaseLinuxConnector):
     """Connector class to attach/detach Fibre Channel volumes."""
@@ -182,7 +192,8 @@ class FibreChannelConnector(base.BaseLinuxConnector):
         volume_paths = self.get_volume_paths(connection_properties)
         if volume_paths:
             return self._linuxscsi.extend_volume(
-                volume_paths, use_multipath=self.use_multipath)
+                volume_paths, use_multipath=self.use_multipath,
+                concurrent=self.use_multipath)
         else:
             LOG.warning("Couldn't find any volume paths on the host to "
                         "extend volume for %(props)s",
@@ -204,57 +215,87 @@ class FibreChannelConnector(base.BaseLinuxConnector):
         target_wwn - World Wide Name
         target_lun - LUN id of the volume
         """
-        device_info = {'type': 'block'}
+        return self._connect_volumes([connection_properties])[0]
 
-        connection_properties = self._add_targets_to_connection_properties(
-            connection_properties)
+    @utils.trace
+    def connect_volumes(self, connection_properties_list):
+        """Attach multiple volumes at once.
+
+        Meant for LUNs presented through the same target ports, for example
+        when attaching many volumes from the same storage array.  Each
+        targeted scan is done only once for all the volumes, we wait for all
+        their devices at the same time, and their multipath devices are
+        discovered concurrently.
+
+        :param connection_properties_list: List of connection properties
+                                           dictionaries, as the ones passed to
+                                           connect_volume.
+        :returns: List of device info dictionaries, as the ones returned by
+                  connect_volume, in the same order as the connection
+                  properties.
+        :raises NoFibreChannelVolumeDeviceFound: If any of the volumes is not
+                                                 found, in which case the
+                                                 caller should disconnect all
+                                                 of them.
+        """
+        results = self._connect_volumes_locked(connection_properties_list)
+        return [utils.prepare_connect_volume_result(self, props, res)
+                for props, res in zip(connection_properties_list, results)]
+
+    @synchronized('connect_volume', external=True)
+    def _connect_volumes_locked(self, connection_properties_list):
+        return self._connect_volumes(connection_properties_list)
+
+    def _connect_volumes(self, connection_properties_list):
+        connection_properties_list = [
+            self._add_targets_to_connection_properties(connection_properties)
+            for connection_properties in connection_properties_list]
 
         hbas = self._linuxfc.get_fc_hbas_info()
         if not hbas:
             LOG.warning("We are unable to locate any Fibre Channel devices.")
             raise exception.NoFibreChannelHostsFound()
 
-        host_devices = self._get_possible_volume_paths(
-            connection_properties, hbas)
-
-        # The /dev/disk/by-path/... node is not always present immediately
-        # We only need to find the first device.  Once we see the first device
-        # multipath will have any others.
-        def _wait_for_device_discovery(host_devices):
-            for device in host_devices:
-                LOG.debug("Looking for Fibre Channel dev %(device)s",
-                          {'device': device})
-                if os.path.exists(device) and self.check_valid_device(device):
-                    self.host_device = device
-                    # get the /dev/sdX device.  This variable is maintained to
-                    # keep the same log output.
-                    self.device_name = os.path.realpath(device)
-                    raise loopingcall.LoopingCallDone()
-
-            if self.tries >= self.device_scan_attempts:
-                LOG.error("Fibre Channel volume device not found.")
-                raise exception.NoFibreChannelVolumeDeviceFound()
-
-            LOG.info("Fibre Channel volume device not yet found. "
-                     "Will rescan & retry.  Try number: %(tries)s.",
-                     {'tries': self.tries})
-
-            self._linuxfc.rescan_hosts(hbas, connection_properties)
-            self.tries = self.tries + 1
-
-        self.host_device = None
-        self.device_name = None
-        self.tries = 0
-        timer = loopingcall.FixedIntervalLoopingCall(
-            _wait_for_device_discovery, host_devices)
-        timer.start(interval=2).wait()
-
-        LOG.debug("Found Fibre Channel volume %(name)s "
-                  "(after %(tries)s rescans.)",
-                  {'name': self.device_name, 'tries': self.tries})
+        host_devices_list = [
+            self._get_possible_volume_paths(connection_properties, hbas)
+            for connection_properties in connection_properties_list]
+
+        found = self._wait_for_devices_discovery(
+            hbas, connection_properties_list, host_devices_list)
+
+        if len(found) == 1:
+            return [self._get_device_info(connection_properties_list[0],
+                                          found[0])]
+
+        # Finding the multipaths waits for them to be formed, do it for all
+        # the volumes at the same time.
+        results: list = [None] * len(found)
+        errors: list = []
+
+        def get_device_info(index):
+            try:
+                results[index] = self._get_device_info(
+                    connection_properties_list[index], found[index])
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [executor.Thread(target=get_device_info, args=(i,))
+                   for i in range(len(found))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def _get_device_info(self, connection_properties, host_device):
+        """Return the connect_volume result for a device that was found."""
+        device_info = {'type': 'block'}
 
         # find out the WWN of the device
-        device_wwn = self._linuxscsi.get_scsi_wwn(self.host_device)
+        device_wwn = self._linuxscsi.get_scsi_wwn(host_device)
         LOG.debug("Device WWN = '%(wwn)s'", {'wwn': device_wwn})
         device_info['scsi_wwn'] = device_wwn
 
@@ -265,17 +306,133 @@ class FibreChannelConnector(base.BaseLinuxConnector):
             # back if we don't find a multipath and we'll return that to the
             # caller, breaking Nova's encryption which requires a symlink.
             (device_path, multipath_id) = self._discover_mpath_device(
-                device_wwn, connection_properties, self.host_device)
+                device_wwn, connection_properties, host_device)
             if multipath_id:
                 # only set the multipath_id if we found one
                 device_info['multipath_id'] = multipath_id
 
         else:
-            device_path = self.host_device
+            device_path = host_device
 
         device_info['path'] = device_path
         return device_info
 
+    def _wait_for_devices_discovery(self, hbas, connection_properties_list,
+                                    host_devices_list):
+        """Wait until one of the possible paths of each volume is valid.
+
+        The /dev/disk/by-path/... links are not always present immediately,
+        they are created by udev as soon as the kernel finds the LUN.  We only
+        need to find the first device of each volume, once we see it
+        multipath will have any others.
+
+        Checking the links is cheap, so we do it every DEVICE_POLL_INTERVAL
+        seconds, but rescans block until the HBAs have completed them, so we
+        only do them on an exponential backoff schedule: right away and then
+        after 1, 2, 4... seconds, never waiting more than RESCAN_MAX_BACKOFF
+        seconds between rescans, up to device_scan_attempts rescans.  Each
+        rescan only includes the volumes that have not been found yet.
+
+        :returns: List with the host device path found for each volume.
+        """
+        self.tries = 0
+        backoff = RESCAN_INITIAL_BACKOFF
+        next_rescan = time.monotonic()
+        found = [None] * len(host_devices_list)
+        invalid = set()
+        while True:
+            for i, host_devices in enumerate(host_devices_list):
+                if found[i]:
+                    continue
+                for device in host_devices:
+                    # Don't read from devices known to be invalid until next
+                    # rescan
+                    if device not in invalid and os.path.exists(device):
+                        LOG.debug("Checking Fibre Channel dev %(device)s",
+                                  {'device': device})
+                        if self.check_valid_device(device):
+                            LOG.debug("Found Fibre Channel volume %(name)s "
+                                      "(after %(tries)s rescans.)",
+                                      {'name': os.path.realpath(device),
+                                       'tries': self.tries})
+                            found[i] = device
+                            break
+                        invalid.add(device)
+
+            pending = [connection_properties_list[i]
+                       for i, device in enumerate(found) if not device]
+            if not pending:
+                return found
+
+            if time.monotonic() >= next_rescan:
+                if self.tries >= self.device_scan_attempts:
+                    LOG.error("Fibre Channel volume device not found for "
+                              "%(num)s volumes.", {'num': len(pending)})
+                    raise exception.NoFibreChannelVolumeDeviceFound()
+
+                LOG.info("Fibre Channel volume device not yet found for "
+                         "%(num)s volumes. Will rescan & retry.  Try number: "
+                         "%(tries)s.", {'num': len(pending),
+                                        'tries': self.tries})
+                self._rescan_hosts(hbas, pending)
+                self.tries += 1
+                invalid.clear()
+                next_rescan = time.monotonic() + backoff
+                backoff = min(backoff * 2, RESCAN_MAX_BACKOFF)
+
+            time.sleep(DEVICE_POLL_INTERVAL)
+
+    def _rescan_hosts(self, hbas, connection_properties_list):
+        """Rescan the HBAs for multiple volumes.
+
+        Volumes presented through the same target ports are scanned in a
+        single rescan_hosts call, so targeted scans are done only once.
+        """
+        if len(connection_properties_list) == 1:
+            self._linuxfc.rescan_hosts(hbas, connection_properties_list[0])
+            return
+
+        groups: dict = {}
+        for connection_properties in connection_properties_list:
+            key = frozenset(wwpn for wwpn, _lun
+                            in connection_properties['targets'])
+            groups.setdefault(key, []).append(connection_properties)
+        for group in groups.values():
+            self._linuxfc.rescan_hosts(
+                hbas, self._merge_connection_properties(group))
+
+    @staticmethod
+    def _merge_connection_properties(connection_properties_list):
+        """Combine the scan information of volumes sharing target ports."""
+        if len(connection_properties_list) == 1:
+            return connection_properties_list[0]
+
+        def union(lists):
+            result = []
+            for values in lists:
+                result.extend(value for value in values
+                              if value not in result)
+            return result
+
+        merged = {
+            'targets': union(props['targets']
+                             for props in connection_properties_list),
+            'enable_wildcard_scan': all(
+                props.get('enable_wildcard_scan', True)
+                for props in connection_properties_list),
+        }
+        # The initiator map is only used if all volumes have it
+        if all(props.get('initiator_target_map') is not None
+               for props in connection_properties_list):
+            for key in ('initiator_target_map', 'initiator_target_lun_map'):
+                initiators = union(props[key]
+                                   for props in connection_properties_list)
+                merged[key] = {
+                    initiator: union(props[key].get(initiator, ())
+                                     for props in connection_properties_list)
+                    for initiator in initiators}
+        return merged
+
     def _get_host_devices(self, possible_devs):
         """Compute the device paths on the system with an id, wwn, and lun
 
@@ -369,12 +526,46 @@ class FibreChannelConnector(base.BaseLinuxConnector):
         # We check for /pci because that's the value we return for single
         # paths, whereas for multipaths we have multiple link formats.
         was_multipath = '/pci-' not in path_used and was_symlink
-        for device in devices:
-            device_path = device['device']
+
+        # Flushing and deleting a path can take a while, specially if the path
+        # is down, so we do it for all the paths at the same time.
+        errors: list = []
+        if len(devices) == 1:
+            self._remove_device(devices[0]['device'], path_used,
+                                was_multipath, errors)
+        else:
+            threads = [executor.Thread(target=self._remove_device,
+                                       args=(device['device'], path_used,
+                                             was_multipath, errors))
+                       for device in devices]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+        # Delete requests are asynchronous, wait for all the paths at once,
+        # but not for long, since a path that is still there doesn't fail
+        # the disconnect
+        names = [os.path.basename(device['device']) for device in devices]
+        if names:
+            try:
+                self._linuxscsi.wait_for_volumes_removal(
+                    names, timeout=REMOVAL_WAIT_TIMEOUT)
+            except exception.VolumePathNotRemoved as exc:
+                LOG.warning('Paths are still present after removal: %s', exc)
+
+    def _remove_device(self, device_path, path_used, was_multipath, errors):
+        """Flush and delete a path device, storing errors in errors list."""
+        try:
             flush = self._linuxscsi.requires_flush(device_path,
                                                    path_used,
                                                    was_multipath)
             self._linuxscsi.remove_scsi_device(device_path, flush=flush)
+        except Exception as exc:
+            errors.append(exc)
 
     def _get_pci_num(self, hba):
         # NOTE(walter-boring)
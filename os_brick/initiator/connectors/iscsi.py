@@ -489,7 +489,8 @@ class ISCSIConnector(base.BaseLinuxConnector, base_iscsi.BaseISCSIConnector):
         LOG.info("Found paths for volume %s", volume_paths)
         if volume_paths:
             return self._linuxscsi.extend_volume(
-                volume_paths, use_multipath=self.use_multipath)
+                volume_paths, use_multipath=self.use_multipath,
+                concurrent=self.use_multipath)
         else:
             LOG.warning("Couldn't find any volume paths on the host to "
                         "extend volume for %(props)s",
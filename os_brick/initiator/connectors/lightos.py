@@ -14,7 +14,6 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import glob
 import http.client
 import os
 import re
@@ -29,6 +28,7 @@ from oslo_log import log as logging
 from os_brick import exception
 from os_brick.i18n import _
 from os_brick.initiator.connectors import base
+from os_brick.initiator import linuxblock
 from os_brick.privileged import lightos as priv_lightos
 from os_brick import utils
 
@@ -200,33 +200,36 @@ class LightOSConnector(base.BaseLinuxConnector):
                 return devname
         return None
 
-    def _check_device_exists_reading_block_class(self, uuid):
-        file_path = "/sys/class/block/*/wwid"
-        wwid = "uuid." + uuid
-        for match_path in glob.glob(file_path):
-            try:
-                with open(match_path, "r") as f:
-                    match_wwid = f.readline()
-            except Exception:
-                LOG.warning("LIGHTOS: Failed to read file %s",
-                            match_path)
-                continue
+    def _check_device_exists_reading_block_class(self, uuid, topology=None):
+        """Look for the NVMe namespace of a volume in sysfs.
 
-            if wwid != match_wwid.strip():
-                continue
+        :param uuid: uuid of the volume
+        :param topology: NVMe topology returned by a previous call, only new
+                         devices are read from sysfs when it's provided.
+        :returns: Tuple of the device path, or None if not found, and the
+                  NVMe topology.
+        """
+        if topology is None:
+            topology = linuxblock.BlockDeviceTopology.snapshot(
+                patterns=('nvme*',))
+        else:
+            topology = topology.refresh()
 
+        wwid = "uuid." + uuid
+        for device in topology.get_by_wwid(wwid):
             # skip slave nvme devices, for example: nvme0c0n1
-            if nvmec_match.match(match_path.split("/")[-2]):
+            if nvmec_match.match(device.name):
                 continue
 
             LOG.info("LIGHTOS: matching uuid %s was found"
-                     " for device path %s", uuid, match_path)
-            return os.path.join("/dev", match_path.split("/")[-2])
-        return None
+                     " for device path %s", uuid, device.path)
+            return device.path, topology
+        return None, topology
 
     @utils.trace
     def _get_device_by_uuid(self, uuid):
         endtime = time.time() + self.WAIT_DEVICE_TIMEOUT
+        topology = None
         while time.time() < endtime:
             try:
                 device = self._check_device_exists_using_dev_lnk(uuid)
@@ -234,7 +237,8 @@ class LightOSConnector(base.BaseLinuxConnector):
                     return device
             except Exception as e:
                 LOG.debug(f'LIGHTOS: {e}')
-            device = self._check_device_exists_reading_block_class(uuid)
+            device, topology = self._check_device_exists_reading_block_class(
+                uuid, topology)
             if device:
                 return device
 
@@ -10,24 +10,30 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import errno
-import glob
 import json
 import os.path
 import re
+import socket
+import threading
 import time
 
 from oslo_concurrency import lockutils
 from oslo_concurrency import processutils as putils
 from oslo_log import log as logging
+from oslo_utils import strutils
 
 from os_brick import exception
+from os_brick import executor as brick_executor
 from os_brick.i18n import _
 from os_brick.initiator.connectors import base
+from os_brick.initiator import linuxblock
 try:
     from os_brick.initiator.connectors import nvmeof_agent
 except ImportError:
     nvmeof_agent = None
+from os_brick.privileged import nvmeof as priv_nvme
 from os_brick.privileged import rootwrap as priv_rootwrap
 from os_brick import utils
 
@@ -35,11 +41,58 @@ DEV_SEARCH_PATH = '/dev/'
 
 DEVICE_SCAN_ATTEMPTS_DEFAULT = 5
 
+# Deadline in seconds for each portal connection in concurrent connect mode
+PORTAL_CONNECT_TIMEOUT_DEFAULT = 30
+
+# nvme connect arguments for each fabrics option
+NVME_CONNECT_CLI_ARGS = {'transport': '-t',
+                         'traddr': '-a',
+                         'trsvcid': '-s',
+                         'nqn': '-n',
+                         'hostnqn': '-q',
+                         'hostid': '-I',
+                         'nr_io_queues': '-i',
+                         'queue_size': '-Q',
+                         'ctrl_loss_tmo': '-l'}
+
+NVME_HOSTID_FILE = '/etc/nvme/hostid'
+SYSFS_PATH = linuxblock.SYSFS
+# Topology snapshots only need the NVMe namespaces and their controllers
+NVME_DEVICE_PATTERNS = ('nvme*',)
+
+# Seconds after which the NVMe index is rebuilt if we cannot get uevents
+INDEX_POLL_INTERVAL = 10
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_BUFFER_SIZE = 16384
+
+MD_BITMAPS = ('internal', 'none')
+MD_BITMAP_CHUNK_PATTERN = re.compile(r'^[0-9]+[KMG]?$')
+
 synchronized = lockutils.synchronized_with_prefix('os-brick-')
 
 LOG = logging.getLogger(__name__)
 
 
+class NVMeNamespace(collections.namedtuple(
+        'NVMeNamespace',
+        ['name',         # Block device name, ie: 'nvme0n1'
+         'controllers',  # Tuple of (controller, state), ie: ('nvme0', 'live')
+         'uuid',         # Namespace uuid, ie: 'c20aba21-6ef6-...'
+         'nguid',        # Namespace nguid, ie: '4941ef75-95b8-...'
+         'wwid',         # Contents of the wwid file, ie: 'eui.4941ef75...'
+         'size',         # Size in bytes
+         ])):
+    __slots__ = ()
+
+    @property
+    def path(self):
+        return DEV_SEARCH_PATH + self.name
+
+    @property
+    def live(self):
+        return any(state == 'live' for _ctrl, state in self.controllers)
+
+
 class NVMeOFConnector(base.BaseLinuxConnector):
     """Connector class to attach/detach NVMe-oF volumes."""
 
@@ -47,6 +100,9 @@ class NVMeOFConnector(base.BaseLinuxConnector):
 
     def __init__(self, root_helper, driver=None, use_multipath=False,
                  device_scan_attempts=DEVICE_SCAN_ATTEMPTS_DEFAULT,
+                 concurrent_connect=False,
+                 portal_connect_timeout=PORTAL_CONNECT_TIMEOUT_DEFAULT,
+                 use_fabrics_device=False,
                  *args, **kwargs):
         super(NVMeOFConnector, self).__init__(
             root_helper,
@@ -54,6 +110,9 @@ class NVMeOFConnector(base.BaseLinuxConnector):
             device_scan_attempts=device_scan_attempts,
             *args, **kwargs)
         self.use_multipath = use_multipath
+        self.concurrent_connect = concurrent_connect
+        self.portal_connect_timeout = portal_connect_timeout
+        self.use_fabrics_device = use_fabrics_device
         self._set_native_multipath_supported()
         if self.use_multipath and not \
                 NVMeOFConnector.native_multipath_supported:
@@ -170,33 +229,43 @@ class NVMeOFConnector(base.BaseLinuxConnector):
             LOG.warning("Could not find nvme_core/parameters/multipath")
         return False
 
+    @classmethod
+    def get_nvme_namespaces(cls, topology=None):
+        """Return the NVMe namespaces present in the system.
+
+        Everything comes from a `linuxblock.BlockDeviceTopology` snapshot of
+        the NVMe devices, which has the namespace identifiers from /sys/block
+        and the controllers (and their state) from /sys/class/nvme, so unlike
+        ``nvme list`` no device is ever opened.
+
+        :param topology: Snapshot to use instead of taking a new one.
+        """
+        if topology is None:
+            topology = linuxblock.BlockDeviceTopology.snapshot(
+                SYSFS_PATH, patterns=NVME_DEVICE_PATTERNS)
+        namespaces = []
+        for device in topology:
+            match = linuxblock.NVME_NS_PATTERN.match(device.name)
+            # Multipath hidden devices are not exposed in /dev
+            if not match or match.group(2):
+                continue
+            ctrls = topology.get_namespace_controllers(device.name)
+            namespaces.append(NVMeNamespace(
+                name=device.name,
+                controllers=tuple((ctrl.name, ctrl.state) for ctrl in ctrls),
+                uuid=device.uuid,
+                nguid=device.nguid,
+                wwid=device.wwid,
+                size=device.size))
+        namespaces.sort(key=lambda ns: ns.name)
+        LOG.debug("Found NVMe namespaces %s", namespaces)
+        return namespaces
+
     def _get_nvme_devices(self):
-        nvme_devices = []
-        # match nvme devices like /dev/nvme10n10
-        pattern = r'/dev/nvme[0-9]+n[0-9]+'
-        cmd = ['nvme', 'list']
-        for retry in range(1, self.device_scan_attempts + 1):
-            try:
-                (out, err) = self._execute(*cmd,
-                                           root_helper=self._root_helper,
-                                           run_as_root=True)
-                for line in out.split('\n'):
-                    result = re.match(pattern, line)
-                    if result:
-                        nvme_devices.append(result.group(0))
-                LOG.debug("_get_nvme_devices returned %(nvme_devices)s",
-                          {'nvme_devices': nvme_devices})
-                return nvme_devices
-
-            except putils.ProcessExecutionError:
-                LOG.warning(
-                    "Failed to list available NVMe connected controllers, "
-                    "retrying.")
-                time.sleep(retry ** 2)
-        else:
-            msg = _("Failed to retrieve available connected NVMe controllers "
-                    "when running nvme list.")
-            raise exception.CommandExecutionFailed(message=msg)
+        nvme_devices = [ns.path for ns in self.get_nvme_namespaces()]
+        LOG.debug("_get_nvme_devices returned %(nvme_devices)s",
+                  {'nvme_devices': nvme_devices})
+        return nvme_devices
 
     @utils.retry(exception.VolumePathsNotFound)
     def _get_device_path(self, current_nvme_devices):
@@ -210,36 +279,145 @@ class NVMeOFConnector(base.BaseLinuxConnector):
 
     @utils.retry(exception.VolumeDeviceNotFound)
     def _get_device_path_by_nguid(self, nguid):
-        device_path = os.path.join(DEV_SEARCH_PATH,
-                                   'disk',
-                                   'by-id',
-                                   'nvme-eui.%s' % nguid)
-        LOG.debug("Try to retrieve symlink to %(device_path)s.",
-                  {"device_path": device_path})
-        try:
-            path, _err = self._execute('readlink',
-                                       '-e',
-                                       device_path,
-                                       run_as_root=True,
-                                       root_helper=self._root_helper)
-            if not path:
-                raise exception.VolumePathsNotFound()
-            return path.rstrip()
-        except putils.ProcessExecutionError as e:
-            LOG.exception(e)
-            raise exception.VolumeDeviceNotFound(device=device_path)
-
-    @utils.retry(putils.ProcessExecutionError)
-    def _try_connect_nvme(self, cmd):
+        LOG.debug("Try to find NVMe namespace with nguid %s.", nguid)
+        ns = NVMeIndex.get().get_namespace(nguid=nguid)
+        if not ns:
+            raise exception.VolumeDeviceNotFound(device='nguid ' + nguid)
+        return ns.path
+
+    @utils.retry((putils.ProcessExecutionError, OSError))
+    def _try_connect_nvme(self, options):
         try:
-            self._execute(*cmd, root_helper=self._root_helper,
-                          run_as_root=True)
+            self.connect_nvme(self, options)
         except putils.ProcessExecutionError as e:
             # Idempotent connection to target.
             # Exit code 70 means that target is already connected.
             if e.exit_code == 70:
                 return
             raise
+        except OSError as e:
+            if e.errno == errno.EALREADY:
+                return
+            raise
+
+    @staticmethod
+    def connect_nvme(executor, options, **kwargs):
+        """Connect to an NVMe-oF target.
+
+        If the connector has `use_fabrics_device` enabled the options are
+        written directly to /dev/nvme-fabrics from the privsep daemon, which
+        avoids running nvme-cli and its discovery side effects.  If the device
+        is not present, because the nvme-fabrics module is not loaded, we fall
+        back to nvme connect.
+
+        :param options: Dictionary of fabrics options, see
+                        `NVME_CONNECT_CLI_ARGS` for the accepted keys.
+        :param kwargs: Additional arguments for the nvme-cli execution.  Only
+                       `timeout` is used with /dev/nvme-fabrics.
+        """
+        if getattr(executor, 'use_fabrics_device', False):
+            try:
+                ctrl = NVMeOFConnector._connect_ctrl(
+                    NVMeOFConnector._get_fabrics_options(options),
+                    kwargs.get('timeout'))
+                LOG.debug('Connected to %(nqn)s as controller %(ctrl)s',
+                          {'nqn': options.get('nqn'), 'ctrl': ctrl})
+                return
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                LOG.debug('%s not present, falling back to nvme-cli',
+                          priv_nvme.NVME_FABRICS)
+
+        nvme_command = ['connect']
+        for key, value in options.items():
+            if value is not None:
+                nvme_command.extend((NVME_CONNECT_CLI_ARGS[key], value))
+        NVMeOFConnector.run_nvme_cli(executor, tuple(nvme_command), **kwargs)
+
+    @staticmethod
+    def disconnect_nvme(executor, ctrl):
+        """Disconnect an NVMe-oF controller, ie: 'nvme3'.
+
+        Uses the controller's delete_controller file in sysfs when the
+        connector has `use_fabrics_device` enabled and nvme-cli otherwise or
+        if the former fails.
+        """
+        if getattr(executor, 'use_fabrics_device', False):
+            try:
+                priv_nvme.delete_ctrl(ctrl)
+                return
+            except OSError as exc:
+                LOG.debug('Could not delete controller %(ctrl)s using '
+                          'sysfs, falling back to nvme-cli: %(exc)s',
+                          {'ctrl': ctrl, 'exc': exc})
+        NVMeOFConnector.run_nvme_cli(executor,
+                                     ('disconnect', '-d', '/dev/' + ctrl))
+
+    def _try_disconnect(self, target_nqn, device_path):
+        """Delete the controllers of a subsystem that only had this device.
+
+        Controllers with any other namespace are kept, since they are in use
+        or new volumes may be appearing on them.
+        """
+        topology = linuxblock.BlockDeviceTopology.snapshot(
+            SYSFS_PATH, patterns=NVME_DEVICE_PATTERNS)
+        name = os.path.basename(device_path)
+        for ctrl in topology.get_nvme_controllers(target_nqn):
+            if ctrl.namespaces == (name,):
+                self.disconnect_nvme(self, ctrl.name)
+
+    @staticmethod
+    def _get_fabrics_options(options):
+        """Add the host identity that nvme connect would send.
+
+        nvme-cli reads the host NQN and host ID from /etc/nvme when they are
+        not provided, but the kernel uses its own defaults, which targets with
+        host ACLs reject.
+        """
+        options = dict(options)
+        if not options.get('hostnqn'):
+            options['hostnqn'] = utils.get_host_nqn()
+        if not options.get('hostid'):
+            try:
+                with open(NVME_HOSTID_FILE, 'r') as f:
+                    options['hostid'] = f.read().strip() or None
+            except OSError:
+                LOG.debug('Could not read %s', NVME_HOSTID_FILE)
+        return options
+
+    @staticmethod
+    def _connect_ctrl(options, timeout=None):
+        """Write the options to /dev/nvme-fabrics with an optional timeout.
+
+        Like running nvme-cli with a timeout, raises ExecutionTimeout if the
+        kernel hasn't replied in time, but the connection attempt can't be
+        cancelled and carries on in the background.
+        """
+        if timeout is None:
+            return priv_nvme.connect_ctrl(options)
+
+        result: dict = {}
+
+        def connect():
+            try:
+                result['ctrl'] = priv_nvme.connect_ctrl(options)
+            except Exception as exc:
+                result['exc'] = exc
+
+        thread = brick_executor.Thread(target=connect)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            msg = ('Time out after waiting %(time)s seconds when writing to '
+                   '%(path)s' % {'time': timeout,
+                                 'path': priv_nvme.NVME_FABRICS})
+            LOG.debug(msg)
+            raise exception.ExecutionTimeout(stdout='', stderr=msg,
+                                             cmd=priv_nvme.NVME_FABRICS)
+        if 'exc' in result:
+            raise result['exc']
+        return result['ctrl']
 
     def _get_nvme_subsys(self):
         # Example output:
@@ -354,16 +532,13 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         nvme_transport_type = connection_properties['transport_type']
         host_nqn = connection_properties.get('host_nqn')
         device_nguid = connection_properties.get('volume_nguid')
-        cmd = [
-            'nvme', 'connect',
-            '-t', nvme_transport_type,
-            '-n', conn_nqn,
-            '-a', target_portal,
-            '-s', port]
-        if host_nqn:
-            cmd.extend(['-q', host_nqn])
-
-        self._try_connect_nvme(cmd)
+        options = {'transport': nvme_transport_type,
+                   'nqn': conn_nqn,
+                   'traddr': target_portal,
+                   'trsvcid': port,
+                   'hostnqn': host_nqn or None}
+
+        self._try_connect_nvme(options)
         try:
             self._wait_for_blk(nvme_transport_type, conn_nqn,
                                target_portal, port)
@@ -392,6 +567,9 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         volumes can pop up asynchronously in the meantime. So the only thing
         left is flushing or disassembly of a correspondng RAID device.
 
+        The exception is the `use_fabrics_device` mode, where the controllers
+        of the subsystem that only have this volume are deleted afterwards.
+
         :param connection_properties: The dictionary that describes all
                                       of the target volume attributes.
                connection_properties must include:
@@ -421,6 +599,8 @@ class NVMeOFConnector(base.BaseLinuxConnector):
 
         try:
             self._linuxscsi.flush_device_io(device_path)
+            if self.use_fabrics_device:
+                self._try_disconnect(conn_nqn, device_path)
         except putils.ProcessExecutionError:
             if not ignore_errors:
                 raise
@@ -463,24 +643,17 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         volume_alias = connection_properties.get('alias')
 
         if volume_replicas:
-            host_device_paths = []
-
-            for replica in volume_replicas:
-                try:
-                    rep_host_device_path = self._connect_target_volume(
-                        replica['target_nqn'], replica['vol_uuid'],
-                        replica['portals'])
-                    if rep_host_device_path:
-                        host_device_paths.append(rep_host_device_path)
-                except Exception as ex:
-                    LOG.error("_connect_target_volume: %s", ex)
+            # Validate them before connecting anything
+            raid_options = self._get_raid_options(connection_properties)
+            host_device_paths = self._connect_replicas(volume_replicas)
             if not host_device_paths:
                 raise exception.VolumeDeviceNotFound(
                     device=volume_replicas)
 
             if replica_count > 1:
                 device_path = self._handle_replicated_volume(
-                    host_device_paths, volume_alias, replica_count)
+                    host_device_paths, volume_alias, replica_count,
+                    raid_options)
             else:
                 device_path = self._handle_single_replica(
                     host_device_paths, volume_alias)
@@ -495,6 +668,37 @@ class NVMeOFConnector(base.BaseLinuxConnector):
 
         return {'type': 'block', 'path': device_path}
 
+    def _connect_replicas(self, volume_replicas):
+        """Connect to all the replicas concurrently.
+
+        Replicas that fail to connect are logged and skipped.
+
+        :returns: List with the device paths of the connected replicas, in the
+                  same order as the replicas.
+        """
+        results = [None] * len(volume_replicas)
+
+        def connect(i, replica):
+            try:
+                results[i] = self._connect_target_volume(
+                    replica['target_nqn'], replica['vol_uuid'],
+                    replica['portals'])
+            except Exception as ex:
+                LOG.error("_connect_target_volume: %s", ex)
+
+        if len(volume_replicas) == 1:
+            connect(0, volume_replicas[0])
+        else:
+            threads = [brick_executor.Thread(target=connect,
+                                             args=(i, replica))
+                       for i, replica in enumerate(volume_replicas)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return [path for path in results if path]
+
     @utils.trace
     def _disconnect_volume_replicated(self, connection_properties, device_info,
                                       force=False, ignore_errors=False):
@@ -547,8 +751,8 @@ class NVMeOFConnector(base.BaseLinuxConnector):
             raise exception.VolumeDeviceNotFound(device=target_nqn)
         if any_new_connect:
             # new connections - refresh controllers map
-            nvme_ctrls = \
-                NVMeOFConnector.get_live_nvme_controllers_map(self, target_nqn)
+            nvme_ctrls = NVMeOFConnector.get_live_nvme_controllers_map(
+                self, target_nqn, portals)
         nvme_ctrls_values = list(nvme_ctrls.values())
         dev_path = NVMeOFConnector.get_nvme_device_path(self, target_nqn,
                                                         vol_uuid,
@@ -566,6 +770,9 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         any_new_connect = False
         no_multipath = (not executor.use_multipath
                         or not NVMeOFConnector.native_multipath_supported)
+        if not no_multipath and getattr(executor, 'concurrent_connect', False):
+            return executor._connect_to_portals_concurrently(
+                target_nqn, target_portals, nvme_ctrls)
         for portal in target_portals:
             portal_address = portal[0]
             portal_port = portal[1]
@@ -574,15 +781,9 @@ class NVMeOFConnector(base.BaseLinuxConnector):
                 if no_multipath:
                     break
                 continue
-            if portal[2] == 'RoCEv2':
-                portal_transport = 'rdma'
-            else:
-                portal_transport = 'tcp'
-            nvme_command = (
-                'connect', '-a', portal_address, '-s', portal_port, '-t',
-                portal_transport, '-n', target_nqn, '-Q', '128', '-l', '-1')
+            options = NVMeOFConnector._get_connect_options(target_nqn, portal)
             try:
-                NVMeOFConnector.run_nvme_cli(executor, nvme_command)
+                NVMeOFConnector.connect_nvme(executor, options)
                 any_new_connect = True
                 if no_multipath:
                     break
@@ -590,9 +791,77 @@ class NVMeOFConnector(base.BaseLinuxConnector):
                 LOG.exception("Could not connect to portal %s", portal)
         return any_new_connect
 
+    @staticmethod
+    def _get_connect_options(target_nqn, portal):
+        portal_address, portal_port, portal_transport = portal[:3]
+        if portal_transport == 'RoCEv2':
+            portal_transport = 'rdma'
+        else:
+            portal_transport = 'tcp'
+        return {'traddr': portal_address,
+                'trsvcid': portal_port,
+                'transport': portal_transport,
+                'nqn': target_nqn,
+                'queue_size': '128',
+                'ctrl_loss_tmo': '-1'}
+
+    def _connect_to_portals_concurrently(self, target_nqn, target_portals,
+                                         nvme_ctrls):
+        """Connect to all the missing portals in parallel.
+
+        With native multipath every portal gets connected, and doing it in
+        parallel makes the attach take as long as the slowest portal instead
+        of the sum of all of them.
+
+        Each connection has a deadline of `portal_connect_timeout` seconds and
+        so does waiting for all of them, so an unreachable portal doesn't
+        stall the attach for longer than that.
+
+        :returns: Whether any new portal was connected.
+        """
+        portals = [portal for portal in target_portals
+                   if not self.is_portal_connected(portal[0], portal[1],
+                                                   nvme_ctrls)]
+        if not portals:
+            return False
+
+        # Used to communicate with the threads
+        connected: list = []
+
+        def connect(portal):
+            options = self._get_connect_options(target_nqn, portal)
+            try:
+                self.connect_nvme(self, options,
+                                  timeout=self.portal_connect_timeout)
+                connected.append(portal)
+            except Exception:
+                LOG.exception("Could not connect to portal %s", portal)
+
+        threads = [brick_executor.Thread(target=connect, args=(portal,))
+                   for portal in portals]
+        for thread in threads:
+            thread.start()
+
+        deadline = time.monotonic() + self.portal_connect_timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        pending = sum(thread.is_alive() for thread in threads)
+        if pending:
+            LOG.warning("%(pending)s portals for %(nqn)s did not connect in "
+                        "%(timeout)s seconds",
+                        {'pending': pending, 'nqn': target_nqn,
+                         'timeout': self.portal_connect_timeout})
+        return bool(connected)
+
+    @staticmethod
+    def _get_portal_ctrl_address(portal_address, portal_port):
+        """Return the address the kernel reports for a portal's controller."""
+        return f"traddr={portal_address},trsvcid={portal_port}"
+
     @staticmethod
     def is_portal_connected(portal_address, portal_port, nvme_ctrls):
-        address = f"traddr={portal_address},trsvcid={portal_port}"
+        address = NVMeOFConnector._get_portal_ctrl_address(portal_address,
+                                                           portal_port)
         return address in nvme_ctrls
 
     @staticmethod
@@ -604,37 +873,15 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         raise exception.VolumeDeviceNotFound(device=target_nqn)
 
     @staticmethod
-    def get_live_nvme_controllers_map(executor, target_nqn):
-        """returns map of all live controllers and their addresses """
-        nvme_controllers = dict()
-        ctrls = glob.glob('/sys/class/nvme-fabrics/ctl/nvme*')
-        for ctrl in ctrls:
-            try:
-                lines, _err = executor._execute(
-                    'cat', ctrl + '/subsysnqn', run_as_root=True,
-                    root_helper=executor._root_helper)
-                for line in lines.split('\n'):
-                    if line == target_nqn:
-                        state, _err = executor._execute(
-                            'cat', ctrl + '/state', run_as_root=True,
-                            root_helper=executor._root_helper)
-                        if 'live' in state:
-                            address_file = ctrl + '/address'
-                            try:
-                                with open(address_file, 'rt') as f:
-                                    address = f.read().strip()
-                            except Exception:
-                                LOG.warning("Failed to read file %s",
-                                            address_file)
-                                continue
-                            ctrl_name = os.path.basename(ctrl)
-                            LOG.debug("[!] address: %s|%s", address, ctrl_name)
-                            nvme_controllers[address] = ctrl_name
-                        else:
-                            LOG.debug("nvmeof ctrl device not live: %s", ctrl)
-            except putils.ProcessExecutionError as e:
-                LOG.exception(e)
-        return nvme_controllers
+    def get_live_nvme_controllers_map(executor, target_nqn, portals=None):
+        """returns map of all live controllers and their addresses
+
+        :param portals: Portals we expect to be connected, ie: the ones we
+                        have just connected to.
+        """
+        addresses = [NVMeOFConnector._get_portal_ctrl_address(*portal[:2])
+                     for portal in portals or ()]
+        return NVMeIndex.get().get_live_controllers(target_nqn, addresses)
 
     @staticmethod
     @utils.retry(exception.VolumeDeviceNotFound, retries=5)
@@ -643,24 +890,67 @@ class NVMeOFConnector(base.BaseLinuxConnector):
             nvme_ctrls = NVMeOFConnector.get_nvme_controllers(executor,
                                                               target_nqn)
         LOG.debug("[!] nvme_ctrls: %s", nvme_ctrls)
-        for nvme_ctrl in nvme_ctrls:
-            uuid_paths = glob.glob('/sys/class/block/' + nvme_ctrl + 'n*/uuid')
-            for uuid_path in uuid_paths:
-                try:
-                    uuid_lines, _err = executor._execute(
-                        'cat', uuid_path, run_as_root=True,
-                        root_helper=executor._root_helper)
-                    if uuid_lines.split('\n')[0] == vol_uuid:
-                        ignore = len('/uuid')
-                        ns_ind = uuid_path.rfind('/', 0, -ignore)
-                        nvme_device = uuid_path[ns_ind + 1: -ignore]
-                        return '/dev/' + nvme_device
-                except putils.ProcessExecutionError as e:
-                    LOG.exception(e)
-        raise exception.VolumeDeviceNotFound(device=vol_uuid)
+        ns = NVMeIndex.get().get_namespace(uuid=vol_uuid,
+                                           controllers=nvme_ctrls)
+        if not ns:
+            raise exception.VolumeDeviceNotFound(device=vol_uuid)
+        return ns.path
+
+    @staticmethod
+    def _get_raid_options(connection_properties):
+        """Get the md RAID options from the connection properties.
+
+        Supported connection properties are:
+
+        - md_assume_clean: Skip the initial resync when creating the RAID,
+          which is only safe if all replicas have the same contents, for
+          example when they are freshly provisioned zeroed volumes.  Boolean
+          or string like 'false', defaults to True.
+        - md_bitmap: Write-intent bitmap, 'internal' (default) or 'none'.
+        - md_bitmap_chunk: Size of the chunks tracked by the bitmap, for
+          example '64M'.
+        - md_sync_speed_min and md_sync_speed_max: Resync speed limits in
+          KiB/s for this RAID.
+
+        :raises InvalidParameterValue: If any of the options is not valid.
+        """
+        assume_clean = connection_properties.get('md_assume_clean', True)
+        try:
+            assume_clean = strutils.bool_from_string(assume_clean,
+                                                     strict=True)
+        except ValueError:
+            raise exception.InvalidParameterValue(
+                err=_('Invalid md_assume_clean %s, must be a boolean') %
+                assume_clean)
+        options = {
+            'assume_clean': assume_clean,
+            'bitmap': connection_properties.get('md_bitmap', 'internal'),
+            'bitmap_chunk': connection_properties.get('md_bitmap_chunk'),
+            'sync_speed_min': connection_properties.get('md_sync_speed_min'),
+            'sync_speed_max': connection_properties.get('md_sync_speed_max'),
+        }
+        if options['bitmap'] not in MD_BITMAPS:
+            raise exception.InvalidParameterValue(
+                err=_('Invalid md_bitmap %(bitmap)s, must be one of '
+                      '%(valid)s') % {'bitmap': options['bitmap'],
+                                      'valid': MD_BITMAPS})
+        chunk = options['bitmap_chunk']
+        if chunk is not None and not MD_BITMAP_CHUNK_PATTERN.match(str(chunk)):
+            raise exception.InvalidParameterValue(
+                err=_('Invalid md_bitmap_chunk %s') % chunk)
+        for key in ('sync_speed_min', 'sync_speed_max'):
+            value = options[key]
+            if value is not None and (isinstance(value, bool) or
+                                      not isinstance(value, int) or
+                                      value <= 0):
+                raise exception.InvalidParameterValue(
+                    err=_('Invalid md_%(key)s %(value)s, must be a positive '
+                          'integer') % {'key': key, 'value': value})
+        return options
 
     def _handle_replicated_volume(self, host_device_paths,
-                                  volume_alias, num_of_replicas):
+                                  volume_alias, num_of_replicas,
+                                  raid_options=None):
         path_in_raid = False
         for dev_path in host_device_paths:
             path_in_raid = NVMeOFConnector._is_device_in_raid(self, dev_path)
@@ -678,8 +968,13 @@ class NVMeOFConnector(base.BaseLinuxConnector):
                     paths_found, num_of_replicas)
                 raise exception.VolumeDeviceNotFound(device=volume_alias)
             NVMeOFConnector.create_raid(self, host_device_paths, '1',
-                                        volume_alias, volume_alias, False)
+                                        volume_alias, volume_alias, False,
+                                        raid_options)
 
+        if raid_options:
+            NVMeOFConnector.set_raid_sync_speed(
+                device_path, raid_options['sync_speed_min'],
+                raid_options['sync_speed_max'])
         return device_path
 
     def _handle_single_replica(self, host_device_paths, volume_alias):
@@ -801,7 +1096,16 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         return True
 
     @staticmethod
-    def create_raid(executor, drives, raid_type, device_name, name, read_only):
+    def create_raid(executor, drives, raid_type, device_name, name, read_only,
+                    options=None):
+        """Create an md RAID.
+
+        :param options: Dictionary as returned by `_get_raid_options`, by
+                        default an internal bitmap is used and the initial
+                        resync is skipped.
+        """
+        options = options or {}
+        bitmap = options.get('bitmap', 'internal')
         cmd = ['mdadm']
         num_drives = len(drives)
         cmd.append('-C')
@@ -819,10 +1123,13 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         cmd.append('--level')
         cmd.append(raid_type)
         cmd.append('--raid-devices=' + str(num_drives))
-        cmd.append('--bitmap=internal')
+        cmd.append('--bitmap=' + bitmap)
+        if bitmap != 'none' and options.get('bitmap_chunk'):
+            cmd.append('--bitmap-chunk=%s' % options['bitmap_chunk'])
         cmd.append('--homehost=any')
         cmd.append('--failfast')
-        cmd.append('--assume-clean')
+        if options.get('assume_clean', True):
+            cmd.append('--assume-clean')
 
         for i in range(len(drives)):
             cmd.append(drives[i])
@@ -843,6 +1150,67 @@ class NVMeOFConnector(base.BaseLinuxConnector):
         LOG.error(msg)
         raise exception.NotFound(message=msg)
 
+    @staticmethod
+    def _get_md_sysfs_path(md_path):
+        # /dev/md/<alias> is a link to /dev/md<N>
+        md_name = os.path.basename(os.path.realpath(md_path))
+        return os.path.join(SYSFS_PATH, 'block', md_name, 'md')
+
+    @staticmethod
+    def set_raid_sync_speed(md_path, speed_min=None, speed_max=None):
+        """Set the resync speed limits, in KiB/s, of an md RAID."""
+        path = NVMeOFConnector._get_md_sysfs_path(md_path)
+        for name, value in (('sync_speed_min', speed_min),
+                            ('sync_speed_max', speed_max)):
+            if value is None:
+                continue
+            try:
+                priv_rootwrap.write_sys(os.path.join(path, name), str(value))
+            except OSError as exc:
+                LOG.warning('Could not set %(name)s of %(md)s: %(exc)s',
+                            {'name': name, 'md': md_path, 'exc': exc})
+
+    @staticmethod
+    def get_raid_sync_progress(md_path):
+        """Get the resync or recovery progress of an md RAID.
+
+        :returns: None if the device is not an md RAID, otherwise a dictionary
+                  with the current sync action (ie: 'idle', 'resync',
+                  'recover'), the 'completed' and 'total' sectors, the
+                  'progress' as a fraction and the current 'speed' in KiB/s.
+                  The last 4 are None when there's no sync in progress.
+        """
+        path = NVMeOFConnector._get_md_sysfs_path(md_path)
+        read = linuxblock.read_sysfs
+        action = read(path, 'sync_action')
+        if action is None:
+            return None
+
+        completed = total = None
+        # Either 'none' or '<completed> / <total>'
+        sync_completed = read(path, 'sync_completed')
+        if sync_completed and '/' in sync_completed:
+            completed, total = (int(value)
+                                for value in sync_completed.split('/'))
+        speed = read(path, 'sync_speed')
+        return {'action': action,
+                'completed': completed,
+                'total': total,
+                'progress': completed / total if total else None,
+                'speed': int(speed) if speed and speed.isdigit() else None}
+
+    def get_resync_progress(self, connection_properties):
+        """Get the RAID resync progress of a replicated volume.
+
+        :returns: See `get_raid_sync_progress`.  None for volumes that are not
+                  replicated.
+        """
+        if (connection_properties.get('volume_replicas') and
+                connection_properties.get('replica_count', 0) > 1):
+            return self.get_raid_sync_progress(
+                '/dev/md/' + connection_properties['alias'])
+        return None
+
     @staticmethod
     def end_raid(executor, device_path):
         raid_exists = NVMeOFConnector.is_raid_exists(executor, device_path)
@@ -899,7 +1267,7 @@ class NVMeOFConnector(base.BaseLinuxConnector):
     def run_nvme_cli(executor, nvme_command, **kwargs):
         (out, err) = executor._execute('nvme', *nvme_command, run_as_root=True,
                                        root_helper=executor._root_helper,
-                                       check_exit_code=True)
+                                       check_exit_code=True, **kwargs)
         msg = ("nvme %(nvme_command)s: stdout=%(out)s stderr=%(err)s" %
                {'nvme_command': nvme_command, 'out': out, 'err': err})
         LOG.debug("[!] " + msg)
@@ -933,3 +1301,189 @@ class NVMeOFConnector(base.BaseLinuxConnector):
             return None
 
         return fs_type
+
+
+class NVMeIndex(object):
+    """Host wide index of the NVMe controllers and namespaces.
+
+    Maps subsystem NQNs to their controllers and namespace UUIDs and NGUIDs to
+    their block devices, so connectors don't have to crawl sysfs on every
+    lookup, which is slow on hosts with hundreds of controllers.
+
+    The index is rebuilt from sysfs on the first lookup after it becomes
+    stale, which happens when the kernel sends an NVMe or NVMe block device
+    uevent or, if we cannot listen to uevents, every `poll_interval` seconds.
+    Lookups that miss also rebuild it, since we usually look for devices that
+    have just appeared.
+
+    Controller states change without uevents, so they are not indexed and are
+    read on lookup instead.
+
+    Use the `get` class method to get the shared instance.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, use_uevents=True, poll_interval=INDEX_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._stale = True
+        self._built_at = 0.0
+        self._topology = linuxblock.BlockDeviceTopology(
+            {}, SYSFS_PATH, NVME_DEVICE_PATTERNS)
+        self._ns_by_uuid: dict = {}
+        self._ns_by_nguid: dict = {}
+        self._uevents = use_uevents and self._listen_uevents()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @staticmethod
+    def _open_uevent_socket():
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             NETLINK_KOBJECT_UEVENT)
+        # Let the kernel assign the port id and join the group of the kernel
+        # events (udev's are in group 2)
+        sock.bind((0, 1))
+        return sock
+
+    def _listen_uevents(self):
+        try:
+            sock = self._open_uevent_socket()
+        except (AttributeError, OSError) as exc:
+            LOG.info('Cannot listen to uevents, NVMe index will be rebuilt '
+                     'every %s seconds: %s', self.poll_interval, exc)
+            return False
+        thread = brick_executor.Thread(target=self._watch_uevents,
+                                       args=(sock,), name='nvme-index',
+                                       daemon=True)
+        thread.start()
+        return True
+
+    def _watch_uevents(self, sock):
+        while True:
+            try:
+                data = sock.recv(UEVENT_BUFFER_SIZE)
+            except OSError as exc:
+                # Socket buffer overflowed, we have lost events
+                if exc.errno == errno.ENOBUFS:
+                    self._stale = True
+                    continue
+                LOG.warning('Stopped listening to uevents, NVMe index will be '
+                            'rebuilt every %s seconds: %s',
+                            self.poll_interval, exc)
+                self._uevents = False
+                sock.close()
+                return
+            if self._is_nvme_uevent(data):
+                self._stale = True
+
+    @staticmethod
+    def _is_nvme_uevent(data):
+        # Header (ie: add@/devices/...) followed by null separated KEY=value
+        env = dict(field.partition(b'=')[::2]
+                   for field in data.split(b'\0')[1:] if b'=' in field)
+        subsystem = env.get(b'SUBSYSTEM')
+        return (subsystem in (b'nvme', b'nvme-subsystem') or
+                (subsystem == b'block' and
+                 env.get(b'DEVNAME', b'').startswith(b'nvme')))
+
+    @staticmethod
+    def _normalize_nguid(nguid):
+        return nguid.replace('-', '').lower()
+
+    def _is_stale(self):
+        return self._stale or (
+            not self._uevents and
+            time.monotonic() - self._built_at > self.poll_interval)
+
+    def refresh(self):
+        """Rebuild the index from sysfs."""
+        with self._lock:
+            # Events received while we are reading sysfs make it stale again
+            self._stale = False
+            built_at = time.monotonic()
+
+            # Always a new snapshot, a namespace that is deleted and created
+            # again may get the same major:minor
+            topology = linuxblock.BlockDeviceTopology.snapshot(
+                SYSFS_PATH, patterns=NVME_DEVICE_PATTERNS)
+
+            ns_by_uuid = {}
+            ns_by_nguid = {}
+            for ns in NVMeOFConnector.get_nvme_namespaces(topology):
+                if ns.uuid:
+                    ns_by_uuid[ns.uuid] = ns
+                # Old kernels don't have the nguid file, but the wwid has it
+                nguid = ns.nguid or (ns.wwid or '').partition('eui.')[2]
+                if nguid:
+                    ns_by_nguid[self._normalize_nguid(nguid)] = ns
+
+            self._topology = topology
+            self._ns_by_uuid = ns_by_uuid
+            self._ns_by_nguid = ns_by_nguid
+            self._built_at = built_at
+
+    def _lookup(self, find):
+        refreshed = self._is_stale()
+        if refreshed:
+            self.refresh()
+        result = find()
+        if not result and not refreshed:
+            self.refresh()
+            result = find()
+        return result
+
+    def get_live_controllers(self, nqn, addresses=()):
+        """Return a dict with the address of each live controller of an NQN.
+
+        For example {'traddr=10.0.0.1,trsvcid=4420': 'nvme3'}.
+
+        :param addresses: Addresses of the controllers we expect, ie: those
+                          of the portals we have just connected to.  If any
+                          is missing the index is rebuilt, because a new
+                          controller of a known NQN is not there until its
+                          uevent is handled.
+        """
+        ctrls = self._lookup(
+            lambda: self._topology.get_nvme_controllers(nqn))
+        if not {ctrl.address for ctrl in ctrls}.issuperset(addresses):
+            self.refresh()
+            ctrls = self._topology.get_nvme_controllers(nqn)
+        result = {}
+        for ctrl in ctrls:
+            state = linuxblock.read_sysfs(SYSFS_PATH, 'class', 'nvme',
+                                          ctrl.name, 'state')
+            if state != 'live':
+                LOG.debug("nvmeof ctrl device not live: %s", ctrl.name)
+            elif not ctrl.address:
+                LOG.warning("Failed to read address of %s", ctrl.name)
+            else:
+                LOG.debug("[!] address: %s|%s", ctrl.address, ctrl.name)
+                result[ctrl.address] = ctrl.name
+        return result
+
+    def get_namespace(self, uuid=None, nguid=None, controllers=None):
+        """Find a namespace by its UUID or its NGUID.
+
+        :param controllers: If provided, the namespace must be accessible
+                            through at least one of these controllers.
+        :returns: NVMeNamespace or None
+        """
+        key = uuid or self._normalize_nguid(nguid)
+
+        def find():
+            # Get the index on each call, since it may have been rebuilt
+            ns = (self._ns_by_uuid if uuid else self._ns_by_nguid).get(key)
+            if ns and controllers is not None:
+                if not any(ctrl in controllers
+                           for ctrl, _state in ns.controllers):
+                    return None
+            return ns
+
+        return self._lookup(find)
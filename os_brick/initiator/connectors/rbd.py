@@ -13,9 +13,15 @@
 #    under the License.
 
 
+import collections
+import errno
+import hashlib
 import os
+import re
+import stat
 import tempfile
 
+from oslo_concurrency import lockutils
 from oslo_concurrency import processutils as putils
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
@@ -27,16 +33,74 @@ from os_brick.i18n import _
 from os_brick import initiator
 from os_brick.initiator.connectors import base
 from os_brick.initiator.connectors import base_rbd
+from os_brick.initiator import linuxblock
 from os_brick.initiator import linuxrbd
 from os_brick.privileged import rbd as rbd_privsep
 from os_brick import utils
 
 LOG = logging.getLogger(__name__)
 
+CEPH_CONF_PREFIX = 'brickrbd_'
+# Directory for the generated Ceph config files, None for the system's
+# temporary directory
+CEPH_CONF_DIR = None
+# Shared config files are named after their owner and a hash of their contents
+CEPH_CONF_SHARED_PATTERN = re.compile(
+    '^' + CEPH_CONF_PREFIX + r'[0-9]+_[0-9a-f]{64}$')
+# Suffix of the files with the number of users of a shared config file
+CEPH_CONF_REFS_SUFFIX = '.refs'
+
+RBD_SYSFS_PATH = '/sys/bus/rbd/devices'
+
+# Supported options for "rbd map -o", with the first kernel version that
+# supports each of them and the values they accept: FLAG for options without
+# value, UINT and POSITIVE_INT for integers, POWER_OF_2 for sizes in bytes,
+# STRING, or a tuple with the valid values.
+FLAG, UINT, POSITIVE_INT, POWER_OF_2, STRING = range(5)
+RBD_MAP_OPTIONS = {
+    'queue_depth': ((4, 2), POSITIVE_INT),
+    'lock_on_read': ((4, 9), FLAG),
+    'exclusive': ((4, 12), FLAG),
+    'lock_timeout': ((4, 17), UINT),
+    'notrim': ((4, 17), FLAG),
+    'alloc_size': ((5, 1), POWER_OF_2),
+    'read_from_replica': ((5, 8), ('no', 'balance', 'localize')),
+    'crush_location': ((5, 8), STRING),
+    'compression_hint': ((5, 8), ('none', 'compressible', 'incompressible')),
+    'ms_mode': ((5, 11), ('legacy', 'crc', 'secure', 'prefer-crc',
+                          'prefer-secure')),
+    'noudev': ((5, 16), FLAG),
+    'rxbounce': ((5, 17), FLAG),
+}
+# Map options that are not reported back because they are credentials
+RBD_SECRET_OPTIONS = ('name', 'key', 'secret')
+
+
+class RBDMapping(collections.namedtuple(
+        'RBDMapping',
+        ['id',         # Device id, ie: '0' for /dev/rbd0
+         'pool',       # Pool name
+         'namespace',  # Pool namespace, '' for the default one
+         'name',       # Image name
+         'snap',       # Mapped snapshot, '-' for the image itself
+         ])):
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.pool, self.namespace, self.name, self.snap
+
+    @property
+    def device(self):
+        return '/dev/rbd' + self.id
+
 
 class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
     """"Connector class to attach/detach RBD volumes."""
 
+    # The rbd CLI doesn't go away once we have seen it
+    _rbd_cli_available = False
+
     def __init__(self, root_helper, driver=None, use_multipath=False,
                  device_scan_attempts=initiator.DEVICE_SCAN_ATTEMPTS_DEFAULT,
                  *args, **kwargs):
@@ -46,6 +110,7 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
                                            device_scan_attempts,
                                            *args, **kwargs)
         self.do_local_attach = kwargs.get('do_local_attach', False)
+        self.rbd_map_options = kwargs.get('rbd_map_options')
 
     @staticmethod
     def get_connector_properties(root_helper, *args, **kwargs):
@@ -91,19 +156,138 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
         keyring = cls._check_or_get_keyring_contents(keyring, cluster_name,
                                                      user)
 
+        # Bug #1865754 - '[global]' has been the appropriate
+        # place for this stuff since at least Hammer, but in
+        # Octopus (15.2.0+), Ceph began enforcing this.
+        contents = ''.join(["[global]", "\n", mon_hosts, "\n", keyring, "\n"])
+
+        # Attachments to the same cluster with the same user share the file,
+        # which is named after its contents.  Its number of users is stored
+        # next to it, since it's shared with other processes and must
+        # survive restarts.
+        directory = CEPH_CONF_DIR or tempfile.gettempdir()
+        digest = hashlib.sha256(contents.encode('utf-8')).hexdigest()
+        ceph_conf_path = os.path.join(
+            directory, '%s%s_%s' % (CEPH_CONF_PREFIX, os.geteuid(), digest))
         try:
-            fd, ceph_conf_path = tempfile.mkstemp(prefix="brickrbd_")
-            with os.fdopen(fd, 'w') as conf_file:
-                # Bug #1865754 - '[global]' has been the appropriate
-                # place for this stuff since at least Hammer, but in
-                # Octopus (15.2.0+), Ceph began enforcing this.
-                conf_file.writelines(["[global]", "\n",
-                                      mon_hosts, "\n",
-                                      keyring, "\n"])
-            return ceph_conf_path
-        except IOError:
+            with cls._ceph_conf_lock(directory):
+                if not cls._is_own_private_file(ceph_conf_path):
+                    ceph_conf_path = cls._write_ceph_conf(ceph_conf_path,
+                                                          contents)
+                if cls._is_shared_ceph_conf(ceph_conf_path):
+                    refs = cls._read_ceph_conf_refs(ceph_conf_path) or 0
+                    cls._write_ceph_conf_refs(ceph_conf_path, refs + 1)
+        except (IOError, OSError):
             msg = (_("Failed to write data to %s.") % (ceph_conf_path))
             raise exception.BrickException(msg=msg)
+        return ceph_conf_path
+
+    @staticmethod
+    def _ceph_conf_lock(directory):
+        """Lock for the shared config files of this user in a directory."""
+        return lockutils.lock('%s%s.lock' % (CEPH_CONF_PREFIX, os.geteuid()),
+                              external=True, lock_path=directory)
+
+    @staticmethod
+    def _is_shared_ceph_conf(path):
+        return bool(CEPH_CONF_SHARED_PATTERN.match(os.path.basename(path)))
+
+    @classmethod
+    def _read_ceph_conf_refs(cls, path):
+        """Return the number of users of a shared config, None if unknown.
+
+        Files that are not ours or that others can change are not trusted,
+        since anyone can create them in a shared directory like /tmp.
+        """
+        try:
+            fd = os.open(path + CEPH_CONF_REFS_SUFFIX,
+                         os.O_RDONLY | os.O_NOFOLLOW)
+            with os.fdopen(fd, 'r') as f:
+                if not cls._is_own_private_stat(os.fstat(f.fileno())):
+                    LOG.warning('Ignoring untrusted %s',
+                                path + CEPH_CONF_REFS_SUFFIX)
+                    return None
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_ceph_conf_refs(path, refs):
+        """Atomically replace the number of users of a shared config."""
+        fd, tmp_path = tempfile.mkstemp(prefix=CEPH_CONF_PREFIX,
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as refs_file:
+                refs_file.write(str(refs))
+            os.replace(tmp_path, path + CEPH_CONF_REFS_SUFFIX)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                fileutils.delete_if_exists(tmp_path)
+
+    @staticmethod
+    def _is_own_private_stat(st):
+        """Check that a file is ours and only we can read and change it."""
+        return (stat.S_ISREG(st.st_mode) and st.st_uid == os.geteuid() and
+                not st.st_mode & 0o077)
+
+    @classmethod
+    def _is_own_private_file(cls, path):
+        """Check that a file exists and only we can read and change it."""
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return False
+        return cls._is_own_private_stat(st)
+
+    @staticmethod
+    def _write_ceph_conf(path, contents):
+        """Atomically create a config file only readable by us.
+
+        :returns: The path of the file, which is a unique temporary file if
+                  there is a file we don't own at the requested path.
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix=CEPH_CONF_PREFIX,
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as conf_file:
+                conf_file.write(contents)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                fileutils.delete_if_exists(tmp_path)
+
+        try:
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            if exc.errno not in (errno.EPERM, errno.EACCES):
+                fileutils.delete_if_exists(tmp_path)
+                raise
+            LOG.warning('Cannot replace %s, not sharing Ceph config file',
+                        path)
+            return tmp_path
+        return path
+
+    @classmethod
+    def _release_ceph_conf(cls, path):
+        """Release a file from _create_ceph_conf, deleting it if unused.
+
+        Shared files whose number of users is unknown are never deleted,
+        since other attachments may still need them to unmap their devices.
+        """
+        if not cls._is_shared_ceph_conf(path):
+            fileutils.delete_if_exists(path)
+            return
+
+        with cls._ceph_conf_lock(os.path.dirname(path)):
+            refs = cls._read_ceph_conf_refs(path)
+            if refs is None:
+                LOG.warning('Unknown number of users of %s, not deleting it',
+                            path)
+                return
+            if refs > 1:
+                cls._write_ceph_conf_refs(path, refs - 1)
+                return
+            fileutils.delete_if_exists(path)
+            fileutils.delete_if_exists(path + CEPH_CONF_REFS_SUFFIX)
 
     def _get_rbd_handle(self, connection_properties):
         try:
@@ -130,7 +314,7 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
             rbd_handle = linuxrbd.RBDVolumeIOWrapper(
                 linuxrbd.RBDImageMetadata(rbd_volume, pool, user, conf))
         except Exception:
-            fileutils.delete_if_exists(conf)
+            self._release_ceph_conf(conf)
             raise
 
         return rbd_handle
@@ -170,43 +354,219 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
                                                  keyring)
         return conf
 
-    def _local_attach_volume(self, connection_properties):
+    @classmethod
+    def get_rbd_mappings(cls):
+        """Index of the images mapped by the rbd kernel module.
+
+        Reads /sys/bus/rbd/devices instead of running ``rbd showmapped``.
+
+        :returns: Dictionary of RBDMapping by (pool, namespace, image, snap),
+                  or None if the mappings cannot be read.
+        """
+        try:
+            dev_ids = os.listdir(RBD_SYSFS_PATH)
+        except FileNotFoundError:
+            # The rbd module is not loaded, so nothing is mapped
+            if os.path.isdir(os.path.dirname(RBD_SYSFS_PATH)):
+                return {}
+            return None
+        except OSError as exc:
+            LOG.debug('Cannot read rbd mappings: %s', exc)
+            return None
+
+        mappings = {}
+        for dev_id in dev_ids:
+            path = os.path.join(RBD_SYSFS_PATH, dev_id)
+            pool = linuxblock.read_sysfs(path, 'pool')
+            name = linuxblock.read_sysfs(path, 'name')
+            # Device is being removed
+            if pool is None or name is None:
+                continue
+            mapping = RBDMapping(
+                id=dev_id,
+                pool=pool,
+                # Kernels older than 4.19 don't support namespaces
+                namespace=linuxblock.read_sysfs(path, 'pool_ns') or '',
+                name=name,
+                snap=linuxblock.read_sysfs(path, 'current_snap') or '-')
+            mappings[mapping.key] = mapping
+        return mappings
+
+    @staticmethod
+    def get_rbd_map_options(device):
+        """Get the options a device was mapped with from its config_info.
+
+        Credentials are not returned, and flags have a value of True.
+
+        :param device: Path of the device, ie: '/dev/rbd0'.
+        :returns: Dictionary with the options or None if it cannot be read.
+        """
+        dev_id = device[len('/dev/rbd'):]
+        config_info = linuxblock.read_sysfs(RBD_SYSFS_PATH, dev_id,
+                                            'config_info')
+        # Format is: <mon addresses> <options> <pool> <image> <snapshot>
+        fields = config_info.split() if config_info else ()
+        if len(fields) < 4:
+            return None
+        options = {}
+        for option in fields[1].split(','):
+            key, sep, value = option.partition('=')
+            if key not in RBD_SECRET_OPTIONS:
+                options[key] = value if sep else True
+        return options
+
+    @staticmethod
+    def _get_kernel_version():
+        match = re.match(r'(\d+)\.(\d+)', os.uname().release)
+        return (int(match.group(1)), int(match.group(2))) if match else None
+
+    @staticmethod
+    def _parse_rbd_map_options(options):
+        if not options:
+            return {}
+        if isinstance(options, dict):
+            return dict(options)
+        result = {}
+        for option in str(options).split(','):
+            key, sep, value = option.strip().partition('=')
+            if key:
+                result[key] = value if sep else True
+        return result
+
+    @staticmethod
+    def _validate_rbd_map_option(key, value, kind):
+        if kind == FLAG:
+            if value in (True, False, 'true', 'false'):
+                return value in (True, 'true')
+        elif kind in (UINT, POSITIVE_INT, POWER_OF_2):
+            try:
+                if isinstance(value, bool):
+                    raise ValueError
+                number = int(value)
+            except (TypeError, ValueError):
+                pass
+            else:
+                if ((kind == UINT and number >= 0) or
+                        (kind == POSITIVE_INT and number > 0) or
+                        (kind == POWER_OF_2 and number >= 512 and
+                         not number & (number - 1))):
+                    return str(number)
+        elif kind == STRING:
+            if isinstance(value, str) and value and ',' not in value:
+                return value
+        elif value in kind:
+            return value
+        raise exception.InvalidParameterValue(
+            err=_('Invalid value %(value)s for rbd map option %(key)s') %
+            {'value': value, 'key': key})
+
+    def _get_rbd_map_options(self, connection_properties):
+        """Get the "rbd map -o" options for a local attach.
+
+        Options come from the connector's rbd_map_options parameter and from
+        the rbd_map_options connection property, which takes precedence.
+        Both can be a dictionary or a string like "queue_depth=256,notrim".
+        Options not supported by the running kernel are ignored.
+
+        :returns: List of options, ie: ['queue_depth=256', 'notrim'].
+        :raises InvalidParameterValue: If any of the options is not valid.
+        """
+        options = self._parse_rbd_map_options(self.rbd_map_options)
+        options.update(self._parse_rbd_map_options(
+            connection_properties.get('rbd_map_options')))
+        if not options:
+            return []
+
+        kernel = self._get_kernel_version()
+        result = []
+        for key, value in options.items():
+            if key not in RBD_MAP_OPTIONS:
+                raise exception.InvalidParameterValue(
+                    err=_('Unsupported rbd map option %s') % key)
+            min_kernel, kind = RBD_MAP_OPTIONS[key]
+            value = self._validate_rbd_map_option(key, value, kind)
+            if kernel and kernel < min_kernel:
+                LOG.warning('Ignoring rbd map option %(key)s, it requires '
+                            'kernel %(min)s', {'key': key,
+                                               'min': '%s.%s' % min_kernel})
+            elif kind == FLAG:
+                if value:
+                    result.append(key)
+            else:
+                result.append('%s=%s' % (key, value))
+        return result
+
+    def _check_rbd_cli(self):
         # NOTE(e0ne): sanity check if ceph-common is installed.
+        if RBDConnector._rbd_cli_available:
+            return
         try:
             self._execute('which', 'rbd')
         except putils.ProcessExecutionError:
             msg = _("ceph-common package is not installed.")
             LOG.error(msg)
             raise exception.BrickException(message=msg)
+        RBDConnector._rbd_cli_available = True
+
+    @staticmethod
+    def _get_udev_device(rbd_dev_path):
+        """Device the udev symlink points to or None if it doesn't exist."""
+        if os.path.islink(rbd_dev_path):
+            device = os.path.realpath(rbd_dev_path)
+            if os.path.exists(device):
+                return device
+        return None
+
+    def _get_mapped_device(self, pool, volume, rbd_dev_path):
+        mappings = self.get_rbd_mappings()
+        if mappings is None:
+            return self._get_udev_device(rbd_dev_path)
+        mapping = mappings.get((pool, '', volume, '-'))
+        return mapping.device if mapping else None
+
+    @staticmethod
+    def _log_rbd_map_options(volume, device):
+        try:
+            options = rbd_privsep.root_get_rbd_map_options(device)
+        except Exception as exc:
+            LOG.debug('Cannot read map options of %(dev)s: %(exc)s',
+                      {'dev': device, 'exc': exc})
+            return
+        LOG.info('Volume %(vol)s mapped to %(dev)s with options %(opts)s',
+                 {'vol': volume, 'dev': device, 'opts': options})
+
+    def _local_attach_volume(self, connection_properties):
+        self._check_rbd_cli()
 
         # NOTE(e0ne): map volume to a block device
         # via the rbd kernel module.
         pool, volume = connection_properties['name'].split('/')
         rbd_dev_path = self.get_rbd_device_name(pool, volume)
+        map_options = self._get_rbd_map_options(connection_properties)
         # If we are not running on OpenStack, create config file
         conf = self.create_non_openstack_config(connection_properties)
         try:
-            if (
-                not os.path.islink(rbd_dev_path) or
-                not os.path.exists(os.path.realpath(rbd_dev_path))
-            ):
+            device = self._get_mapped_device(pool, volume, rbd_dev_path)
+            if not device:
                 # TODO(stephenfin): Update to the unified 'rbd device map'
                 # command introduced in ceph 13.0 (commit 6a57358add1157629a6d)
                 # when we drop support earlier versions
                 cmd = ['rbd', 'map', volume, '--pool', pool]
+                if map_options:
+                    cmd += ['-o', ','.join(map_options)]
                 cmd += self._get_rbd_args(connection_properties, conf)
                 self._execute(*cmd, root_helper=self._root_helper,
                               run_as_root=True)
+                device = self._get_mapped_device(pool, volume, rbd_dev_path)
+                if device and map_options:
+                    self._log_rbd_map_options(volume, device)
             else:
                 LOG.debug(
                     'Volume %(vol)s is already mapped to local device %(dev)s',
-                    {'vol': volume, 'dev': os.path.realpath(rbd_dev_path)}
+                    {'vol': volume, 'dev': device}
                 )
 
-            if (
-                not os.path.islink(rbd_dev_path) or
-                not os.path.exists(os.path.realpath(rbd_dev_path))
-            ):
+            if not self._get_udev_device(rbd_dev_path):
                 LOG.warning(
                     'Volume %(vol)s has not been mapped to local device '
                     '%(dev)s; is the udev daemon running and are the '
@@ -214,11 +574,14 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
                     'more information.',
                     {'vol': volume, 'dev': rbd_dev_path},
                 )
+                # Use the kernel's device if we know it
+                if device:
+                    rbd_dev_path = device
         except Exception:
             # Cleanup conf file on failure
             with excutils.save_and_reraise_exception():
                 if conf:
-                    rbd_privsep.delete_if_exists(conf)
+                    rbd_privsep.root_release_ceph_conf(conf)
 
         res = {'path': rbd_dev_path,
                'type': 'block'}
@@ -248,15 +611,21 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
     def _find_root_device(self, connection_properties, conf):
         """Find the underlying /dev/rbd* device for a mapping.
 
-        Use the showmapped command to list all acive mappings and find the
-        underlying /dev/rbd* device that corresponds to our pool and volume.
+        Look for our pool and volume in the kernel's rbd mappings in sysfs,
+        or if they are not available use the showmapped command to list all
+        acive mappings and find the underlying /dev/rbd* device.
 
         :param connection_properties: The dictionary that describes all
                                       of the target volume attributes.
         :type connection_properties: dict
         :returns: '/dev/rbd*' or None if no active mapping is found.
         """
-        __, volume = connection_properties['name'].split('/')
+        pool, volume = connection_properties['name'].split('/')
+        mappings = self.get_rbd_mappings()
+        if mappings is not None:
+            mapping = mappings.get((pool, '', volume, '-'))
+            return mapping.device if mapping else None
+
         # TODO(stephenfin): Update to the unified 'rbd device list'
         # command introduced in ceph 13.0 (commit 6a57358add1157629a6d)
         # when we drop support earlier versions
@@ -331,12 +700,12 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
                 self._execute(*cmd, root_helper=self._root_helper,
                               run_as_root=True)
                 if conf:
-                    rbd_privsep.delete_if_exists(conf)
+                    rbd_privsep.root_release_ceph_conf(conf)
         else:
             if device_info:
                 rbd_handle = device_info.get('path', None)
                 if rbd_handle is not None:
-                    fileutils.delete_if_exists(rbd_handle.rbd_conf)
+                    self._release_ceph_conf(rbd_handle.rbd_conf)
                     rbd_handle.close()
 
     @staticmethod
@@ -386,7 +755,7 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
                 handle.seek(0, 2)
                 return handle.tell()
             finally:
-                fileutils.delete_if_exists(handle.rbd_conf)
+                self._release_ceph_conf(handle.rbd_conf)
                 handle.close()
 
         # Create config file when we do the attach on the host and not the VM
@@ -398,7 +767,7 @@ class RBDConnector(base_rbd.RBDConnectorMixin, base.BaseLinuxConnector):
             # If we have generated the config file we need to remove it
             if conf:
                 try:
-                    rbd_privsep.delete_if_exists(conf)
+                    rbd_privsep.root_release_ceph_conf(conf)
                 except Exception as exc:
                     LOG.warning(_('Could not remove config file %(filename)s: '
                                   '%(exc)s'), {'filename': conf, 'exc': exc})
@@ -0,0 +1,393 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Snapshot of the block devices topology of a Linux host.
+
+Connectors look for block devices in sysfs in many different ways: globbing
+/sys/class/block/*/wwid, following holders and slaves, reading sizes...  Often
+several times per operation.
+
+This module crawls /sys/block once and builds an immutable view of all the
+block devices we care about, including their relationships (holders and
+slaves) and identifiers, with indexes to look them up by any identifier.
+Snapshots that include NVMe namespaces also have the NVMe controllers from
+/sys/class/nvme, indexed by subsystem NQN and by namespace.
+
+A snapshot can be limited to some kinds of devices, and it can be refreshed
+cheaply, only devices that have been added or explicitly requested are read
+again.
+
+Code reading other sysfs attributes should use `read_sysfs` and
+`list_sysfs`.
+"""
+
+import collections
+import fnmatch
+import os
+import re
+import types
+from typing import Dict, Iterable, Optional, Tuple  # noqa: H301
+
+from oslo_log import log as logging
+
+from os_brick.initiator import linuxscsi
+
+LOG = logging.getLogger(__name__)
+
+SYSFS = '/sys'
+
+# sd*: SCSI, nvme*: NVMe namespaces, dm-*: Device mapper, md*: Software RAID,
+# rbd*: Ceph's krbd, sp-*: StorPool
+DEVICE_PATTERNS = ('sd*', 'nvme*', 'dm-*', 'md*', 'rbd*', 'sp-*')
+# Namespaces are nvme<ctrl>n<nsid> or, with native multipath, the head is
+# nvme<subsys>n<nsid> and each path is nvme<subsys>c<ctrl>n<nsid>
+NVME_NS_PATTERN = re.compile(r'^nvme(\d+)(c\d+)?n(\d+)$')
+
+
+def read_sysfs(*path: str) -> Optional[str]:
+    """Return stripped contents of a sysfs file or None if not readable."""
+    try:
+        with open(os.path.join(*path), 'rt') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def list_sysfs(*path: str) -> Tuple[str, ...]:
+    """Return the sorted entries of a sysfs directory, () if not readable."""
+    try:
+        return tuple(sorted(os.listdir(os.path.join(*path))))
+    except OSError:
+        return ()
+
+
+class BlockDevice(collections.namedtuple(
+        'BlockDevice',
+        ['name',        # Name in /sys/block, ie: 'sda'
+         'dev',         # Major and minor numbers, ie: '8:0'
+         'size',        # Size in bytes
+         'ro',          # Boolean, True if read only
+         'scheduler',   # Active IO scheduler, ie: 'mq-deadline'
+         'hctl',        # SCSI devices only, ie: ('6', '0', '2', '1')
+         'wwid',        # Contents of the wwid file, ie: 'naa.6000...'
+         'nguid',       # NVMe namespaces only
+         'uuid',        # NVMe namespace uuid or DM uuid, ie: 'mpath-3600...'
+         'dm_name',     # DMs only, name of the map, ie: 'mpatha'
+         'holders',     # Tuple of names of the devices holding this device
+         'slaves',      # Tuple of names of the devices held by this device
+         ])):
+    __slots__ = ()
+
+    @property
+    def path(self):
+        return '/dev/' + self.name
+
+    @property
+    def scsi_wwn(self):
+        """WWN in udev format as returned by scsi_id's page 0x83."""
+        if not (self.wwid and self.name.startswith('sd')):
+            return None
+        wwn_types = linuxscsi.LinuxSCSI.WWN_TYPES
+        return wwn_types.get(self.wwid[:4], '8') + self.wwid[4:]
+
+
+class NVMeController(collections.namedtuple(
+        'NVMeController',
+        ['name',        # Name in /sys/class/nvme, ie: 'nvme0'
+         'nqn',         # Subsystem NQN
+         'address',     # ie: 'traddr=10.0.0.1,trsvcid=4420'
+         'state',       # ie: 'live', 'connecting'
+         'namespaces',  # Tuple of names of the namespace block devices
+         ])):
+    __slots__ = ()
+
+
+class BlockDeviceTopology(object):
+    """Immutable snapshot of the block devices present in the system.
+
+    Use the `snapshot` class method to create an instance and `refresh` to get
+    an updated copy.  Devices are `BlockDevice` named tuples and NVMe
+    controllers are `NVMeController` named tuples.
+    """
+
+    def __init__(self, devices: Dict[str, BlockDevice],
+                 sysfs: str = SYSFS,
+                 patterns: Iterable[str] = DEVICE_PATTERNS,
+                 controllers: Optional[Dict[str, NVMeController]] = None
+                 ) -> None:
+        self._sysfs = sysfs
+        self._patterns = tuple(patterns)
+        self._devices = types.MappingProxyType(dict(devices))
+        self._controllers = types.MappingProxyType(dict(controllers or {}))
+        by_nqn: Dict[str, list] = {}
+        by_namespace: Dict[str, list] = {}
+        for ctrl in self._controllers.values():
+            by_nqn.setdefault(ctrl.nqn, []).append(ctrl)
+            for ns in ctrl.namespaces:
+                by_namespace.setdefault(ns, []).append(ctrl)
+        self._ctrls_by_nqn = self._freeze(by_nqn)
+        self._ctrls_by_namespace = self._freeze(by_namespace)
+        by_wwid: Dict[str, list] = {}
+        by_scsi_wwn: Dict[str, list] = {}
+        by_nguid: Dict[str, list] = {}
+        by_uuid: Dict[str, list] = {}
+        by_hctl = {}
+        by_dm_name = {}
+        for device in self._devices.values():
+            if device.wwid:
+                by_wwid.setdefault(device.wwid, []).append(device)
+            if device.scsi_wwn:
+                by_scsi_wwn.setdefault(device.scsi_wwn, []).append(device)
+            if device.nguid:
+                by_nguid.setdefault(device.nguid, []).append(device)
+            if device.uuid:
+                by_uuid.setdefault(device.uuid, []).append(device)
+            if device.hctl:
+                by_hctl[device.hctl] = device
+            if device.dm_name:
+                by_dm_name[device.dm_name] = device
+        self._by_wwid = self._freeze(by_wwid)
+        self._by_scsi_wwn = self._freeze(by_scsi_wwn)
+        self._by_nguid = self._freeze(by_nguid)
+        self._by_uuid = self._freeze(by_uuid)
+        self._by_hctl = types.MappingProxyType(by_hctl)
+        self._by_dm_name = types.MappingProxyType(by_dm_name)
+
+    @staticmethod
+    def _freeze(index):
+        return types.MappingProxyType(
+            {key: tuple(sorted(value, key=lambda d: d.name))
+             for key, value in index.items()})
+
+    @classmethod
+    def snapshot(
+            cls, sysfs: str = SYSFS,
+            patterns: Iterable[str] = DEVICE_PATTERNS
+    ) -> 'BlockDeviceTopology':
+        """Crawl sysfs and return the current topology.
+
+        :param patterns: Shell patterns of the device names to read, ie:
+                         ('nvme*',).  Defaults to all the devices we know.
+        """
+        patterns = tuple(patterns)
+        names = cls._list_devices(sysfs, patterns)
+        devices = {name: cls._read_device(sysfs, name) for name in names}
+        return cls(cls._filter(devices), sysfs, patterns,
+                   cls._read_controllers(sysfs, patterns))
+
+    def refresh(
+            self,
+            names: Optional[Iterable[str]] = None) -> 'BlockDeviceTopology':
+        """Return a new snapshot reusing the information of this one.
+
+        Only new devices, devices with a different major:minor, and devices in
+        `names` have all their information read again from sysfs.  Holders and
+        slaves are always read again, since they are cheap to get and they are
+        what changes on the devices we already knew about, and so are the NVMe
+        controllers.
+
+        :param names: Iterable of device names to forcefully read again, for
+                      example those that have been extended.
+        """
+        reread = set(names or ())
+        devices = {}
+        for name in self._list_devices(self._sysfs, self._patterns):
+            old = self._devices.get(name)
+            if (old is None or name in reread or
+                    old.dev != self._read(self._sysfs, name, 'dev')):
+                device = self._read_device(self._sysfs, name)
+            else:
+                holders, slaves = self._read_relations(self._sysfs, name)
+                device = old._replace(holders=holders, slaves=slaves)
+            devices[name] = device
+        return type(self)(self._filter(devices), self._sysfs, self._patterns,
+                          self._read_controllers(self._sysfs, self._patterns))
+
+    @staticmethod
+    def _list_devices(sysfs, patterns):
+        try:
+            names = os.listdir(os.path.join(sysfs, 'block'))
+        except OSError as exc:
+            LOG.warning('Cannot list block devices: %s', exc)
+            return []
+        return [name for name in names
+                if any(fnmatch.fnmatch(name, p) for p in patterns)]
+
+    @staticmethod
+    def _filter(devices):
+        """Remove devices that disappeared while we were reading them."""
+        return {name: dev for name, dev in devices.items() if dev is not None}
+
+    @staticmethod
+    def _read(sysfs, name, *path):
+        return read_sysfs(sysfs, 'block', name, *path)
+
+    @staticmethod
+    def _listdir(sysfs, name, subdir):
+        return list_sysfs(sysfs, 'block', name, subdir)
+
+    @staticmethod
+    def _read_controllers(sysfs, patterns):
+        """Read the NVMe controllers if we are looking at NVMe namespaces."""
+        if not any(fnmatch.fnmatch('nvme0n1', p) for p in patterns):
+            return {}
+        controllers = {}
+        for name in list_sysfs(sysfs, 'class', 'nvme'):
+            path = os.path.join(sysfs, 'class', 'nvme', name)
+            nqn = read_sysfs(path, 'subsysnqn')
+            # Controller is gone or it's not an NVMe controller
+            if nqn is None:
+                continue
+            namespaces = set()
+            for entry in list_sysfs(path):
+                match = NVME_NS_PATTERN.match(entry)
+                if match:
+                    namespaces.add('nvme%sn%s' % (match.group(1),
+                                                  match.group(3)))
+            controllers[name] = NVMeController(
+                name=name,
+                nqn=nqn,
+                address=read_sysfs(path, 'address') or None,
+                state=read_sysfs(path, 'state'),
+                namespaces=tuple(sorted(namespaces)))
+        return controllers
+
+    @classmethod
+    def _read_relations(cls, sysfs, name):
+        return (cls._listdir(sysfs, name, 'holders'),
+                cls._listdir(sysfs, name, 'slaves'))
+
+    @classmethod
+    def _read_device(cls, sysfs, name) -> Optional[BlockDevice]:
+        dev = cls._read(sysfs, name, 'dev')
+        # Device is gone
+        if dev is None:
+            return None
+
+        size = cls._read(sysfs, name, 'size')
+        ro = cls._read(sysfs, name, 'ro')
+        scheduler = cls._read(sysfs, name, 'queue', 'scheduler')
+        if scheduler and '[' in scheduler:
+            scheduler = scheduler[scheduler.index('[') + 1:
+                                  scheduler.index(']')]
+
+        hctl = wwid = nguid = uuid = dm_name = None
+        if name.startswith('sd'):
+            try:
+                link = os.readlink(os.path.join(sysfs, 'block', name,
+                                                'device'))
+                address = tuple(os.path.basename(link).split(':'))
+                if len(address) == 4:
+                    hctl = address
+            except OSError:
+                pass
+            wwid = cls._read(sysfs, name, 'device', 'wwid')
+        elif name.startswith('nvme'):
+            wwid = cls._read(sysfs, name, 'wwid')
+            nguid = cls._read(sysfs, name, 'nguid')
+            uuid = cls._read(sysfs, name, 'uuid')
+        elif name.startswith('dm-'):
+            uuid = cls._read(sysfs, name, 'dm', 'uuid')
+            dm_name = cls._read(sysfs, name, 'dm', 'name')
+
+        holders, slaves = cls._read_relations(sysfs, name)
+        return BlockDevice(name=name,
+                           dev=dev,
+                           size=int(size) * 512 if size else None,
+                           ro=ro == '1',
+                           scheduler=scheduler,
+                           hctl=hctl,
+                           wwid=wwid or None,
+                           nguid=nguid or None,
+                           uuid=uuid or None,
+                           dm_name=dm_name or None,
+                           holders=holders,
+                           slaves=slaves)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __iter__(self):
+        return iter(self._devices.values())
+
+    def __contains__(self, name):
+        return name in self._devices
+
+    @property
+    def devices(self) -> types.MappingProxyType:
+        """Read only mapping of device names to BlockDevice."""
+        return self._devices
+
+    def get(self, name: str) -> Optional[BlockDevice]:
+        """Get a device by name ('sda') or path ('/dev/sda')."""
+        return self._devices.get(os.path.basename(name))
+
+    def get_by_wwid(self, wwid: str) -> Tuple[BlockDevice, ...]:
+        """Get devices by their sysfs wwid ('naa.6000...', 'uuid.a1b2...')."""
+        return self._by_wwid.get(wwid, ())
+
+    def get_by_scsi_wwn(self, wwn: str) -> Tuple[BlockDevice, ...]:
+        """Get SCSI devices by their WWN in udev format ('36000...')."""
+        return self._by_scsi_wwn.get(wwn, ())
+
+    def get_by_nguid(self, nguid: str) -> Tuple[BlockDevice, ...]:
+        """Get NVMe namespaces by their NGUID."""
+        return self._by_nguid.get(nguid, ())
+
+    def get_by_uuid(self, uuid: str) -> Tuple[BlockDevice, ...]:
+        """Get NVMe namespaces or DMs by their uuid."""
+        return self._by_uuid.get(uuid, ())
+
+    def get_by_hctl(self, host, channel, target,
+                    lun) -> Optional[BlockDevice]:
+        """Get a SCSI device by its host, channel, target and LUN."""
+        return self._by_hctl.get((str(host), str(channel), str(target),
+                                  str(lun)))
+
+    def get_by_dm_name(self, dm_name: str) -> Optional[BlockDevice]:
+        """Get a DM by its map name ('mpatha')."""
+        return self._by_dm_name.get(dm_name)
+
+    def get_multipath(self, wwn: str) -> Optional[BlockDevice]:
+        """Get the multipath DM for a WWN."""
+        devices = self.get_by_uuid('mpath-' + wwn)
+        return devices[0] if devices else None
+
+    def get_holders(self, name: str) -> Tuple[BlockDevice, ...]:
+        """Get the devices that hold a device, ie: its multipath or RAID."""
+        device = self.get(name)
+        if not device:
+            return ()
+        return tuple(self._devices[n] for n in device.holders
+                     if n in self._devices)
+
+    @property
+    def nvme_controllers(self) -> types.MappingProxyType:
+        """Read only mapping of controller names to NVMeController."""
+        return self._controllers
+
+    def get_nvme_controllers(self, nqn: str) -> Tuple[NVMeController, ...]:
+        """Get the NVMe controllers of a subsystem NQN."""
+        return self._ctrls_by_nqn.get(nqn, ())
+
+    def get_namespace_controllers(
+            self, name: str) -> Tuple[NVMeController, ...]:
+        """Get the controllers of an NVMe namespace ('nvme0n1')."""
+        return self._ctrls_by_namespace.get(os.path.basename(name), ())
+
+    def get_slaves(self, name: str) -> Tuple[BlockDevice, ...]:
+        """Get the devices that a device holds, ie: paths of a multipath."""
+        device = self.get(name)
+        if not device:
+            return ()
+        return tuple(self._devices[n] for n in device.slaves
+                     if n in self._devices)
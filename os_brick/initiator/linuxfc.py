@@ -14,27 +14,98 @@
 
 """Generic linux Fibre Channel utilities."""
 
-import errno
 import os
+import threading
+import time
 
 from oslo_concurrency import processutils as putils
 from oslo_log import log as logging
 
+from os_brick import executor
+from os_brick.initiator import linuxblock
 from os_brick.initiator import linuxscsi
+from os_brick.privileged import rootwrap as priv_rootwrap
 
 LOG = logging.getLogger(__name__)
 
+FC_HOST_SYSFS_PATH = '/sys/class/fc_host'
+FC_TRANSPORT_SYSFS_PATH = '/sys/class/fc_transport'
+FC_REMOTE_PORTS_SYSFS_PATH = '/sys/class/fc_remote_ports'
+# Entries in the fc_host directories that are not HBA attributes
+FC_HOST_SKIP = ('device', 'power', 'statistics', 'subsystem', 'uevent')
+# Attributes that can change while the HBA is present
+FC_HOST_VOLATILE = ('port_name', 'port_state')
+
 
 class LinuxFibreChannel(linuxscsi.LinuxSCSI):
+    # HBAs information cache shared by all instances, keyed by host name
+    _hbas_cache: dict = {}
+    _hbas_cache_lock = threading.Lock()
 
     def has_fc_support(self):
-        FC_HOST_SYSFS_PATH = '/sys/class/fc_host'
         if os.path.isdir(FC_HOST_SYSFS_PATH):
             return True
         else:
             return False
 
-    def _get_hba_channel_scsi_target_lun(self, hba, conn_props):
+    @staticmethod
+    def _normalize_wwpn(wwpn):
+        wwpn = wwpn.strip().lower()
+        return wwpn[2:] if wwpn.startswith('0x') else wwpn
+
+    @classmethod
+    def get_fc_targets_index(cls):
+        """Map FC target port WWPNs to their SCSI host, channel and target.
+
+        Built in a single pass over /sys/class/fc_transport, which has the
+        targets bound to a SCSI target, and /sys/class/fc_remote_ports, which
+        has the remote ports and their SCSI target ids, so it can be reused
+        for all the HBAs and targets of an operation.
+
+        :returns: Dictionary with lower case WWPNs without the 0x prefix as
+                  keys and sorted lists of (host, channel, target) tuples of
+                  strings as values.
+        """
+        index: dict = {}
+
+        def add(wwpn, host, channel, target):
+            if wwpn:
+                entries = index.setdefault(cls._normalize_wwpn(wwpn), set())
+                entries.add((host, channel, target))
+
+        for path, prefix in ((FC_TRANSPORT_SYSFS_PATH, 'target'),
+                             (FC_REMOTE_PORTS_SYSFS_PATH, 'rport-')):
+            try:
+                names = os.listdir(path)
+            except OSError as exc:
+                LOG.debug('Cannot list %(path)s: %(exc)s',
+                          {'path': path, 'exc': exc})
+                continue
+
+            for name in names:
+                if not name.startswith(prefix):
+                    continue
+                port_name = linuxblock.read_sysfs(path, name, 'port_name')
+                # fc_transport entries are named target<host>:<channel>:<id>
+                if prefix == 'target':
+                    address = name[len(prefix):].split(':')
+                    if len(address) == 3:
+                        add(port_name, *address)
+                    continue
+
+                # fc_remote_ports entries are named rport-<host>:<channel>-<n>
+                # and have a scsi_target_id of -1 if they are not targets
+                target_id = linuxblock.read_sysfs(path, name, 'scsi_target_id')
+                host_channel = name[len(prefix):].split('-')[0].split(':')
+                if (target_id and target_id != '-1' and
+                        len(host_channel) == 2):
+                    add(port_name, host_channel[0], host_channel[1],
+                        target_id)
+
+        return {wwpn: sorted(entries) for wwpn, entries in index.items()}
+
+    def _get_hba_channel_scsi_target_lun(self, hba, conn_props,
+                                         targets_index=None):
         """Get HBA channels, SCSI targets, LUNs to FC targets for given HBA.
 
         Given an HBA and the connection properties we look for the HBA channels
@@ -49,6 +120,8 @@ class LinuxFibreChannel(linuxscsi.LinuxSCSI):
         based on the contents of the connection information data to know which
         target ports to look for.
 
+        :param targets_index: Result of `get_fc_targets_index`, it will be
+                              built if not provided.
         :returns: 2-Tuple with the first entry being a list of [c, t, l]
         entries where the target port was found, and the second entry of the
         tuple being a set of luns for ports that were not found.
@@ -61,26 +134,26 @@ class LinuxFibreChannel(linuxscsi.LinuxSCSI):
             targets = conn_props['initiator_target_lun_map'].get(
                 hba['port_name'], targets)
 
+        if targets_index is None:
+            targets_index = self.get_fc_targets_index()
+
         # Leave only the number from the host_device field (ie: host6)
         host_device = hba['host_device']
         if host_device and len(host_device) > 4:
             host_device = host_device[4:]
 
-        path = '/sys/class/fc_transport/target%s:' % host_device
         ctls = []
         luns_not_found = set()
         for wwpn, lun in targets:
-            cmd = 'grep -Gil "%(wwpns)s" %(path)s*/port_name' % {'wwpns': wwpn,
-                                                                 'path': path}
-            try:
-                # We need to run command in shell to expand the * glob
-                out, _err = self._execute(cmd, shell=True)
-                ctls += [line.split('/')[4].split(':')[1:] + [lun]
-                         for line in out.split('\n') if line.startswith(path)]
-            except Exception as exc:
-                LOG.debug('Could not get HBA channel and SCSI target ID, path:'
-                          ' %(path)s*, reason: %(reason)s', {'path': path,
-                                                             'reason': exc})
+            found = [[channel, target, lun] for host, channel, target
+                     in targets_index.get(self._normalize_wwpn(wwpn), ())
+                     if host == host_device]
+            if found:
+                ctls += found
+            else:
+                LOG.debug('Could not get HBA channel and SCSI target ID for '
+                          'target port %(wwpn)s on host%(host)s',
+                          {'wwpn': wwpn, 'host': host_device})
                 # If we didn't find any paths add it to the not found list
                 luns_not_found.add(lun)
         return ctls, luns_not_found
@@ -114,8 +187,10 @@ class LinuxFibreChannel(linuxscsi.LinuxSCSI):
         process = []
         skipped = []
         get_ctls = self._get_hba_channel_scsi_target_lun
+        targets_index = self.get_fc_targets_index()
         for hba in hbas:
-            ctls, luns_wildcards = get_ctls(hba, connection_properties)
+            ctls, luns_wildcards = get_ctls(hba, connection_properties,
+                                            targets_index)
             # If we found the target ports, ignore HBAs that din't find them
             if ctls:
                 process.append((hba, ctls))
@@ -135,80 +210,140 @@ class LinuxFibreChannel(linuxscsi.LinuxSCSI):
         # If we didn't find any target ports use wildcards if they are enabled
         process = process or skipped
 
-        for hba, ctls in process:
-            for hba_channel, target_id, target_lun in ctls:
-                LOG.debug('Scanning %(host)s (wwnn: %(wwnn)s, c: '
-                          '%(channel)s, t: %(target)s, l: %(lun)s)',
-                          {'host': hba['host_device'],
-                           'wwnn': hba['node_name'], 'channel': hba_channel,
-                           'target': target_id, 'lun': target_lun})
-                self.echo_scsi_command(
-                    "/sys/class/scsi_host/%s/scan" % hba['host_device'],
-                    "%(c)s %(t)s %(l)s" % {'c': hba_channel,
-                                           't': target_id,
-                                           'l': target_lun})
-
-    def get_fc_hbas(self):
-        """Get the Fibre Channel HBA information."""
+        # Scans on different HBAs are independent, and writing to a host's
+        # scan file blocks until the scan completes, so we scan all the HBAs
+        # at the same time.  The SCSI midlayer serializes scans on the same
+        # host, so each HBA's targets are scanned sequentially in its thread.
+        errors: dict = {}
+        if len(process) == 1:
+            self._scan_hba(*process[0], errors)
+        else:
+            threads = [executor.Thread(target=self._scan_hba,
+                                       args=(hba, ctls, errors))
+                       for hba, ctls in process]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise next(iter(errors.values()))
+
+    def _scan_hba(self, hba, ctls, errors):
+        """Scan the channel, target, LUN combinations of an HBA.
+
+        Errors are stored in the `errors` dictionary, using the host device as
+        key, instead of being raised so all the combinations are scanned.
+        """
+        host = hba['host_device']
+        path = '/sys/class/scsi_host/%s/scan' % host
+        start = time.monotonic()
+        for hba_channel, target_id, target_lun in ctls:
+            LOG.debug('Scanning %(host)s (wwnn: %(wwnn)s, c: '
+                      '%(channel)s, t: %(target)s, l: %(lun)s)',
+                      {'host': host,
+                       'wwnn': hba['node_name'], 'channel': hba_channel,
+                       'target': target_id, 'lun': target_lun})
+            try:
+                priv_rootwrap.write_sys(path, "%(c)s %(t)s %(l)s" %
+                                        {'c': hba_channel,
+                                         't': target_id,
+                                         'l': target_lun})
+            except Exception as exc:
+                LOG.warning('Failed to scan %(host)s: %(exc)s',
+                            {'host': host, 'exc': exc})
+                errors.setdefault(host, exc)
+        LOG.debug('Scanned %(host)s, %(num)d scans in %(time).3fs',
+                  {'host': host, 'num': len(ctls),
+                   'time': time.monotonic() - start})
+
+    @classmethod
+    def _read_fc_host_attr(cls, host, attr):
+        """Return the stripped contents of an fc_host attribute or None."""
+        # Store only attributes like issue_lip cannot be read
+        return linuxblock.read_sysfs(FC_HOST_SYSFS_PATH, host, attr)
+
+    @classmethod
+    def _read_fc_host(cls, host):
+        """Read all the attributes of an HBA in the systool format."""
+        path = os.path.join(FC_HOST_SYSFS_PATH, host)
+        try:
+            attrs = os.listdir(path)
+        except OSError:
+            # HBA was removed while we were reading it
+            return None
+
+        hba = {'ClassDevice': host,
+               'ClassDevicepath': os.path.realpath(path)}
+        for attr in attrs:
+            if attr in FC_HOST_SKIP:
+                continue
+            value = cls._read_fc_host_attr(host, attr)
+            if value is not None:
+                hba[attr] = value
+        return hba
+
+    @staticmethod
+    def _host_number(host):
+        try:
+            return int(host[4:])
+        except ValueError:
+            return -1
+
+    def get_fc_hbas(self, refresh=False):
+        """Get the Fibre Channel HBA information.
 
+        Information is read from /sys/class/fc_host and cached.  The cache is
+        invalidated when an HBA is added or removed or if `refresh` is True,
+        otherwise only the port name and state are read again.
+
+        :param refresh: Read all the HBA information again from sysfs.
+        :returns: List of dictionaries with the same keys returned by systool
+                  (ClassDevice, ClassDevicepath, port_name, node_name,
+                  port_state...), sorted by host number.
+        """
         if not self.has_fc_support():
             # there is no FC support in the kernel loaded
-            # so there is no need to even try to run systool
+            # so there is no need to even try to read the HBAs
             LOG.debug("No Fibre Channel support detected on system.")
             return []
 
-        out = None
         try:
-            out, _err = self._execute('systool', '-c', 'fc_host', '-v',
-                                      run_as_root=True,
-                                      root_helper=self._root_helper)
-        except putils.ProcessExecutionError as exc:
-            # This handles the case where rootwrap is used
-            # and systool is not installed
-            # 96 = nova.cmd.rootwrap.RC_NOEXECFOUND:
-            if exc.exit_code == 96:
-                LOG.warning("systool is not installed")
-            return []
+            hosts = sorted(os.listdir(FC_HOST_SYSFS_PATH),
+                           key=self._host_number)
         except OSError as exc:
-            # This handles the case where rootwrap is NOT used
-            # and systool is not installed
-            if exc.errno == errno.ENOENT:
-                LOG.warning("systool is not installed")
+            LOG.warning('Cannot list FC HBAs: %s', exc)
             return []
 
-        # No FC HBAs were found
-        if out is None:
-            return []
-
-        lines = out.split('\n')
-        # ignore the first 2 lines
-        lines = lines[2:]
-        hbas = []
-        hba = {}
-        lastline = None
-        for line in lines:
-            line = line.strip()
-            # 2 newlines denotes a new hba port
-            if line == '' and lastline == '':
-                if len(hba) > 0:
-                    hbas.append(hba)
-                    hba = {}
-            else:
-                val = line.split('=')
-                if len(val) == 2:
-                    key = val[0].strip().replace(" ", "")
-                    value = val[1].strip()
-                    hba[key] = value.replace('"', '')
-            lastline = line
-
-        return hbas
-
-    def get_fc_hbas_info(self):
+        with self._hbas_cache_lock:
+            cache = self._hbas_cache
+            if refresh or set(hosts) != set(cache):
+                LOG.debug('Reading FC HBAs %s from sysfs', hosts)
+                cache.clear()
+
+            for host in hosts:
+                hba = cache.get(host)
+                if hba is not None:
+                    current = {attr: self._read_fc_host_attr(host, attr)
+                               for attr in FC_HOST_VOLATILE}
+                    # Same host name but a different HBA
+                    if current['port_name'] != hba.get('port_name'):
+                        hba = None
+                    else:
+                        hba.update(current)
+                if hba is None:
+                    hba = self._read_fc_host(host)
+                    if hba is None:
+                        cache.pop(host, None)
+                        continue
+                    cache[host] = hba
+
+            return [dict(cache[host]) for host in hosts if host in cache]
+
+    def get_fc_hbas_info(self, refresh=False):
         """Get Fibre Channel WWNs and device paths from the system, if any."""
 
-        # Note(walter-boring) modern Linux kernels contain the FC HBA's in /sys
-        # and are obtainable via the systool app
-        hbas = self.get_fc_hbas()
+        hbas = self.get_fc_hbas(refresh=refresh)
 
         hbas_info = []
         for hba in hbas:
@@ -225,8 +360,6 @@ class LinuxFibreChannel(linuxscsi.LinuxSCSI):
     def get_fc_wwpns(self):
         """Get Fibre Channel WWPNs from the system, if any."""
 
-        # Note(walter-boring) modern Linux kernels contain the FC HBA's in /sys
-        # and are obtainable via the systool app
         hbas = self.get_fc_hbas()
 
         wwpns = []
@@ -240,8 +373,6 @@ class LinuxFibreChannel(linuxscsi.LinuxSCSI):
     def get_fc_wwnns(self):
         """Get Fibre Channel WWNNs from the system, if any."""
 
-        # Note(walter-boring) modern Linux kernels contain the FC HBA's in /sys
-        # and are obtainable via the systool app
         hbas = self.get_fc_hbas()
 
         wwnns = []
@@ -254,10 +385,10 @@ class LinuxFibreChannel(linuxscsi.LinuxSCSI):
 
 
 class LinuxFibreChannelS390X(LinuxFibreChannel):
-    def get_fc_hbas_info(self):
+    def get_fc_hbas_info(self, refresh=False):
         """Get Fibre Channel WWNs and device paths from the system, if any."""
 
-        hbas = self.get_fc_hbas()
+        hbas = self.get_fc_hbas(refresh=refresh)
 
         hbas_info = []
         for hba in hbas:
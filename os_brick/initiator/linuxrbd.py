@@ -12,11 +12,19 @@
 
 """Generic RBD connection utilities."""
 
+import collections
+import errno
+import hashlib
 import io
+import os
+import threading
+import time
+from typing import Dict, List, Optional  # noqa: H301
 
 from oslo_log import log as logging
 
 from os_brick import exception
+from os_brick import executor
 from os_brick.i18n import _
 from os_brick import utils
 
@@ -30,8 +38,187 @@ except ImportError:
 
 LOG = logging.getLogger(__name__)
 
+# Default number of asynchronous requests in flight when streaming
+AIO_DEPTH_DEFAULT = 8
+
+# Size of the ranges requested to librbd when looking for allocated extents
+EXTENT_SCAN_SIZE = 1024 ** 3
+
+# Seconds an unused pooled rados connection is kept open
+RADOS_POOL_IDLE_TIMEOUT = 60
+
+# Size of the blocks hashed by get_block_hashes, the leaves of the hash tree
+CHECKSUM_BLOCK_SIZE = 4 * 1024 ** 2
+CHECKSUM_THREADS_DEFAULT = 8
+
+# Not defined on all platforms
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+
+class RadosConnection(object):
+    """A pooled rados client and ioctx shared by several RBDClients."""
+
+    def __init__(self, key, client, ioctx):
+        self.key = key
+        self.client = client
+        self.ioctx = ioctx
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.pid = os.getpid()
+
+    @property
+    def healthy(self):
+        return (self.client.state == 'connected' and
+                self.ioctx.state == 'open')
+
+    def shutdown(self):
+        # closing an ioctx cannot raise an exception
+        self.ioctx.close()
+        self.client.shutdown()
+
+
+class RadosPool(object):
+    """Process wide pool of connected rados clients and their ioctxs.
+
+    Connecting to a cluster requires a handshake with the monitors and
+    authentication, which often take longer than the short operations we do
+    with the connection, so connections are shared, keyed by the config
+    file, cluster, user and pool, and kept open for `idle_timeout` seconds
+    after their last user releases them.
+
+    Connections that are no longer connected are replaced on acquire, and a
+    forked child process starts with an empty pool, since librados
+    connections cannot be used after a fork.  Connections acquired before
+    the fork are left alone when released in the child.
+
+    Use the `get` class method to get the shared instance.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, idle_timeout=RADOS_POOL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._connections: Dict[tuple, RadosConnection] = {}
+        self._timer: Optional[threading.Timer] = None
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def _after_fork(cls):
+        cls._instance_lock = threading.Lock()
+        if cls._instance is not None:
+            cls._instance._reset()
+
+    def acquire(self, key, connect):
+        """Get a connection, creating it with `connect` if necessary.
+
+        :param key: Tuple of (conffile, cluster, user, pool).
+        :param connect: Callable returning a connected (client, ioctx).
+        :returns: RadosConnection that must be given back with `release`.
+        """
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn and not conn.healthy:
+                LOG.debug('Replacing broken rados connection %s', key)
+                del self._connections[key]
+                if not conn.refs:
+                    conn.shutdown()
+                conn = None
+            if conn:
+                conn.refs += 1
+                return conn
+
+        # Don't block other users of the pool while we connect
+        conn = RadosConnection(key, *connect())
+        with self._lock:
+            current = self._connections.get(key)
+            if current is None:
+                self._connections[key] = current = conn
+            current.refs += 1
+        # Someone else connected at the same time
+        if current is not conn:
+            conn.shutdown()
+        return current
+
+    def release(self, conn: RadosConnection) -> None:
+        """Give back a connection obtained with `acquire`."""
+        with self._lock:
+            conn.refs -= 1
+            conn.last_used = time.monotonic()
+            if self._connections.get(conn.key) is not conn:
+                # Replaced after it broke or acquired before a fork, only
+                # shut it down in the former case
+                if not conn.refs and conn.pid == os.getpid():
+                    conn.shutdown()
+                return
+            if conn.refs:
+                return
+            if self.idle_timeout <= 0:
+                del self._connections[conn.key]
+                conn.shutdown()
+            elif self._timer is None:
+                self._schedule_eviction(self.idle_timeout)
+
+    def _schedule_eviction(self, delay):
+        self._timer = threading.Timer(delay, self.evict_idle)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def evict_idle(self, max_idle=None):
+        """Close the connections unused for `max_idle` seconds.
+
+        :param max_idle: Defaults to the pool's idle_timeout, 0 to close all
+                         the connections that are not in use.
+        """
+        if max_idle is None:
+            max_idle = self.idle_timeout
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            self._timer = None
+            next_check = None
+            for key, conn in list(self._connections.items()):
+                if conn.refs:
+                    continue
+                idle = now - conn.last_used
+                if idle >= max_idle:
+                    evicted.append(self._connections.pop(key))
+                else:
+                    remaining = self.idle_timeout - idle
+                    if next_check is None or remaining < next_check:
+                        next_check = remaining
+            if next_check is not None:
+                self._schedule_eviction(next_check)
+
+        for conn in evicted:
+            LOG.debug('Closing idle rados connection %s', conn.key)
+            conn.shutdown()
+
+    def __len__(self):
+        return len(self._connections)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=RadosPool._after_fork)
+
 
 class RBDClient(object):
+    """Connection to a pool of a Ceph cluster.
+
+    By default connections come from the process wide `RadosPool`, pass
+    `use_pool=False` to get a dedicated connection.
+    """
 
     def __init__(self, user, pool, *args, **kwargs):
 
@@ -57,6 +244,8 @@ class RBDClient(object):
         self.rbd_conf = kwargs.get('conffile', '/etc/ceph/ceph.conf')
         self.rbd_cluster_name = kwargs.get('rbd_cluster_name', 'ceph')
         self.rados_connect_timeout = kwargs.get('rados_connect_timeout', -1)
+        self.use_pool = kwargs.get('use_pool', True)
+        self._connection = None
 
         self.client, self.ioctx = self.connect()
 
@@ -67,6 +256,14 @@ class RBDClient(object):
         self.disconnect()
 
     def connect(self):
+        if not self.use_pool:
+            return self._connect()
+        key = (self.rbd_conf, self.rbd_cluster_name, self.rbd_user,
+               self.rbd_pool)
+        self._connection = RadosPool.get().acquire(key, self._connect)
+        return self._connection.client, self._connection.ioctx
+
+    def _connect(self):
         LOG.debug("opening connection to ceph cluster (timeout=%s).",
                   self.rados_connect_timeout)
         client = self.rados.Rados(rados_id=self.rbd_user,
@@ -89,11 +286,295 @@ class RBDClient(object):
             raise exception.BrickException(message=msg)
 
     def disconnect(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            RadosPool.get().release(connection)
+            return
+        if self.use_pool:
+            # Already given back to the pool
+            return
         # closing an ioctx cannot raise an exception
         self.ioctx.close()
         self.client.shutdown()
 
 
+def iter_extents(image, offset=0, length=None, from_snapshot=None,
+                 whole_object=False):
+    """Iterate over the allocated extents of an RBD image or snapshot.
+
+    Uses librbd's diff_iterate, which is fast when the image has the
+    fast-diff feature, to find the ranges that contain data so callers can
+    skip the unallocated regions of thin provisioned images instead of
+    reading zeros.  Adjacent extents are merged.
+
+    :param image: rbd.Image, opened at the snapshot to inspect if any.
+    :param from_snapshot: Only return extents changed since this snapshot.
+    :param whole_object: Report whole objects, faster but less precise.
+    :returns: Generator of (offset, length) tuples in ascending order.
+    """
+    end = image.size()
+    if length is not None:
+        end = min(end, offset + length)
+
+    found = []
+
+    def _add_extent(ext_offset, ext_length, exists):
+        if exists:
+            found.append((ext_offset, ext_length))
+
+    current = None
+    while offset < end:
+        scan_end = min(offset + EXTENT_SCAN_SIZE, end)
+        image.diff_iterate(offset, scan_end - offset, from_snapshot,
+                           _add_extent, whole_object=whole_object)
+        for ext_offset, ext_length in found:
+            # Whole object extents can go beyond the requested range
+            start = max(ext_offset, offset)
+            stop = min(ext_offset + ext_length, scan_end)
+            if stop <= start:
+                continue
+            if current and current[1] >= start:
+                current[1] = max(current[1], stop)
+                continue
+            if current:
+                yield current[0], current[1] - current[0]
+            current = [start, stop]
+        del found[:]
+        offset = scan_end
+
+    if current:
+        yield current[0], current[1] - current[0]
+
+
+def _hash(algorithm, prefix, *data):
+    hasher = hashlib.new(algorithm, prefix)
+    for chunk in data:
+        hasher.update(chunk)
+    return hasher.digest()
+
+
+def get_block_hashes(image, block_size=CHECKSUM_BLOCK_SIZE,
+                     threads=CHECKSUM_THREADS_DEFAULT, algorithm='sha256'):
+    """Hash the contents of an RBD image or snapshot in fixed size blocks.
+
+    Blocks are read concurrently by `threads` threads sharing the image,
+    since librbd images can be read from several threads at the same time.
+    Unallocated blocks are not read, they hash like a block of zeros.
+
+    :param image: rbd.Image, opened at the snapshot to hash if any.
+    :param block_size: Size of the blocks, the last one may be smaller.
+    :param algorithm: Any algorithm supported by hashlib.
+    :returns: List of the hex digests of the blocks, in order.
+    """
+    if block_size <= 0 or threads <= 0:
+        raise exception.InvalidParameterValue(
+            err=_('Block size and number of threads must be positive'))
+    size = image.size()
+    count = -(-size // block_size)
+
+    allocated: set = set()
+    for offset, length in iter_extents(image, whole_object=True):
+        allocated.update(range(offset // block_size,
+                               (offset + length - 1) // block_size + 1))
+
+    hashes: List[Optional[bytes]] = [None] * count
+    zero_hashes: Dict[int, bytes] = {}
+    for block in range(count):
+        if block not in allocated:
+            length = min(block_size, size - block * block_size)
+            if length not in zero_hashes:
+                zero_hashes[length] = _hash(algorithm, b'\x00',
+                                            bytes(length))
+            hashes[block] = zero_hashes[length]
+
+    pending = iter(sorted(allocated))
+    lock = threading.Lock()
+    errors: list = []
+
+    def _hash_blocks():
+        while True:
+            with lock:
+                block = None if errors else next(pending, None)
+            if block is None:
+                return
+            offset = block * block_size
+            try:
+                data = image.read(offset, min(block_size, size - offset))
+                hashes[block] = _hash(algorithm, b'\x00', data)
+            except Exception as exc:
+                LOG.error('Error reading block at %(offset)s: %(exc)s',
+                          {'offset': offset, 'exc': exc})
+                with lock:
+                    errors.append(exc)
+                return
+
+    workers = [executor.Thread(target=_hash_blocks)
+               for _i in range(min(threads, len(allocated)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    # Every block has its hash when there are no errors
+    return [h.hex() for h in hashes if h is not None]
+
+
+def tree_hash(block_hashes, size, algorithm='sha256'):
+    """Fold block hashes into the root hash of a binary hash tree.
+
+    Leaves are the blocks' hashes, each node is the hash of its children,
+    and the size of the image is included in the root, so the checksum of an
+    image can be computed from hashes of blocks stored elsewhere, like in a
+    backup, and two lists of block hashes can be compared to find the blocks
+    that differ.
+
+    :param block_hashes: List of hex digests, as returned by
+                         get_block_hashes.
+    :param size: Size of the image in bytes.
+    :returns: Hex digest of the root of the tree.
+    """
+    level = [bytes.fromhex(h) for h in block_hashes]
+    while len(level) > 1:
+        pairs = [level[i:i + 2] for i in range(0, len(level), 2)]
+        level = [_hash(algorithm, b'\x01', *pair) if len(pair) == 2
+                 else pair[0] for pair in pairs]
+    root = level[0] if level else b''
+    return _hash(algorithm, b'\x02', size.to_bytes(8, 'big'), root).hex()
+
+
+def checksum_image(image, block_size=CHECKSUM_BLOCK_SIZE,
+                   threads=CHECKSUM_THREADS_DEFAULT, algorithm='sha256'):
+    """Checksum an RBD image or snapshot, see get_block_hashes.
+
+    :returns: Hex digest of the root of the tree of the block hashes.
+    """
+    hashes = get_block_hashes(image, block_size, threads, algorithm)
+    return tree_hash(hashes, image.size(), algorithm)
+
+
+def verify_image(image, block_hashes, block_size=CHECKSUM_BLOCK_SIZE,
+                 threads=CHECKSUM_THREADS_DEFAULT, algorithm='sha256'):
+    """Compare an image with the block hashes of its expected contents.
+
+    :returns: List of the offsets of the blocks that differ, empty if the
+              image has the expected contents.
+    """
+    hashes = get_block_hashes(image, block_size, threads, algorithm)
+    different = [i * block_size
+                 for i, (h1, h2) in enumerate(zip(hashes, block_hashes))
+                 if h1 != h2]
+    # Blocks missing in one of them are different
+    different.extend(i * block_size for i in
+                     range(min(len(hashes), len(block_hashes)),
+                           max(len(hashes), len(block_hashes))))
+    return different
+
+
+class AIORequest(object):
+    """A librbd asynchronous read or write request."""
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+        self.data = None
+        self.error = None
+        self._done = threading.Event()
+
+    def complete(self, completion, data=None):
+        """Callback for librbd, called from one of its threads."""
+        ret = completion.get_return_value()
+        if ret < 0:
+            self.error = IOError(-ret, os.strerror(-ret))
+        else:
+            self.data = data
+        self._done.set()
+
+    def wait(self):
+        """Wait for the request to complete and return the read data."""
+        self._done.wait()
+        if self.error:
+            raise self.error
+        return self.data
+
+
+class AIOQueue(object):
+    """Ordered queue of in flight librbd asynchronous requests.
+
+    Requests complete in any order, but they are retired with `pop` in the
+    order they were submitted, which is what sequential readers and writers
+    need.  Writes wait for the oldest requests to complete when there are
+    already `depth` requests or `max_bytes` bytes in flight, so memory usage
+    is bounded.  Readers are expected to `pop` a request before submitting a
+    new one once the queue is full.
+    """
+
+    def __init__(self, image, depth=AIO_DEPTH_DEFAULT, max_bytes=None):
+        self.image = image
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._requests: collections.deque = collections.deque()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._requests)
+
+    def full(self, length=0):
+        return bool(self._requests) and (
+            len(self._requests) >= self.depth or
+            (self.max_bytes is not None and
+             self._bytes + length > self.max_bytes))
+
+    def _add(self, offset, length):
+        request = AIORequest(offset, length)
+        self._requests.append(request)
+        self._bytes += length
+        return request
+
+    def read(self, offset, length):
+        request = self._add(offset, length)
+        self.image.aio_read(offset, length, request.complete)
+        return request
+
+    def write(self, data, offset):
+        # The caller may reuse its buffer once we return
+        data = bytes(data)
+        while self.full(len(data)):
+            self.pop()
+        request = self._add(offset, len(data))
+        self.image.aio_write(data, offset, request.complete)
+        return request
+
+    @property
+    def next_offset(self):
+        """Offset of the oldest request or None if there are none."""
+        return self._requests[0].offset if self._requests else None
+
+    def pop(self):
+        """Wait for the oldest request and return its data, if any."""
+        request = self._requests.popleft()
+        self._bytes -= request.length
+        return request.wait()
+
+    def drain(self):
+        """Wait for all requests and raise the first error, if any."""
+        error = None
+        while self._requests:
+            try:
+                self.pop()
+            except Exception as exc:
+                error = error or exc
+        if error:
+            raise error
+
+    def discard(self):
+        """Wait for all requests ignoring their results."""
+        try:
+            self.drain()
+        except Exception:
+            pass
+
+
 class RBDVolume(object):
     """Context manager for dealing with an existing rbd volume."""
 
@@ -133,6 +614,58 @@ class RBDVolume(object):
     def __getattr__(self, attrib):
         return getattr(self.image, attrib)
 
+    def iter_extents(self, offset=0, length=None, from_snapshot=None,
+                     whole_object=False):
+        """Iterate over the allocated extents, see `iter_extents`."""
+        return iter_extents(self.image, offset, length, from_snapshot,
+                            whole_object)
+
+    def checksum(self, block_size=CHECKSUM_BLOCK_SIZE,
+                 threads=CHECKSUM_THREADS_DEFAULT, algorithm='sha256'):
+        """Checksum the image, see `checksum_image`."""
+        return checksum_image(self.image, block_size, threads, algorithm)
+
+    def read_stream(self, offset=0, length=None, chunk_size=None,
+                    depth=AIO_DEPTH_DEFAULT):
+        """Read the image sequentially keeping `depth` reads in flight.
+
+        :param chunk_size: Size of the chunks, defaults to the object size.
+        :returns: Generator of the data chunks, in order.
+        """
+        end = self.image.size()
+        if length is not None:
+            end = min(end, offset + length)
+        chunk_size = chunk_size or self.image.stat()['obj_size']
+        queue = AIOQueue(self.image, depth)
+        try:
+            while offset < end or len(queue):
+                while offset < end and not queue.full():
+                    chunk = min(chunk_size, end - offset)
+                    queue.read(offset, chunk)
+                    offset += chunk
+                yield queue.pop()
+        finally:
+            queue.discard()
+
+    def write_stream(self, chunks, offset=0, depth=AIO_DEPTH_DEFAULT,
+                     max_bytes=None):
+        """Write data chunks sequentially keeping `depth` writes in flight.
+
+        :param chunks: Iterable of bytes-like objects.
+        :param max_bytes: Maximum amount of data in flight.
+        :returns: Offset after the last written byte.
+        """
+        queue = AIOQueue(self.image, depth, max_bytes)
+        try:
+            for chunk in chunks:
+                queue.write(chunk, offset)
+                offset += len(chunk)
+        except Exception:
+            queue.discard()
+            raise
+        queue.drain()
+        return offset
+
 
 class RBDImageMetadata(object):
     """RBD image metadata to be used with RBDVolumeIOWrapper."""
@@ -142,17 +675,58 @@ class RBDImageMetadata(object):
         self.user = utils.convert_str(user or '')
         self.conf = utils.convert_str(conf or '')
 
+    def close(self):
+        self.image.close()
+
 
 class RBDVolumeIOWrapper(io.RawIOBase):
     """Enables LibRBD.Image objects to be treated as Python IO objects.
 
     Calling unimplemented interfaces will raise IOError.
+
+    The image size is cached, it is only checked again when reaching the end
+    of the image or on `truncate`.  Call `invalidate_size` if the image is
+    resized by other means.
+
+    :param read_ahead: Size in bytes of the read ahead window, 0 to disable
+                       it.  The window is rounded up to the image's object
+                       size and reads are aligned to it, so each read from the
+                       cluster covers complete objects.
+    :param aio_depth: Enables the streaming mode, where up to this number of
+                      asynchronous reads of read ahead windows (an object if
+                      read_ahead is 0) or asynchronous writes are kept in
+                      flight.  Write errors are raised on a later write,
+                      seek, flush or close.
+    :param aio_max_bytes: Maximum amount of written data in flight in the
+                          streaming mode, by default aio_depth windows.
+    :param write_buffer: Size in bytes of the write back buffer, 0 to disable
+                         it.  It is rounded up to the image's object size and
+                         sequential writes are coalesced in it and sent to the
+                         cluster as object aligned writes once it is full.
+                         It is flushed on seek, read, truncate, flush and
+                         close, where write errors are raised.  Data that
+                         could not be written stays in the buffer.
     """
 
-    def __init__(self, rbd_volume):
+    def __init__(self, rbd_volume, read_ahead=0, aio_depth=0,
+                 aio_max_bytes=None, write_buffer=0):
         super(RBDVolumeIOWrapper, self).__init__()
         self._rbd_volume = rbd_volume
         self._offset = 0
+        self._size = None
+        self._read_ahead = read_ahead
+        self._window = None
+        self._aio_depth = aio_depth
+        self._aio_max_bytes = aio_max_bytes
+        self._aio_reads = None
+        self._aio_writes = None
+        self._next_read = 0
+        # Read ahead buffer and the image offset where it starts
+        self._buffer = b''
+        self._buffer_offset = 0
+        self._write_buffer_size = write_buffer
+        self._write_buffer = bytearray()
+        self._write_buffer_offset = 0
 
     def _inc_offset(self, length):
         self._offset += length
@@ -173,46 +747,241 @@ class RBDVolumeIOWrapper(io.RawIOBase):
     def rbd_conf(self):
         return self._rbd_volume.conf
 
-    def read(self, length=None):
-        offset = self._offset
-        total = self._rbd_volume.image.size()
+    def _get_size(self, refresh=False):
+        if refresh or self._size is None:
+            self._size = self._rbd_volume.image.size()
+        return self._size
+
+    def invalidate_size(self):
+        """Forget the cached image size and the read ahead buffer."""
+        self._size = None
+        self._drop_buffer()
+
+    def _drop_buffer(self):
+        self._buffer = b''
+        self._buffer_offset = 0
+
+    def _get_window(self):
+        if self._window is None:
+            obj_size = self._rbd_volume.image.stat()['obj_size']
+            read_ahead = max(self._read_ahead, 1)
+            self._window = -(-read_ahead // obj_size) * obj_size
+        return self._window
+
+    def _get_aio_queue(self, attr, max_bytes=None):
+        queue = getattr(self, attr)
+        if queue is None:
+            queue = AIOQueue(self._rbd_volume.image, self._aio_depth,
+                             max_bytes)
+            setattr(self, attr, queue)
+        return queue
 
+    def _cancel_aio_reads(self):
+        if self._aio_reads is not None:
+            self._aio_reads.discard()
+
+    def _wait_aio_writes(self):
+        if self._aio_writes is not None:
+            self._aio_writes.drain()
+
+    def _sync_writes(self):
+        """Write the buffered data and wait for the in flight writes."""
+        self._flush_write_buffer()
+        self._wait_aio_writes()
+
+    def _remaining(self):
+        """Bytes from the current offset to the end of the image."""
+        # Reads must see our writes
+        self._sync_writes()
+        remaining = self._get_size() - self._offset
+        # Image may have been extended since we got its size
+        if remaining <= 0:
+            remaining = self._get_size(refresh=True) - self._offset
+        return max(remaining, 0)
+
+    def _image_read(self, offset, length):
+        try:
+            return self._rbd_volume.image.read(int(offset), int(length))
+        except Exception:
+            LOG.exception('Exception encountered during image read')
+            raise
+
+    def read(self, length=None):
         # NOTE(dosaboy): posix files do not barf if you read beyond their
         # length (they just return nothing) but rbd images do so we need to
         # return empty string if we have reached the end of the image.
-        if (offset >= total):
+        remaining = self._remaining()
+        if not remaining:
             return b''
 
-        if length is None:
-            length = total
+        if length is None or length < 0 or length > remaining:
+            length = remaining
 
-        if (offset + length) > total:
-            length = total - offset
+        if self._read_ahead or self._aio_depth:
+            data = bytearray(length)
+            length = self.readinto(data)
+            return bytes(data[:length])
 
+        data = self._image_read(self._offset, length)
+        self._inc_offset(length)
+        return data
+
+    def readinto(self, b):
+        """Read directly into a pre-allocated writable bytes-like object."""
+        view = memoryview(b).cast('B')
+        length = min(len(view), self._remaining())
+        if not length:
+            return 0
+
+        if not (self._read_ahead or self._aio_depth):
+            view[:length] = self._image_read(self._offset, length)
+            self._inc_offset(length)
+            return length
+
+        done = 0
+        while done < length:
+            start = self._offset - self._buffer_offset
+            if not 0 <= start < len(self._buffer):
+                self._fill_buffer()
+                start = self._offset - self._buffer_offset
+                # Image was shrunk
+                if start >= len(self._buffer):
+                    break
+            chunk = min(length - done, len(self._buffer) - start)
+            with memoryview(self._buffer) as buffer:
+                view[done:done + chunk] = buffer[start:start + chunk]
+            done += chunk
+            self._inc_offset(chunk)
+        return done
+
+    def _fill_buffer(self):
+        """Read the object aligned window that contains the current offset."""
+        window = self._get_window()
+        start = self._offset - self._offset % window
+        if self._aio_depth:
+            self._buffer = self._aio_read(start, window)
+        else:
+            length = min(window, self._get_size() - start)
+            self._buffer = self._image_read(start, length)
+        self._buffer_offset = start
+
+    def _aio_read(self, start, window):
+        """Get a window from the queue, keeping the next ones in flight."""
+        queue = self._get_aio_queue('_aio_reads')
+        # Not a sequential read, start again from here
+        if queue.next_offset != start:
+            queue.discard()
+            self._next_read = start
+        size = self._get_size()
+        while self._next_read < size and not queue.full():
+            length = min(window, size - self._next_read)
+            queue.read(self._next_read, length)
+            self._next_read += length
+        if not len(queue):
+            return b''
         try:
-            data = self._rbd_volume.image.read(int(offset), int(length))
+            return queue.pop()
         except Exception:
             LOG.exception('Exception encountered during image read')
+            queue.discard()
             raise
 
+    def write(self, data):
+        self._drop_buffer()
+        length = len(data)
+        if self._write_buffer_size:
+            self._buffered_write(memoryview(data).cast('B'))
+        else:
+            self._image_write(data, self._offset)
         self._inc_offset(length)
-        return data
+        return length
 
-    def write(self, data):
-        self._rbd_volume.image.write(data, self._offset)
-        self._inc_offset(len(data))
+    def _image_write(self, data, offset):
+        if self._aio_depth:
+            self._cancel_aio_reads()
+            max_bytes = self._aio_max_bytes
+            if max_bytes is None:
+                max_bytes = self._aio_depth * self._get_window()
+            queue = self._get_aio_queue('_aio_writes', max_bytes)
+            queue.write(data, offset)
+        else:
+            self._rbd_volume.image.write(data, offset)
+
+    def _get_write_buffer_capacity(self):
+        obj_size = self._rbd_volume.image.stat()['obj_size']
+        return -(-self._write_buffer_size // obj_size) * obj_size, obj_size
+
+    def _buffered_write(self, view):
+        capacity, obj_size = self._get_write_buffer_capacity()
+        buf = self._write_buffer
+        offset = self._offset
+        if buf and offset != self._write_buffer_offset + len(buf):
+            self._flush_write_buffer()
+
+        while view:
+            if not buf:
+                self._write_buffer_offset = offset
+                # Large aligned writes bypass the buffer
+                if not offset % obj_size and len(view) >= capacity:
+                    length = len(view) - len(view) % obj_size
+                    self._image_write(bytes(view[:length]), offset)
+                    view = view[length:]
+                    offset += length
+                    continue
+            length = min(capacity - len(buf), len(view))
+            buf += view[:length]
+            view = view[length:]
+            offset += length
+            if len(buf) >= capacity:
+                self._flush_write_buffer(obj_size)
+
+    def _flush_write_buffer(self, align=None):
+        """Write the buffer, only up to the last object boundary if align."""
+        buf = self._write_buffer
+        if not buf:
+            return
+        start = self._write_buffer_offset
+        end = start + len(buf)
+        if align:
+            end -= end % align
+            if end <= start:
+                return
+        length = end - start
+        self._image_write(bytes(buf[:length]), start)
+        del buf[:length]
+        self._write_buffer_offset = end
+
+    def truncate(self, size=None):
+        """Resize the image, by default to the current offset."""
+        self._sync_writes()
+        if size is None:
+            size = self._offset
+        self._rbd_volume.image.resize(size)
+        self.invalidate_size()
+        self._size = size
+        return size
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
 
     def seekable(self):
         return True
 
     def seek(self, offset, whence=0):
+        # In flight writes could overlap with the next ones
+        self._sync_writes()
         if whence == 0:
             new_offset = offset
         elif whence == 1:
             new_offset = self._offset + offset
         elif whence == 2:
-            new_offset = self._rbd_volume.image.size()
+            new_offset = self._get_size(refresh=True)
             new_offset += offset
+        elif whence in (SEEK_DATA, SEEK_HOLE):
+            new_offset = self._seek_extent(offset, whence == SEEK_DATA)
         else:
             raise IOError(_("Invalid argument - whence=%s not supported") %
                           (whence))
@@ -221,11 +990,39 @@ class RBDVolumeIOWrapper(io.RawIOBase):
             raise IOError(_("Invalid argument"))
 
         self._offset = new_offset
+        return new_offset
+
+    def _seek_extent(self, offset, data):
+        """Find the next data or hole offset like lseek's SEEK_DATA/HOLE."""
+        if offset < 0:
+            raise IOError(_("Invalid argument"))
+        size = self._get_size(refresh=True)
+        if offset >= size:
+            raise IOError(errno.ENXIO, os.strerror(errno.ENXIO))
+
+        for start, length in iter_extents(self._rbd_volume.image, offset):
+            if data:
+                return start
+            # Extents are merged, so this one ends in a hole
+            return offset if start > offset else start + length
+
+        if data:
+            raise IOError(errno.ENXIO, os.strerror(errno.ENXIO))
+        # There is a virtual hole at the end of the image
+        return size
 
     def tell(self):
         return self._offset
 
+    def checksum(self, block_size=CHECKSUM_BLOCK_SIZE,
+                 threads=CHECKSUM_THREADS_DEFAULT, algorithm='sha256'):
+        """Checksum the image including our writes, see `checksum_image`."""
+        self._sync_writes()
+        return checksum_image(self._rbd_volume.image, block_size, threads,
+                              algorithm)
+
     def flush(self):
+        self._sync_writes()
         try:
             self._rbd_volume.image.flush()
         except AttributeError:
@@ -240,4 +1037,10 @@ class RBDVolumeIOWrapper(io.RawIOBase):
         raise IOError(_("fileno() not supported by RBD()"))
 
     def close(self):
-        self.rbd_image.close()
+        try:
+            self._cancel_aio_reads()
+            self._sync_writes()
+        finally:
+            del self._write_buffer[:]
+            # An RBDVolume also releases its client, which may be pooled
+            self._rbd_volume.close()
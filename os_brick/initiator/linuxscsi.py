@@ -18,7 +18,6 @@
 """
 import glob
 import os
-import re
 import time
 from typing import Dict, List, Optional  # noqa: H301
 
@@ -27,16 +26,14 @@ from oslo_log import log as logging
 
 from os_brick import exception
 from os_brick import executor
+from os_brick.initiator import linuxblock
 from os_brick.privileged import rootwrap as priv_rootwrap
 from os_brick import utils
 
 LOG = logging.getLogger(__name__)
 
-MULTIPATH_ERROR_REGEX = re.compile(r"\w{3} \d+ \d\d:\d\d:\d\d \|.*$")
-MULTIPATH_WWID_REGEX = re.compile(r"\((?P<wwid>.+)\)")
-MULTIPATH_DEVICE_ACTIONS = ['unchanged:', 'reject:', 'reload:',
-                            'switchpg:', 'rename:', 'create:',
-                            'resize:']
+# Devices read from sysfs to find multipath DMs and their paths
+MULTIPATH_DEVICE_PATTERNS = ('sd*', 'dm-*')
 
 
 class LinuxSCSI(executor.Executor):
@@ -80,8 +77,12 @@ class LinuxSCSI(executor.Executor):
             with exc.context(force, 'Removing %s failed', device):
                 self.echo_scsi_command(path, "1")
 
-    def wait_for_volumes_removal(self, volumes_names: List[str]) -> None:
-        """Wait for device paths to be removed from the system."""
+    def wait_for_volumes_removal(self, volumes_names: List[str],
+                                 timeout: float = 30) -> None:
+        """Wait for device paths to be removed from the system.
+
+        :param timeout: Seconds to wait before raising VolumePathNotRemoved.
+        """
         str_names = ', '.join(volumes_names)
         LOG.debug('Checking to see if SCSI volumes %s have been removed.',
                   str_names)
@@ -90,13 +91,14 @@ class LinuxSCSI(executor.Executor):
         # It can take up to 30 seconds to remove a SCSI device if the path
         # failed right before we start detaching, which is unlikely, but we
         # still shouldn't fail in that case.
-        for i in range(61):
+        tries = int(timeout / 0.5)
+        for i in range(tries + 1):
             exist = [path for path in exist if os.path.exists(path)]
             if not exist:
                 LOG.debug("SCSI volumes %s have been removed.", str_names)
                 return
             # Don't sleep on the last try since we are quitting
-            if i < 60:
+            if i < tries:
                 time.sleep(0.5)
                 # Log every 5 seconds
                 if i % 10 == 0:
@@ -113,6 +115,19 @@ class LinuxSCSI(executor.Executor):
         if os.path.islink(device):
             device = '/dev/' + os.readlink(device).split('/')[-1]
         # Else it's already a /dev/sdX device.
+        # Get it from sysfs, where the device links to its [H:C:T:L] directory
+        try:
+            link = os.readlink('/sys/block/%s/device' %
+                               device.replace('/dev/', ''))
+            hctl_info = os.path.basename(link).split(':')
+            if len(hctl_info) == 4:
+                dev_info.update(host=hctl_info[0], channel=hctl_info[1],
+                                id=hctl_info[2], lun=hctl_info[3])
+                LOG.debug('dev_info=%s', str(dev_info))
+                return dev_info
+        except OSError:
+            pass
+
         # Then get it from lsscsi output
         (out, _err) = self._execute('lsscsi')
         if out:
@@ -425,6 +440,56 @@ class LinuxSCSI(executor.Executor):
         else:
             LOG.debug("Block device %s is not read-only.", device_path)
 
+    def get_dm_uuid(self, dm):
+        """Get the Device map uuid given the device name of the dm on sysfs.
+
+        :param dm: Device map name as seen in sysfs. ie: 'dm-0'
+        :returns: String with the uuid, or empty string if not available.
+                  ie: 'mpath-36e843b658476b7ed5bc1d4d10d9b1fde'
+        """
+        return linuxblock.read_sysfs('/sys/block', dm, 'dm', 'uuid') or ''
+
+    def find_sysfs_multipath_dm_by_wwn(self, wwn):
+        """Find the multipath dm device name for a WWN using sysfs.
+
+        Multipath DMs have a uuid in the form of mpath-<WWN>, regardless of
+        multipath friendly names being enabled or not.
+
+        :param wwn: The WWN of the volume. ie: '36e843b658476b7ed5bc1d4d10d9'
+        :returns: String with the dm name or None if not found. ie: 'dm-0'
+        """
+        dm = linuxblock.BlockDeviceTopology.snapshot(
+            patterns=('dm-*',)).get_multipath(wwn)
+        return dm.name if dm else None
+
+    @staticmethod
+    def get_sysfs_dm_devices(dm, topology=None):
+        """Get the SCSI devices that are part of a DM from sysfs.
+
+        :param dm: Device map name as seen in sysfs. ie: 'dm-0'
+        :param topology: BlockDeviceTopology with the DM and its SCSI devices,
+                         a new one is read if not provided.
+        :returns: List of dictionaries with the device path and its host,
+                  channel, id, and lun, as returned by get_device_info.
+        """
+        if topology is None:
+            topology = linuxblock.BlockDeviceTopology.snapshot(
+                patterns=MULTIPATH_DEVICE_PATTERNS)
+        # Devices without an address are not SCSI devices (ie: nested DMs)
+        return [{'device': slave.path,
+                 'host': slave.hctl[0], 'channel': slave.hctl[1],
+                 'id': slave.hctl[2], 'lun': slave.hctl[3]}
+                for slave in topology.get_slaves(dm) if slave.hctl]
+
+    @utils.retry(exception.VolumeDeviceNotFound)
+    def _wait_for_sysfs_multipath_dm(self, wwn):
+        """Wait for the multipath DM of a WWN to show up in sysfs."""
+        dm = self.find_sysfs_multipath_dm_by_wwn(wwn)
+        if not dm:
+            LOG.debug("Multipath DM for %s doesn't exist yet.", wwn)
+            raise exception.VolumeDeviceNotFound(device='mpath-' + wwn)
+        return dm
+
     def find_multipath_device_path(self, wwn):
         """Look for the multipath device file for a volume WWN.
 
@@ -443,109 +508,77 @@ class LinuxSCSI(executor.Executor):
             /dev/disk/by-id/scsi-<WWN>
             /dev/mapper/<WWN>
 
+        Instead of polling each of these locations we look for the DM in sysfs
+        using its uuid, and then return the most stable path that exists.
         """
         LOG.info("Find Multipath device file for volume WWN %(wwn)s",
                  {'wwn': wwn})
-        # First look for the common path
-        wwn_dict = {'wwn': wwn}
-        path = "/dev/disk/by-id/dm-uuid-mpath-%(wwn)s" % wwn_dict
         try:
-            self.wait_for_path(path)
-            return path
+            dm = self._wait_for_sysfs_multipath_dm(wwn)
         except exception.VolumeDeviceNotFound:
-            pass
-
-        # for some reason the common path wasn't found
-        # lets try the dev mapper path
-        path = "/dev/mapper/%(wwn)s" % wwn_dict
-        try:
-            self.wait_for_path(path)
-            return path
-        except exception.VolumeDeviceNotFound:
-            pass
+            # couldn't find a path
+            LOG.warning("couldn't find a valid multipath device path for "
+                        "%(wwn)s", {'wwn': wwn})
+            return None
 
-        # couldn't find a path
-        LOG.warning("couldn't find a valid multipath device path for "
-                    "%(wwn)s", wwn_dict)
-        return None
+        paths = ['/dev/disk/by-id/dm-uuid-mpath-' + wwn]
+        name = self.get_dm_name(dm)
+        if name:
+            paths.append('/dev/mapper/' + name)
+        for path in paths:
+            if os.path.exists(path):
+                return path
+        # udev hasn't created the symlinks yet, but the DM is there
+        return '/dev/' + dm
 
     def find_multipath_device(self, device):
         """Discover multipath devices for a mpath device.
 
-           This uses the slow multipath -l command to find a
-           multipath device description, then screen scrapes
-           the output to discover the multipath device name
-           and it's devices.
+        Gets the multipath device description from sysfs, the multipath name
+        and uuid from /sys/block/dm-*/dm and its devices from
+        /sys/block/dm-*/slaves.
 
+        :param device: Device path of one of the paths (ie: /dev/sde), the DM
+                       itself (ie: /dev/dm-2) or the multipath name or WWN.
+        :returns: Dictionary with the multipath device path, its id, name, and
+                  the devices that are part of it, or None if not found.
         """
+        topology = linuxblock.BlockDeviceTopology.snapshot(
+            patterns=MULTIPATH_DEVICE_PATTERNS)
+        name = os.path.basename(device)
+        if name.startswith('dm-'):
+            dm = topology.get(name)
+        else:
+            dm = next((holder for holder in topology.get_holders(name)
+                       if holder.name.startswith('dm-')), None)
+            if not (dm and self._is_multipath_dm(dm)):
+                dm = (topology.get_multipath(name) or
+                      topology.get_by_dm_name(name))
+
+        if not (dm and self._is_multipath_dm(dm)):
+            LOG.debug("Couldn't find multipath device for %s", device)
+            return None
 
-        mdev = None
-        devices = []
-        out = None
+        mdev_name = dm.dm_name or ''
+        mdev = '/dev/mapper/%s' % mdev_name
+
+        # Confirm that the device is present.
         try:
-            (out, _err) = self._execute('multipath', '-l', device,
-                                        run_as_root=True,
-                                        root_helper=self._root_helper)
-        except putils.ProcessExecutionError as exc:
-            LOG.warning("multipath call failed exit %(code)s",
-                        {'code': exc.exit_code})
-            raise exception.CommandExecutionFailed(
-                cmd='multipath -l %s' % device)
+            os.stat(mdev)
+        except OSError:
+            LOG.warning("Couldn't find multipath device %s", mdev)
+            return None
 
-        if out:
-            lines_str = out.strip()
-            lines = lines_str.split("\n")
-            lines = [line for line in lines
-                     if not re.match(MULTIPATH_ERROR_REGEX, line) and
-                     len(line)]
-            if lines:
-
-                mdev_name = lines[0].split(" ")[0]
-
-                if mdev_name in MULTIPATH_DEVICE_ACTIONS:
-                    mdev_name = lines[0].split(" ")[1]
-
-                mdev = '/dev/mapper/%s' % mdev_name
-
-                # Confirm that the device is present.
-                try:
-                    os.stat(mdev)
-                except OSError:
-                    LOG.warning("Couldn't find multipath device %s",
-                                mdev)
-                    return None
+        mdev_id = dm.uuid[6:] or mdev_name
+        LOG.debug("Found multipath device = %(mdev)s", {'mdev': mdev})
+        return {"device": mdev,
+                "id": mdev_id,
+                "name": mdev_name,
+                "devices": self.get_sysfs_dm_devices(dm.name, topology)}
 
-                wwid_search = MULTIPATH_WWID_REGEX.search(lines[0])
-                if wwid_search is not None:
-                    mdev_id = wwid_search.group('wwid')
-                else:
-                    mdev_id = mdev_name
-
-                LOG.debug("Found multipath device = %(mdev)s",
-                          {'mdev': mdev})
-                device_lines = lines[3:]
-                for dev_line in device_lines:
-                    if dev_line.find("policy") != -1:
-                        continue
-
-                    dev_line = dev_line.lstrip(' |-`')
-                    dev_info = dev_line.split()
-                    address = dev_info[0].split(":")
-
-                    dev = {'device': '/dev/%s' % dev_info[1],
-                           'host': address[0], 'channel': address[1],
-                           'id': address[2], 'lun': address[3]
-                           }
-
-                    devices.append(dev)
-
-        if mdev is not None:
-            info = {"device": mdev,
-                    "id": mdev_id,
-                    "name": mdev_name,
-                    "devices": devices}
-            return info
-        return None
+    @staticmethod
+    def _is_multipath_dm(dm):
+        return (dm.uuid or '').startswith('mpath-')
 
     def get_device_size(self, device):
         """Get the size in bytes of a volume."""
@@ -582,12 +615,22 @@ class LinuxSCSI(executor.Executor):
                                     root_helper=self._root_helper)
         return out
 
-    def extend_volume(self, volume_paths, use_multipath=False):
+    def extend_volume(self, volume_paths, use_multipath=False,
+                      concurrent=False):
         """Signal the SCSI subsystem to test for volume resize.
 
         This function tries to signal the local system's kernel
         that an already attached volume might have been resized.
+
+        :param volume_paths: List of paths to the devices of the volume.
+        :param use_multipath: Whether to resize the multipath device map.
+        :param concurrent: Rescan all paths concurrently and get sizes from
+                           sysfs instead of doing it serially using blockdev.
         """
+        if concurrent:
+            return self._extend_volume_concurrently(volume_paths,
+                                                    use_multipath)
+
         LOG.debug("extend volume %s", volume_paths)
 
         for volume_path in volume_paths:
@@ -635,6 +678,109 @@ class LinuxSCSI(executor.Executor):
 
         return new_size
 
+    @staticmethod
+    def get_sysfs_device_size(device_name):
+        """Get the size in bytes of a block device from sysfs.
+
+        :param device_name: Device name, not path. ie: 'sda' or 'dm-0'
+        :returns: Size in bytes or None if the device is not present.
+        """
+        try:
+            with open('/sys/block/%s/size' % device_name) as f:
+                return int(f.read().strip()) * 512
+        except (IOError, ValueError):
+            return None
+
+    def _rescan_device(self, device_name, data):
+        """Send a rescan to a SCSI device, to be run in a thread.
+
+        Errors are stored in the shared dictionary under the device name.
+        """
+        try:
+            hctl = os.path.basename(
+                os.readlink('/sys/block/%s/device' % device_name))
+            self.echo_scsi_command(
+                '/sys/bus/scsi/drivers/sd/%s/rescan' % hctl, '1')
+        except Exception as exc:
+            LOG.warning('Failed to rescan %(device)s: %(exc)s',
+                        {'device': device_name, 'exc': exc})
+            data[device_name] = exc
+
+    def _wait_for_sizes_to_agree(self, device_names, timeout=10.0):
+        """Wait until all devices report the same size in sysfs.
+
+        :returns: Dictionary with the size of each device.
+        """
+        deadline = time.time() + timeout
+        while True:
+            sizes = {name: self.get_sysfs_device_size(name)
+                     for name in device_names}
+            if len(set(sizes.values())) == 1 or time.time() > deadline:
+                return sizes
+            time.sleep(0.1)
+
+    def _extend_volume_concurrently(self, volume_paths, use_multipath=False):
+        """Rescan all the paths in parallel and resize the multipath once.
+
+        Devices are resolved and sizes read from sysfs, so there are no
+        lsscsi, blockdev, or scsi_id calls, and the only subprocesses are the
+        rescans, which run at the same time, and the multipath map resize.
+        """
+        LOG.debug("extend volume %s concurrently", volume_paths)
+        device_names = [os.path.basename(os.path.realpath(path))
+                        for path in volume_paths]
+        old_sizes = {name: self.get_sysfs_device_size(name)
+                     for name in device_names}
+        LOG.debug("Starting sizes: %s", old_sizes)
+
+        failed: dict = {}
+        threads = [executor.Thread(target=self._rescan_device,
+                                   args=(name, failed))
+                   for name in device_names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        rescanned = [name for name in device_names if name not in failed]
+        if not rescanned:
+            LOG.error("Failed to rescan all paths of volume %s",
+                      volume_paths)
+            return None
+
+        sizes = self._wait_for_sizes_to_agree(rescanned)
+        new_size = max(size or 0 for size in sizes.values()) or None
+        if len(set(sizes.values())) != 1:
+            LOG.warning("Paths of volume %(volume)s report different sizes "
+                        "after rescan: %(sizes)s",
+                        {'volume': volume_paths, 'sizes': sizes})
+        LOG.debug("volume size after scsi device rescan %s", new_size)
+
+        mpath_dm = use_multipath and self.find_sysfs_multipath_dm(
+            device_names)
+        if mpath_dm:
+            mpath_id = self.get_dm_uuid(mpath_dm)[6:]
+            LOG.info("mpath(%(device)s) current size %(size)s",
+                     {'device': mpath_dm,
+                      'size': self.get_sysfs_device_size(mpath_dm)})
+            result = self.multipath_resize_map(mpath_id)
+            if 'fail' in result:
+                # Multipathd may have lost track of the map
+                self.multipath_reconfigure()
+                result = self.multipath_resize_map(mpath_id)
+            if 'fail' in result:
+                LOG.error("Multipathd failed to update the size mapping "
+                          "of multipath device %(scsi_wwn)s volume "
+                          "%(volume)s",
+                          {'scsi_wwn': mpath_id, 'volume': volume_paths})
+                return None
+            new_size = self._wait_for_sizes_to_agree(
+                [mpath_dm] + rescanned)[mpath_dm]
+            LOG.info("mpath(%(device)s) new size %(size)s",
+                     {'device': mpath_dm, 'size': new_size})
+
+        return new_size
+
     def process_lun_id(self, lun_ids):
         if isinstance(lun_ids, list):
             processed = []
@@ -25,6 +25,7 @@ from oslo_utils import excutils
 
 from os_brick import exception
 from os_brick import executor
+from os_brick.privileged import lvm as priv_lvm
 from os_brick.privileged import rootwrap as priv_rootwrap
 from os_brick import utils
 
@@ -35,11 +36,13 @@ class LVM(executor.Executor):
     """LVM object to enable various LVM related operations."""
 
     LVM_CMD_PREFIX = ['env', 'LC_ALL=C']
+    # Execute arguments supported when running commands in the lvm shell
+    SHELL_KWARGS = ('root_helper', 'run_as_root', 'check_exit_code')
 
     def __init__(self, vg_name, root_helper, create_vg=False,
                  physical_volumes=None, lvm_type='default',
                  executor=None, lvm_conf=None,
-                 suppress_fd_warn=False):
+                 suppress_fd_warn=False, use_lvm_shell=False):
 
         """Initialize the LVM object.
 
@@ -55,9 +58,12 @@ class LVM(executor.Executor):
         :param executor: Execute method to use, None uses
                          oslo_concurrency.processutils
         :param suppress_fd_warn: Add suppress FD Warn to LVM env
+        :param use_lvm_shell: Run LVM commands in a persistent lvm shell
+                              instead of starting a new process each time
         """
         super(LVM, self).__init__(execute=executor, root_helper=root_helper)
         self.vg_name = vg_name
+        self.use_lvm_shell = use_lvm_shell
         self.pv_list = []
         self.vg_size = 0.0
         self.vg_free_space = 0.0
@@ -117,7 +123,73 @@ class LVM(executor.Executor):
 
             self.vg_thin_pool = pool_name
             self.activate_lv(self.vg_thin_pool)
-        self.pv_list = self.get_all_physical_volumes(root_helper, vg_name)
+        self.pv_list = self.get_all_physical_volumes(
+            root_helper, vg_name, use_lvm_shell=use_lvm_shell)
+
+    @staticmethod
+    def _shell_execute(cmd, vg_name=None):
+        """Run an LVM command in the lvm shell of a VG.
+
+        Commands are only run as a process instead when they were not sent to
+        a shell, or when they only read, since running the others again after
+        the shell failed could repeat their changes.
+
+        :returns: Tuple of (stdout, stderr), or None if the command cannot be
+                  run in the shell and must be run as a process instead.
+        :raises ProcessExecutionError: If the command fails, or if the shell
+                                       fails while running a command that
+                                       changes LVM metadata.
+        """
+        env = {}
+        args = list(cmd)
+        if args and args[0] == 'env':
+            args.pop(0)
+            while args and '=' in args[0]:
+                name, value = args.pop(0).split('=', 1)
+                env[name] = value
+        if not args or args[0] not in priv_lvm.LVM_SHELL_COMMANDS:
+            return None
+        try:
+            return priv_lvm.execute(vg_name, env, *args)
+        except priv_lvm.LVMShellUnavailable as exc:
+            LOG.debug('Running %s as a command: %s', args[0], exc)
+            return None
+        except priv_lvm.LVMShellError as exc:
+            if args[0] not in priv_lvm.LVM_SHELL_READONLY_COMMANDS:
+                raise putils.ProcessExecutionError(
+                    cmd=' '.join(args), stderr=str(exc),
+                    description='The lvm shell failed running the command')
+            LOG.warning('The lvm shell failed, running %s as a command: %s',
+                        args[0], exc)
+            return None
+
+    @staticmethod
+    def _root_execute(cmd, root_helper, use_lvm_shell=False, vg_name=None):
+        """Run an LVM command as root for the static methods."""
+        result = use_lvm_shell and LVM._shell_execute(cmd, vg_name)
+        return result or priv_rootwrap.execute(*cmd,
+                                               root_helper=root_helper,
+                                               run_as_root=True)
+
+    def _execute(self, *cmd, **kwargs):
+        # The shell runs as root and can honour the exit code check, other
+        # options like attempts or process_input need a process.
+        if self.use_lvm_shell and set(kwargs).issubset(self.SHELL_KWARGS):
+            try:
+                result = self._shell_execute(cmd, self.vg_name)
+            except putils.ProcessExecutionError as exc:
+                check_exit_code = kwargs.get('check_exit_code', True)
+                if isinstance(check_exit_code, bool):
+                    ignore = not check_exit_code
+                else:
+                    ignore = exc.exit_code in check_exit_code
+                # Errors from the shell itself have no exit code
+                if exc.exit_code is None or not ignore:
+                    raise
+                result = (exc.stdout, exc.stderr)
+            if result is not None:
+                return result
+        return super(LVM, self)._execute(*cmd, **kwargs)
 
     def _vg_exists(self):
         """Simple check to see if VG exists.
@@ -298,12 +370,14 @@ class LVM(executor.Executor):
     @staticmethod
     @utils.retry(retry=utils.retry_if_exit_code, retry_param=139, interval=0.5,
                  backoff_rate=0.5)  # Bug#1901783
-    def get_lv_info(root_helper, vg_name=None, lv_name=None):
+    def get_lv_info(root_helper, vg_name=None, lv_name=None,
+                    use_lvm_shell=False):
         """Retrieve info about LVs (all, in a VG, or a single LV).
 
         :param root_helper: root_helper to use for execute
         :param vg_name: optional, gathers info for only the specified VG
         :param lv_name: optional, gathers info for only the specified LV
+        :param use_lvm_shell: optional, run the command in the lvm shell
         :returns: List of Dictionaries with LV info
 
         """
@@ -316,9 +390,8 @@ class LVM(executor.Executor):
             cmd.append(vg_name)
 
         try:
-            (out, _err) = priv_rootwrap.execute(*cmd,
-                                                root_helper=root_helper,
-                                                run_as_root=True)
+            (out, _err) = LVM._root_execute(cmd, root_helper, use_lvm_shell,
+                                            vg_name)
         except putils.ProcessExecutionError as err:
             with excutils.save_and_reraise_exception(reraise=True) as ctx:
                 if "not found" in err.stderr or "Failed to find" in err.stderr:
@@ -345,7 +418,8 @@ class LVM(executor.Executor):
         """
         return self.get_lv_info(self._root_helper,
                                 self.vg_name,
-                                lv_name)
+                                lv_name,
+                                use_lvm_shell=self.use_lvm_shell)
 
     def get_volume(self, name):
         """Get reference object of volume specified by name.
@@ -360,11 +434,13 @@ class LVM(executor.Executor):
         return None
 
     @staticmethod
-    def get_all_physical_volumes(root_helper, vg_name=None):
+    def get_all_physical_volumes(root_helper, vg_name=None,
+                                 use_lvm_shell=False):
         """Static method to get all PVs on a system.
 
         :param root_helper: root_helper to use for execute
         :param vg_name: optional, gathers info for only the specified VG
+        :param use_lvm_shell: optional, run the command in the lvm shell
         :returns: List of Dictionaries with PV info
 
         """
@@ -374,9 +450,8 @@ class LVM(executor.Executor):
                                     '-o', 'vg_name,name,size,free',
                                     '--separator', field_sep,
                                     '--nosuffix']
-        (out, _err) = priv_rootwrap.execute(*cmd,
-                                            root_helper=root_helper,
-                                            run_as_root=True)
+        (out, _err) = LVM._root_execute(cmd, root_helper, use_lvm_shell,
+                                        vg_name)
 
         pvs = out.split()
         if vg_name is not None:
@@ -397,16 +472,17 @@ class LVM(executor.Executor):
         :returns: List of Dictionaries with PV info
 
         """
-        self.pv_list = self.get_all_physical_volumes(self._root_helper,
-                                                     self.vg_name)
+        self.pv_list = self.get_all_physical_volumes(
+            self._root_helper, self.vg_name, use_lvm_shell=self.use_lvm_shell)
         return self.pv_list
 
     @staticmethod
-    def get_all_volume_groups(root_helper, vg_name=None):
+    def get_all_volume_groups(root_helper, vg_name=None, use_lvm_shell=False):
         """Static method to get all VGs on a system.
 
         :param root_helper: root_helper to use for execute
         :param vg_name: optional, gathers info for only the specified VG
+        :param use_lvm_shell: optional, run the command in the lvm shell
         :returns: List of Dictionaries with VG info
 
         """
@@ -418,9 +494,8 @@ class LVM(executor.Executor):
         if vg_name is not None:
             cmd.append(vg_name)
 
-        (out, _err) = priv_rootwrap.execute(*cmd,
-                                            root_helper=root_helper,
-                                            run_as_root=True)
+        (out, _err) = LVM._root_execute(cmd, root_helper, use_lvm_shell,
+                                        vg_name)
         vg_list = []
         if out is not None:
             vgs = out.split()
@@ -443,7 +518,8 @@ class LVM(executor.Executor):
         :returns: Dictionaries of VG info
 
         """
-        vg_list = self.get_all_volume_groups(self._root_helper, self.vg_name)
+        vg_list = self.get_all_volume_groups(self._root_helper, self.vg_name,
+                                             self.use_lvm_shell)
 
         if len(vg_list) != 1:
             LOG.error('Unable to find VG: %s', self.vg_name)
@@ -479,7 +555,8 @@ class LVM(executor.Executor):
             # therefore we should provide only self.vg_name, but not
             # self.vg_thin_pool here.
             for lv in self.get_lv_info(self._root_helper,
-                                       self.vg_name):
+                                       self.vg_name,
+                                       use_lvm_shell=self.use_lvm_shell):
                 lvsize = lv['size']
                 # get_lv_info runs "lvs" command with "--nosuffix".
                 # This removes "g" from "1.00g" and only outputs "1.00".
@@ -0,0 +1,374 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Persistent LVM shell sessions.
+
+Every LVM command reads lvm.conf, initializes its locking and scans devices
+when it starts, which is most of the time spent by short commands like lvs.
+The lvm shell pays that cost once and then runs all the commands we send to
+its stdin.
+
+Commands are run with JSON reports and the command log enabled, the same way
+lvmdbusd does, and reports are written to a separate file descriptor
+(LVM_REPORT_FD), so we can get the return code of each command from the log
+and the report rows without parsing the shell's output.  Reports are
+converted back to the text the LVM commands would have printed with
+--noheadings, so callers can use sessions and commands interchangeably.
+
+Shells run in the privsep daemon, up to LVM_SHELLS_PER_VG per volume group
+and environment, and commands that find all of them busy are run as separate
+processes by the caller, so slow commands don't serialize the others.
+"""
+
+import json
+import os
+import select
+import subprocess
+import threading
+import time
+
+from oslo_concurrency import processutils as putils
+from oslo_log import log as logging
+
+import os_brick.privileged
+
+
+LOG = logging.getLogger(__name__)
+
+LVM_SHELL_CMD = ['lvm']
+LVM_SHELL_PROMPT = b'lvm> '
+# Seconds to wait for a command to complete before killing the shell
+LVM_SHELL_TIMEOUT = 600
+# Maximum number of shells for a volume group and environment
+LVM_SHELLS_PER_VG = 4
+# Seconds to wait before trying again to start a shell that failed to start
+LVM_SHELL_RESTART_INTERVAL = 60
+# Commands that can be run in the shell
+LVM_SHELL_COMMANDS = ('lvs', 'vgs', 'pvs', 'lvdisplay', 'lvcreate',
+                      'lvremove', 'lvchange', 'lvextend', 'lvrename',
+                      'lvconvert', 'vgcreate')
+# Commands that can safely run again if the shell fails while running them
+LVM_SHELL_READONLY_COMMANDS = ('lvs', 'vgs', 'pvs', 'lvdisplay')
+# Report the status of the command in the command log.  Commands accept a
+# single --config option, so this is added to the command's own if it has
+# one.
+LVM_SHELL_CONFIG = ('log { report_command_log = 1 '
+                    'command_log_selection = "all" }')
+# Return code of successful commands in the command log (ECMD_PROCESSED)
+LVM_SHELL_SUCCESS = 1
+
+
+class LVMShellError(Exception):
+    """The shell failed while running a command.
+
+    The command may or may not have been run.
+    """
+
+
+class LVMShellUnavailable(LVMShellError):
+    """The command was not sent to a shell, it can be run some other way."""
+
+
+class LVMShellStartError(LVMShellUnavailable):
+    """The shell could not be started."""
+
+
+class LVMShell(object):
+    """An lvm shell process running commands one at a time."""
+
+    def __init__(self, env=None, timeout=LVM_SHELL_TIMEOUT):
+        self.env = dict(env or {})
+        self.timeout = timeout
+        self.busy = False
+        self._process = None
+        self._report_fd = None
+
+    @property
+    def alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """Start the shell.
+
+        :raises LVMShellStartError: If the shell cannot be started, for any
+                                    reason.
+        """
+        env = dict(os.environ)
+        env.update(self.env)
+        env.setdefault('LC_ALL', 'C')
+        try:
+            report_r, report_w = os.pipe()
+        except OSError as exc:
+            raise LVMShellStartError('Cannot start the lvm shell: %s' % exc)
+        env['LVM_REPORT_FD'] = str(report_w)
+        try:
+            self._process = subprocess.Popen(
+                LVM_SHELL_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, env=env, pass_fds=(report_w,),
+                close_fds=True)
+        except Exception as exc:
+            os.close(report_r)
+            raise LVMShellStartError('Cannot start the lvm shell: %s' % exc)
+        finally:
+            os.close(report_w)
+        self._report_fd = report_r
+        try:
+            for fd in (self._process.stdout, self._process.stderr, report_r):
+                os.set_blocking(fd if isinstance(fd, int) else fd.fileno(),
+                                False)
+            self._read_until_prompt()
+        except Exception as exc:
+            self.close()
+            raise LVMShellStartError('Cannot start the lvm shell: %s' % exc)
+        LOG.debug('Started lvm shell with pid %s', self._process.pid)
+
+    def close(self):
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        for stream in (process.stdin, process.stdout, process.stderr):
+            stream.close()
+        os.close(self._report_fd)
+        self._report_fd = None
+
+    @staticmethod
+    def _quote(arg):
+        """Quote an argument the way the lvm shell splits its input line.
+
+        The shell splits words on whitespace, a word starting with a quote
+        ends at the same quote, without escapes, and a word starting with #
+        is a comment.
+        """
+        arg = str(arg)
+        if '\n' not in arg:
+            if (arg and len(arg.split()) == 1 and
+                    not arg.startswith(("'", '"', '#'))):
+                return arg
+            if "'" not in arg:
+                return "'%s'" % arg
+            if '"' not in arg:
+                return '"%s"' % arg
+        raise LVMShellUnavailable(
+            'Argument cannot be passed to the lvm shell: %r' % arg)
+
+    @staticmethod
+    def _get_shell_args(args):
+        """Add the arguments to get the JSON report and command log."""
+        args = list(args)
+        for i, arg in enumerate(args):
+            if arg == '--config' and i + 1 < len(args):
+                args[i + 1] = '%s %s' % (args[i + 1], LVM_SHELL_CONFIG)
+                break
+            if arg.startswith('--config='):
+                args[i] = '%s %s' % (arg, LVM_SHELL_CONFIG)
+                break
+        else:
+            args += ['--config', LVM_SHELL_CONFIG]
+        return args + ['--reportformat', 'json']
+
+    def _read_until_prompt(self):
+        """Read the output of the shell until it prints the prompt."""
+        stdout = stderr = report = b''
+        fds = {self._process.stdout.fileno(): 'stdout',
+               self._process.stderr.fileno(): 'stderr',
+               self._report_fd: 'report'}
+        deadline = time.monotonic() + self.timeout
+        while not stdout.endswith(LVM_SHELL_PROMPT):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LVMShellError('Timed out waiting for the lvm shell')
+            ready, _w, _x = select.select(list(fds), [], [], remaining)
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if not data:
+                    if fds[fd] == 'stdout':
+                        raise LVMShellError('The lvm shell exited')
+                    del fds[fd]
+                elif fds[fd] == 'stdout':
+                    stdout += data
+                elif fds[fd] == 'stderr':
+                    stderr += data
+                else:
+                    report += data
+        # Reports are written before the prompt
+        report += self._read_available(self._report_fd)
+        stderr += self._read_available(self._process.stderr.fileno())
+        return (stdout[:-len(LVM_SHELL_PROMPT)].decode('utf-8', 'replace'),
+                stderr.decode('utf-8', 'replace'),
+                report.decode('utf-8', 'replace'))
+
+    @staticmethod
+    def _read_available(fd):
+        data = b''
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    @staticmethod
+    def _parse_reports(report):
+        """Parse the concatenated JSON documents written to the report fd."""
+        decoder = json.JSONDecoder()
+        documents = []
+        index = 0
+        report = report.strip()
+        while index < len(report):
+            document, index = decoder.raw_decode(report, index)
+            documents.append(document)
+            while index < len(report) and report[index].isspace():
+                index += 1
+        return documents
+
+    @staticmethod
+    def _get_separator(args):
+        if '--separator' in args[:-1]:
+            return args[args.index('--separator') + 1]
+        return ' '
+
+    def run(self, args):
+        """Run an LVM command in the shell.
+
+        :param args: Command and arguments, ie: ['lvs', '-o', 'name'].
+        :returns: Tuple of (stdout, stderr) like the command would return,
+                  with the report rows as stdout.
+        :raises ProcessExecutionError: If the command fails.
+        :raises LVMShellUnavailable: If the command was not sent to the
+                                     shell.
+        :raises LVMShellError: If the shell failed after the command was
+                               sent, in which case it has been stopped.
+        """
+        line = ' '.join(self._quote(arg)
+                        for arg in self._get_shell_args(args)) + '\n'
+        if not self.alive:
+            self.close()
+            self.start()
+        try:
+            self._process.stdin.write(line.encode('utf-8'))
+            self._process.stdin.flush()
+            stdout, stderr, report = self._read_until_prompt()
+            documents = self._parse_reports(report)
+        except Exception as exc:
+            self.close()
+            if isinstance(exc, LVMShellError):
+                raise
+            raise LVMShellError(str(exc))
+
+        lines = []
+        ret_code = None
+        errors = []
+        separator = self._get_separator(args)
+        for document in documents:
+            for section in document.get('report', ()):
+                for rows in section.values():
+                    lines.extend(separator.join(str(v) for v in row.values())
+                                 for row in rows)
+            for entry in document.get('log', ()):
+                if entry.get('log_type') == 'status':
+                    ret_code = int(entry.get('log_ret_code', 0))
+                elif entry.get('log_type') == 'error':
+                    errors.append(entry.get('log_message', ''))
+        if ret_code is None:
+            self.close()
+            raise LVMShellError('No status in the lvm shell command log')
+
+        if lines:
+            stdout = '\n'.join(lines) + '\n' + stdout
+        if errors:
+            stderr += '\n'.join(e for e in errors if e not in stderr)
+        cmd = ' '.join(args)
+        if ret_code != LVM_SHELL_SUCCESS:
+            raise putils.ProcessExecutionError(stdout=stdout, stderr=stderr,
+                                               exit_code=ret_code, cmd=cmd)
+        return stdout, stderr
+
+
+# Shells by (vg_name, env), and when they last failed to start
+_shells: dict = {}
+_start_failures: dict = {}
+_shells_lock = threading.Lock()
+
+
+def _acquire_shell(key, env):
+    """Get an idle shell for a VG and environment, creating it if needed."""
+    with _shells_lock:
+        failed_at = _start_failures.get(key)
+        if (failed_at is not None and
+                time.monotonic() - failed_at < LVM_SHELL_RESTART_INTERVAL):
+            raise LVMShellUnavailable('The lvm shell failed to start recently')
+        shells = _shells.setdefault(key, [])
+        for shell in shells:
+            if not shell.busy:
+                break
+        else:
+            if len(shells) >= LVM_SHELLS_PER_VG:
+                raise LVMShellUnavailable('All the lvm shells are busy')
+            shell = LVMShell(env)
+            shells.append(shell)
+        shell.busy = True
+        return shell
+
+
+def _release_shell(shell):
+    with _shells_lock:
+        shell.busy = False
+
+
+@os_brick.privileged.default.entrypoint
+def execute(vg_name, env, *args):
+    """Run an LVM command in a shell for a volume group and environment.
+
+    :param vg_name: Name of the volume group, or None, to select the shell.
+    :param env: Dictionary with the LVM environment variables, ie:
+                {'LVM_SYSTEM_DIR': '/etc/cinder'}.
+    :returns: Tuple of (stdout, stderr).
+    :raises ProcessExecutionError: If the command fails.
+    :raises LVMShellUnavailable: If the command was not sent to a shell
+                                 because none is available.
+    :raises LVMShellError: If the shell failed while running the command.
+    """
+    key = (vg_name, tuple(sorted(env.items())))
+    shell = _acquire_shell(key, env)
+    try:
+        result = shell.run(args)
+    except LVMShellStartError as exc:
+        LOG.warning('%s, not using it for %s seconds', exc,
+                    LVM_SHELL_RESTART_INTERVAL)
+        with _shells_lock:
+            _start_failures[key] = time.monotonic()
+        raise
+    finally:
+        _release_shell(shell)
+    with _shells_lock:
+        _start_failures.pop(key, None)
+    return result
+
+
+@os_brick.privileged.default.entrypoint
+def close_shells():
+    """Stop all the idle lvm shells and forget the start failures."""
+    with _shells_lock:
+        shells = [shell for key_shells in _shells.values()
+                  for shell in key_shells if not shell.busy]
+        for key in list(_shells):
+            _shells[key] = [shell for shell in _shells[key] if shell.busy]
+        _start_failures.clear()
+        for shell in shells:
+            shell.busy = True
+    for shell in shells:
+        shell.close()
@@ -71,3 +71,53 @@ def create_hostnqn():
         LOG.warning("Could not generate host nqn: %s" % str(e))
 
     return host_nqn
+
+
+NVME_FABRICS = '/dev/nvme-fabrics'
+NVME_CTRL_SYSFS_PATH = '/sys/class/nvme'
+
+
+@os_brick.privileged.default.entrypoint
+def connect_ctrl(options):
+    """Create an NVMe-oF controller without using nvme-cli.
+
+    Writes the fabrics options string to /dev/nvme-fabrics, like nvme connect
+    does, and reads back the reply the kernel gives on success, for example
+    "instance=3,cntlid=1".
+
+    The write only returns once the kernel has connected to the target (or
+    failed to do so), and errors are raised as OSError, for example EALREADY
+    if the controller already exists.
+
+    :param options: Dictionary of fabrics options, in the order they are to
+                    be written, ie: {'transport': 'tcp', 'traddr': '10.0.0.1',
+                    'trsvcid': '4420', 'nqn': 'nqn...', 'hostnqn': 'nqn...'}.
+                    Options with None value are ignored.
+    :returns: Name of the new controller, ie: 'nvme3'
+    """
+    options_str = ','.join('%s=%s' % (key, value)
+                           for key, value in options.items()
+                           if value is not None)
+    LOG.debug('Writing %s to %s', options_str, NVME_FABRICS)
+    fd = os.open(NVME_FABRICS, os.O_RDWR)
+    try:
+        os.write(fd, options_str.encode())
+        reply = os.read(fd, 4096).decode()
+    finally:
+        os.close(fd)
+
+    values = dict(field.split('=', 1)
+                  for field in reply.strip().split(',') if '=' in field)
+    if 'instance' not in values:
+        raise OSError(errno.EIO,
+                      'Unexpected reply from %s: %s' % (NVME_FABRICS, reply))
+    return 'nvme' + values['instance']
+
+
+@os_brick.privileged.default.entrypoint
+def delete_ctrl(ctrl):
+    """Remove an NVMe-oF controller using sysfs instead of nvme-cli."""
+    path = os.path.join(NVME_CTRL_SYSFS_PATH, ctrl, 'delete_controller')
+    LOG.debug('Deleting NVMe controller %s', ctrl)
+    with open(path, 'w') as f:
+        f.write('1')
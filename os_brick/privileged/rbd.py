@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import re
+
 from oslo_utils import fileutils
 from oslo_utils import importutils
 
@@ -52,6 +54,23 @@ def root_create_ceph_conf(monitor_ips, monitor_ports, cluster_name, user,
                                           cluster_name, user, keyring)
 
 
+@os_brick.privileged.default.entrypoint
+def root_release_ceph_conf(path):
+    """Release a .conf file from root_create_ceph_conf."""
+    get_rbd_class()
+    return RBDConnector._release_ceph_conf(path)
+
+
+@os_brick.privileged.default.entrypoint
+def root_get_rbd_map_options(device):
+    """Get the options of a mapped rbd device, only readable by root."""
+    # The device id is used to build the sysfs path
+    if not re.fullmatch(r'/dev/rbd(\d+)', device):
+        raise ValueError('Invalid rbd device %s' % device)
+    get_rbd_class()
+    return RBDConnector.get_rbd_map_options(device)
+
+
 @os_brick.privileged.default.entrypoint
 def check_valid_path(path):
     get_rbd_class()
@@ -238,3 +238,24 @@ def link_root(target, link_name, force=True):
         except FileNotFoundError:
             pass
     os.symlink(target, link_name)
+
+
+@privileged.default.entrypoint
+def write_sys(path, content):
+    """Write a string to a sysfs file with sys admin privileges.
+
+    This is the in-process equivalent of "echo content | tee -a path", it
+    returns once the kernel has processed the write, for example after the
+    SCSI scan requested on a host's scan file has completed.
+
+    Only files in /sys can be written, symlinks are resolved before checking
+    it and PermissionError is raised for any other path.
+    """
+    real_path = os.path.realpath(path)
+    if not real_path.startswith('/sys/'):
+        raise PermissionError('Refusing to write to %s, it is not in /sys' %
+                              path)
+    LOG.debug('Writing %(content)r to %(path)s',
+              {'content': content, 'path': real_path})
+    with open(real_path, 'w') as f:
+        f.write(content)
@@ -12,6 +12,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
 import os
 from unittest import mock
 
@@ -23,6 +24,7 @@ from os_brick.initiator.connectors import fibre_channel
 from os_brick.initiator import linuxfc
 from os_brick.initiator import linuxscsi
 from os_brick.tests.initiator import test_connector
+from os_brick import utils
 
 
 @ddt.ddt
@@ -32,6 +34,8 @@ class FibreChannelConnectorTestCase(test_connector.ConnectorTestCase):
         super(FibreChannelConnectorTestCase, self).setUp()
         self.connector = fibre_channel.FibreChannelConnector(
             None, execute=self.fake_execute, use_multipath=False)
+        # Scans are written in-process through privsep
+        self.mock_object(linuxfc.priv_rootwrap, 'write_sys')
         self.assertIsNotNone(self.connector)
         self.assertIsNotNone(self.connector._linuxfc)
         self.assertIsNotNone(self.connector._linuxscsi)
@@ -346,7 +350,9 @@ class FibreChannelConnectorTestCase(test_connector.ConnectorTestCase):
             'tee -a /sys/block/sdb/device/delete',
             'tee -a /sys/block/sdc/device/delete',
         ]
-        self.assertEqual(expected_commands, self.cmds)
+        # Paths are removed concurrently
+        self.assertEqual(expected_commands[0], self.cmds[0])
+        self.assertCountEqual(expected_commands, self.cmds)
         return connection_info
 
     @mock.patch.object(linuxscsi.LinuxSCSI, 'find_multipath_device')
@@ -504,6 +510,306 @@ class FibreChannelConnectorTestCase(test_connector.ConnectorTestCase):
                                                     wwn)
         new_size = self.connector.extend_volume(connection_info['data'])
         self.assertEqual(fake_new_size, new_size)
+        mock_scsi_extend.assert_called_once_with(
+            ['/dev/vdx'], use_multipath=False, concurrent=False)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.monotonic')
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'rescan_hosts')
+    @mock.patch.object(base.BaseLinuxConnector, 'check_valid_device',
+                       return_value=True)
+    @mock.patch('os.path.exists')
+    def test__wait_for_devices_discovery_present(self, exists_mock,
+                                                 valid_mock, rescan_mock,
+                                                 monotonic_mock, sleep_mock):
+        exists_mock.side_effect = [False, True]
+        monotonic_mock.return_value = 0
+        res = self.connector._wait_for_devices_discovery(
+            mock.sentinel.hbas, [mock.sentinel.props], [['/dev/a', '/dev/b']])
+        self.assertEqual(['/dev/b'], res)
+        self.assertEqual(0, self.connector.tries)
+        valid_mock.assert_called_once_with('/dev/b')
+        rescan_mock.assert_not_called()
+        sleep_mock.assert_not_called()
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.monotonic')
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'rescan_hosts')
+    @mock.patch.object(base.BaseLinuxConnector, 'check_valid_device')
+    @mock.patch('os.path.exists')
+    def test__wait_for_devices_discovery_backoff(self, exists_mock,
+                                                 valid_mock, rescan_mock,
+                                                 monotonic_mock, sleep_mock):
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        sleep_mock.side_effect = sleep
+        monotonic_mock.side_effect = lambda: clock[0]
+        # The link appears 2.5 seconds after the first rescan and the device
+        # is not valid until it has been rescanned again
+        exists_mock.side_effect = lambda path: clock[0] >= 2.5
+        valid_mock.side_effect = lambda path: rescan_mock.call_count == 3
+
+        res = self.connector._wait_for_devices_discovery(
+            mock.sentinel.hbas, [mock.sentinel.props], [['/dev/a']])
+
+        self.assertEqual(['/dev/a'], res)
+        # Rescans at 0, 1, and 3 seconds
+        self.assertEqual(3, self.connector.tries)
+        rescan_mock.assert_has_calls(
+            [mock.call(mock.sentinel.hbas, mock.sentinel.props)] * 3)
+        # Invalid device is only checked again after a rescan
+        self.assertEqual(2, valid_mock.call_count)
+        self.assertAlmostEqual(3.0, clock[0], delta=0.5)
+        sleep_mock.assert_called_with(fibre_channel.DEVICE_POLL_INTERVAL)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.monotonic')
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'rescan_hosts')
+    @mock.patch('os.path.exists', return_value=False)
+    def test__wait_for_devices_discovery_max_backoff(self, exists_mock,
+                                                     rescan_mock,
+                                                     monotonic_mock,
+                                                     sleep_mock):
+        clock = [0.0]
+        rescans = []
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        sleep_mock.side_effect = sleep
+        monotonic_mock.side_effect = lambda: clock[0]
+        rescan_mock.side_effect = lambda *args: rescans.append(clock[0])
+        self.connector.device_scan_attempts = 12
+
+        self.assertRaises(exception.NoFibreChannelVolumeDeviceFound,
+                          self.connector._wait_for_devices_discovery,
+                          mock.sentinel.hbas, [mock.sentinel.props],
+                          [['/dev/a']])
+
+        self.assertEqual(12, len(rescans))
+        gaps = [round(b - a) for a, b in zip(rescans, rescans[1:])]
+        self.assertEqual([1, 2, 4, 8] + [fibre_channel.RESCAN_MAX_BACKOFF] * 7,
+                         gaps)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.monotonic')
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'rescan_hosts')
+    @mock.patch('os.path.exists', return_value=False)
+    def test__wait_for_devices_discovery_not_found(self, exists_mock,
+                                                   rescan_mock,
+                                                   monotonic_mock,
+                                                   sleep_mock):
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        sleep_mock.side_effect = sleep
+        monotonic_mock.side_effect = lambda: clock[0]
+        self.connector.device_scan_attempts = 3
+
+        self.assertRaises(exception.NoFibreChannelVolumeDeviceFound,
+                          self.connector._wait_for_devices_discovery,
+                          mock.sentinel.hbas, [mock.sentinel.props],
+                          [['/dev/a']])
+        self.assertEqual(3, rescan_mock.call_count)
+        # Gave up 4 seconds after the last rescan
+        self.assertAlmostEqual(7.0, clock[0], delta=0.5)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.monotonic', return_value=0)
+    @mock.patch.object(fibre_channel.FibreChannelConnector, '_rescan_hosts')
+    @mock.patch.object(base.BaseLinuxConnector, 'check_valid_device',
+                       return_value=True)
+    @mock.patch('os.path.exists')
+    def test__wait_for_devices_discovery_multiple(self, exists_mock,
+                                                  valid_mock, rescan_mock,
+                                                  monotonic_mock, sleep_mock):
+        present = {'/dev/a2'}
+        exists_mock.side_effect = lambda path: path in present
+
+        def rescan(hbas, props_list):
+            self.assertEqual([mock.sentinel.props2], props_list)
+            present.add('/dev/b1')
+
+        rescan_mock.side_effect = rescan
+        res = self.connector._wait_for_devices_discovery(
+            mock.sentinel.hbas, [mock.sentinel.props1, mock.sentinel.props2],
+            [['/dev/a1', '/dev/a2'], ['/dev/b1', '/dev/b2']])
+
+        self.assertEqual(['/dev/a2', '/dev/b1'], res)
+        rescan_mock.assert_called_once_with(mock.sentinel.hbas, mock.ANY)
+        self.assertEqual(1, self.connector.tries)
+
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'rescan_hosts')
+    def test__rescan_hosts_groups(self, rescan_mock):
+        props1 = {'targets': [('wwpn1', 1), ('wwpn2', 1)]}
+        props2 = {'targets': [('wwpn1', 2), ('wwpn2', 2)],
+                  'enable_wildcard_scan': False}
+        props3 = {'targets': [('wwpn3', 1)]}
+        self.connector._rescan_hosts(mock.sentinel.hbas,
+                                     [props1, props2, props3])
+        rescan_mock.assert_has_calls(
+            [mock.call(mock.sentinel.hbas,
+                       {'targets': [('wwpn1', 1), ('wwpn2', 1),
+                                    ('wwpn1', 2), ('wwpn2', 2)],
+                        'enable_wildcard_scan': False}),
+             mock.call(mock.sentinel.hbas, props3)])
+        self.assertEqual(2, rescan_mock.call_count)
+
+    def test__merge_connection_properties_initiator_map(self):
+        props1 = self.connector._add_targets_to_connection_properties(
+            {'target_wwn': ['WWPN1', 'wwpn2'], 'target_lun': 1,
+             'initiator_target_map': {'init1': ['wwpn1'],
+                                      'init2': ['wwpn2']}})
+        props2 = self.connector._add_targets_to_connection_properties(
+            {'target_wwn': ['wwpn1', 'wwpn2'], 'target_lun': 2,
+             'initiator_target_map': {'init1': ['wwpn1', 'wwpn2']}})
+        res = self.connector._merge_connection_properties([props1, props2])
+        expected = {
+            'targets': [('wwpn1', 1), ('wwpn2', 1), ('wwpn1', 2),
+                        ('wwpn2', 2)],
+            'enable_wildcard_scan': True,
+            'initiator_target_map': {'init1': ['wwpn1', 'wwpn2'],
+                                     'init2': ['wwpn2']},
+            'initiator_target_lun_map': {
+                'init1': [('wwpn1', 1), ('wwpn1', 2), ('wwpn2', 2)],
+                'init2': [('wwpn2', 1)]},
+        }
+        self.assertEqual(expected, res)
+
+        # Initiator map is ignored if a volume doesn't have it
+        del props2['initiator_target_map']
+        res = self.connector._merge_connection_properties([props1, props2])
+        self.assertNotIn('initiator_target_map', res)
+        self.assertNotIn('initiator_target_lun_map', res)
+
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'get_fc_hbas_info')
+    @mock.patch.object(fibre_channel.FibreChannelConnector,
+                       '_wait_for_devices_discovery')
+    @mock.patch.object(fibre_channel.FibreChannelConnector,
+                       '_discover_mpath_device')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_scsi_wwn')
+    def test_connect_volumes(self, wwn_mock, discover_mock, wait_mock,
+                             hbas_mock):
+        self.connector.use_multipath = True
+        hbas_mock.side_effect = self.fake_get_fc_hbas_info
+        wait_mock.return_value = ['/dev/disk/by-path/a', '/dev/disk/by-path/b']
+        wwn_mock.side_effect = ['wwn1', 'wwn2']
+        discover_mock.side_effect = [('/dev/dm-1', 'wwn1'),
+                                     ('/dev/disk/by-path/b', None)]
+        props1 = {'target_wwn': ['1234567890123456'], 'target_lun': 1}
+        props2 = {'target_wwn': ['1234567890123456'], 'target_lun': 2,
+                  'encrypted': False}
+
+        res = self.connector.connect_volumes([props1, props2])
+
+        self.assertEqual([{'type': 'block', 'scsi_wwn': 'wwn1',
+                           'multipath_id': 'wwn1', 'path': '/dev/dm-1'},
+                          {'type': 'block', 'scsi_wwn': 'wwn2',
+                           'path': '/dev/disk/by-path/b'}],
+                         res)
+        hbas_mock.assert_called_once_with()
+        wait_mock.assert_called_once_with(
+            self.fake_get_fc_hbas_info(), [props1, props2],
+            [['/dev/disk/by-path/pci-0000:05:00.2-fc-0x1234567890123456-'
+              'lun-1'],
+             ['/dev/disk/by-path/pci-0000:05:00.2-fc-0x1234567890123456-'
+              'lun-2']])
+        discover_mock.assert_has_calls(
+            [mock.call('wwn1', props1, '/dev/disk/by-path/a'),
+             mock.call('wwn2', props2, '/dev/disk/by-path/b')],
+            any_order=True)
+
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'get_fc_hbas_info')
+    @mock.patch.object(fibre_channel.FibreChannelConnector,
+                       '_wait_for_devices_discovery')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_scsi_wwn')
+    def test_connect_volumes_fail(self, wwn_mock, wait_mock, hbas_mock):
+        hbas_mock.side_effect = self.fake_get_fc_hbas_info
+        wait_mock.return_value = ['/dev/disk/by-path/a', '/dev/disk/by-path/b']
+        wwn_mock.side_effect = ['wwn1', exception.BrickException]
+        props1 = {'target_wwn': ['1234567890123456'], 'target_lun': 1}
+        props2 = {'target_wwn': ['1234567890123456'], 'target_lun': 2}
+
+        self.assertRaises(exception.BrickException,
+                          self.connector.connect_volumes, [props1, props2])
+
+    @mock.patch('os.path.realpath', return_value='/dev/sdb')
+    @mock.patch.object(utils.priv_rootwrap, 'link_root')
+    @mock.patch.object(fibre_channel.FibreChannelConnector,
+                       '_connect_volumes')
+    def test_connect_volumes_encrypted(self, connect_mock, link_mock,
+                                       realpath_mock):
+        connect_mock.return_value = [{'type': 'block', 'path': '/dev/sdb'},
+                                     {'type': 'block', 'path': '/dev/sdc'}]
+        props1 = {'encrypted': True}
+        props2 = {'encrypted': False}
+
+        res = self.connector.connect_volumes([props1, props2])
+
+        self.assertEqual('/dev/disk/by-id/os-brick+dev+sdb', res[0]['path'])
+        self.assertEqual('/dev/sdc', res[1]['path'])
+        link_mock.assert_called_once_with('/dev/sdb', res[0]['path'],
+                                          force=True)
+
+    @mock.patch.object(fibre_channel.executor, 'Thread')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'wait_for_volumes_removal')
+    def test__remove_devices_concurrent(self, wait_mock, thread_mock):
+        devices = [{'device': '/dev/sdb'}, {'device': '/dev/sdc'}]
+        self.connector._remove_devices({}, devices,
+                                       {'path': '/dev/disk/by-id/dm-uuid-x'})
+        thread_mock.assert_has_calls(
+            [mock.call(target=self.connector._remove_device,
+                       args=('/dev/sdb', '/dev/disk/by-id/dm-uuid-x', True,
+                             [])),
+             mock.call(target=self.connector._remove_device,
+                       args=('/dev/sdc', '/dev/disk/by-id/dm-uuid-x', True,
+                             []))],
+            any_order=True)
+        self.assertEqual(2, thread_mock.return_value.start.call_count)
+        self.assertEqual(2, thread_mock.return_value.join.call_count)
+        wait_mock.assert_called_once_with(
+            ['sdb', 'sdc'], timeout=fibre_channel.REMOVAL_WAIT_TIMEOUT)
+
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'wait_for_volumes_removal')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'remove_scsi_device')
+    def test__remove_devices_fail(self, remove_mock, wait_mock):
+        error = exception.ExceptionChainer()
+        devices = [{'device': '/dev/sdb'}, {'device': '/dev/sdc'},
+                   {'device': '/dev/sdd'}]
+        remove_mock.side_effect = lambda dev, flush: (
+            self._raise(error) if dev == '/dev/sdc' else None)
+
+        exc = self.assertRaises(exception.ExceptionChainer,
+                                self.connector._remove_devices,
+                                {}, devices, {})
+
+        self.assertIs(error, exc)
+        remove_mock.assert_has_calls(
+            [mock.call('/dev/sdb', flush=False),
+             mock.call('/dev/sdc', flush=False),
+             mock.call('/dev/sdd', flush=False)],
+            any_order=True)
+        wait_mock.assert_not_called()
+
+    @staticmethod
+    def _raise(exc):
+        raise exc
+
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'wait_for_volumes_removal',
+                       side_effect=exception.VolumePathNotRemoved(
+                           volume_path=['/dev/sdb']))
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'remove_scsi_device')
+    def test__remove_devices_not_removed(self, remove_mock, wait_mock):
+        self.connector._remove_devices({}, [{'device': '/dev/sdb'}],
+                                       {'path': '/dev/sdb'})
+        remove_mock.assert_called_once_with('/dev/sdb', flush=True)
+        wait_mock.assert_called_once_with(
+            ['sdb'], timeout=fibre_channel.REMOVAL_WAIT_TIMEOUT)
 
     @mock.patch.object(os.path, 'isdir')
     def test_get_all_available_volumes_path_not_dir(self, mock_isdir):
@@ -512,7 +818,8 @@ class FibreChannelConnectorTestCase(test_connector.ConnectorTestCase):
         actual = self.connector.get_all_available_volumes()
         self.assertCountEqual(expected, actual)
 
-    @mock.patch('eventlet.greenthread.sleep', mock.Mock())
+    @mock.patch('time.sleep', mock.Mock())
+    @mock.patch('time.monotonic', side_effect=itertools.count(step=0.5))
     @mock.patch.object(linuxscsi.LinuxSCSI, 'find_multipath_device')
     @mock.patch.object(linuxscsi.LinuxSCSI, 'wait_for_rw')
     @mock.patch.object(os.path, 'exists', return_value=True)
@@ -530,7 +837,8 @@ class FibreChannelConnectorTestCase(test_connector.ConnectorTestCase):
                                              realpath_mock,
                                              exists_mock,
                                              wait_for_rw_mock,
-                                             find_mp_dev_mock):
+                                             find_mp_dev_mock,
+                                             monotonic_mock):
 
         check_valid_device_mock.return_value = False
         self.assertRaises(exception.NoFibreChannelVolumeDeviceFound,
@@ -814,4 +1122,6 @@ class FibreChannelConnectorTestCase(test_connector.ConnectorTestCase):
             'tee -a /sys/block/sdb/device/delete',
             'tee -a /sys/block/sdc/device/delete',
         ]
-        self.assertEqual(expected_commands, self.cmds)
+        # Paths are removed concurrently
+        self.assertEqual(expected_commands[0], self.cmds[0])
+        self.assertCountEqual(expected_commands, self.cmds)
@@ -12,7 +12,6 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
-import glob
 import http.client
 import queue
 from unittest import mock
@@ -20,6 +19,7 @@ from unittest.mock import mock_open
 
 from os_brick import exception
 from os_brick.initiator.connectors import lightos
+from os_brick.initiator import linuxblock
 from os_brick.initiator import linuxscsi
 from os_brick.privileged import lightos as priv_lightos
 from os_brick.tests.initiator import test_connector
@@ -155,7 +155,7 @@ class LightosConnectorTestCase(test_connector.ConnectorTestCase):
 
     @mock.patch.object(lightos.LightOSConnector,
                        '_check_device_exists_reading_block_class',
-                       return_value=("/dev/nvme0n1"))
+                       return_value=("/dev/nvme0n1", None))
     def test_get_device_by_uuid_succeed_with_block_class(self, execute_mock):
         self.assertEqual(self.connector._get_device_by_uuid(FAKE_VOLUME_UUID),
                          "/dev/nvme0n1")
@@ -165,10 +165,15 @@ class LightosConnectorTestCase(test_connector.ConnectorTestCase):
                        side_effect=[None, False, "/dev/nvme0n1"])
     @mock.patch.object(lightos.LightOSConnector,
                        '_check_device_exists_reading_block_class',
-                       side_effect=[None, False, "/dev/nvme0n1"])
+                       side_effect=[(None, mock.sentinel.topology1),
+                                    (None, mock.sentinel.topology2)])
     def test_get_device_by_uuid_many_attempts(self, execute_mock, glob_mock):
         self.assertEqual(self.connector._get_device_by_uuid(FAKE_VOLUME_UUID),
                          '/dev/nvme0n1')
+        # The topology of the previous attempt is refreshed
+        execute_mock.assert_has_calls(
+            [mock.call(FAKE_VOLUME_UUID, None),
+             mock.call(FAKE_VOLUME_UUID, mock.sentinel.topology1)])
 
     @mock.patch.object(lightos.LightOSConnector, 'dsc_connect_volume',
                        return_value=None)
@@ -231,10 +236,41 @@ class LightosConnectorTestCase(test_connector.ConnectorTestCase):
         self.assertIsNone(self.connector._check_device_exists_using_dev_lnk(
             FAKE_VOLUME_UUID))
 
-    @mock.patch.object(glob, "glob", return_value=['/path/nvme0n1/wwid'])
-    @mock.patch("builtins.open", new_callable=mock_open,
-                read_data=f"uuid.{FAKE_VOLUME_UUID}\n")
-    def test_check_device_exists_reading_block_class(self, mock_glob, m_open):
-        found_dev = self.connector._check_device_exists_reading_block_class(
-            FAKE_VOLUME_UUID)
+    @mock.patch.object(linuxblock.BlockDeviceTopology, 'snapshot')
+    def test_check_device_exists_reading_block_class(self, mock_snapshot):
+        wwid = f"uuid.{FAKE_VOLUME_UUID}"
+        mock_snapshot.return_value = linuxblock.BlockDeviceTopology({
+            'nvme0c0n1': linuxblock.BlockDevice(
+                'nvme0c0n1', '0:0', 0, False, None, None, wwid, None, None,
+                None, (), ()),
+            'nvme0n1': linuxblock.BlockDevice(
+                'nvme0n1', '259:0', 0, False, None, None, wwid, None, None,
+                None, (), ()),
+        })
+        found_dev, topology = (
+            self.connector._check_device_exists_reading_block_class(
+                FAKE_VOLUME_UUID))
         self.assertEqual("/dev/nvme0n1", found_dev)
+        self.assertIs(mock_snapshot.return_value, topology)
+        mock_snapshot.assert_called_once_with(patterns=('nvme*',))
+
+    @mock.patch.object(linuxblock.BlockDeviceTopology, 'snapshot')
+    def test_check_device_exists_reading_block_class_none(self,
+                                                          mock_snapshot):
+        mock_snapshot.return_value = linuxblock.BlockDeviceTopology({})
+        self.assertEqual(
+            (None, mock_snapshot.return_value),
+            self.connector._check_device_exists_reading_block_class(
+                FAKE_VOLUME_UUID))
+
+    @mock.patch.object(linuxblock.BlockDeviceTopology, 'snapshot')
+    def test_check_device_exists_reading_block_class_refresh(self,
+                                                             mock_snapshot):
+        topology = mock.Mock()
+        topology.refresh.return_value.get_by_wwid.return_value = ()
+        self.assertEqual(
+            (None, topology.refresh.return_value),
+            self.connector._check_device_exists_reading_block_class(
+                FAKE_VOLUME_UUID, topology))
+        topology.refresh.assert_called_once_with()
+        mock_snapshot.assert_not_called()
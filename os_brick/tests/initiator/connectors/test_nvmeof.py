@@ -11,11 +11,13 @@
 #    under the License.
 
 import builtins
-import glob
+import errno
 import os.path
+import threading
 from unittest import mock
 
 import ddt
+import fixtures
 from oslo_concurrency import processutils as putils
 
 from os_brick import exception
@@ -90,13 +92,6 @@ nvme_list_subsystems_stdout = """
  }
 """
 
-nvme_list_stdout = """
-Node          SN      Model Namespace Usage            Format      FW Rev
-------------- ------- ----- --------- ---------------- ----------- -------
-/dev/nvme0n1  AB12345 s123  12682     0.00 B / 2.15 GB 512 B + 0 B 2.1.0.0
-/dev/nvme0n2  AB12345 s123  12683     0.00 B / 1.07 GB 512 B + 0 B 2.1.0.0
-"""
-
 
 @ddt.ddt
 class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
@@ -108,6 +103,85 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
         self.connector = nvmeof.NVMeOFConnector(None,
                                                 execute=self.fake_execute,
                                                 use_multipath=False)
+        self.mock_object(nvmeof.NVMeIndex, '_instance',
+                         nvmeof.NVMeIndex(use_uevents=False))
+
+    def test_concurrent_connect_disabled_by_default(self):
+        self.assertFalse(self.connector.concurrent_connect)
+
+    def _setup_nvme_sysfs(self):
+        """Fake sysfs with a multipath and a non multipath subsystem."""
+        self.sysfs = self.useFixture(fixtures.TempDir()).path
+        self.mock_object(nvmeof, 'SYSFS_PATH', self.sysfs)
+        # nvme0 and nvme1 are paths to subsystem 0, nvme2 is not multipathed
+        for ctrl, state, nqn, address, namespaces in (
+                ('nvme0', 'live', TARGET_NQN, 'traddr=10.0.0.1,trsvcid=4420',
+                 ('nvme0c0n1', 'nvme0c0n2')),
+                ('nvme1', 'connecting', TARGET_NQN,
+                 'traddr=10.0.0.2,trsvcid=4420', ('nvme0c1n1', 'nvme0c1n2')),
+                ('nvme2', 'live', 'nqn.other', 'traddr=10.0.0.3,trsvcid=4420',
+                 ('nvme2n1',))):
+            self._write_sysfs('class/nvme', ctrl, state=state, subsysnqn=nqn,
+                              address=address)
+            for ns in namespaces:
+                os.makedirs(os.path.join(self.sysfs, 'class/nvme', ctrl, ns))
+        self._write_sysfs('block', 'nvme0n1', dev='259:0', size='2097152',
+                          uuid=VOL_UUID,
+                          nguid='4941ef75-95b8-ee97-8ccf-096800f205c6',
+                          wwid='eui.4941ef7595b8ee978ccf096800f205c6')
+        self._write_sysfs('block', 'nvme0n2', dev='259:1', size='4194304',
+                          uuid='00000000-0000-0000-0000-000000000000',
+                          wwid='eui.1234')
+        self._write_sysfs('block', 'nvme2n1', dev='259:2', size='1024',
+                          wwid='eui.0025388b91c2D6E4')
+        self._write_sysfs('block', 'nvme0c0n1', dev='259:3')
+        os.makedirs(os.path.join(self.sysfs, 'block', 'sda'))
+
+    def _write_sysfs(self, directory, name, **attrs):
+        path = os.path.join(self.sysfs, directory, name)
+        os.makedirs(path, exist_ok=True)
+        for attr, value in attrs.items():
+            with open(os.path.join(path, attr), 'w') as f:
+                f.write(value + '\n')
+
+    def test_get_nvme_namespaces(self):
+        self._setup_nvme_sysfs()
+        res = nvmeof.NVMeOFConnector.get_nvme_namespaces()
+        expected = [
+            nvmeof.NVMeNamespace(
+                name='nvme0n1',
+                controllers=(('nvme0', 'live'), ('nvme1', 'connecting')),
+                uuid=VOL_UUID,
+                nguid='4941ef75-95b8-ee97-8ccf-096800f205c6',
+                wwid='eui.4941ef7595b8ee978ccf096800f205c6',
+                size=1073741824),
+            nvmeof.NVMeNamespace(
+                name='nvme0n2',
+                controllers=(('nvme0', 'live'), ('nvme1', 'connecting')),
+                uuid='00000000-0000-0000-0000-000000000000',
+                nguid=None,
+                wwid='eui.1234',
+                size=2147483648),
+            nvmeof.NVMeNamespace(
+                name='nvme2n1',
+                controllers=(('nvme2', 'live'),),
+                uuid=None,
+                nguid=None,
+                wwid='eui.0025388b91c2D6E4',
+                size=524288)]
+        self.assertEqual(expected, res)
+        self.assertEqual('/dev/nvme0n1', res[0].path)
+        self.assertTrue(res[0].live)
+        self.assertEqual([], self.cmds)
+
+    def test_get_nvme_namespaces_no_sysfs(self):
+        self.mock_object(nvmeof, 'SYSFS_PATH', '/nonexistent')
+        self.assertEqual([], nvmeof.NVMeOFConnector.get_nvme_namespaces())
+
+    def test_nvme_namespace_not_live(self):
+        ns = nvmeof.NVMeNamespace('nvme0n1', (('nvme0', 'connecting'),),
+                                  None, None, None, None)
+        self.assertFalse(ns.live)
 
     @mock.patch.object(priv_rootwrap, 'custom_execute', autospec=True)
     def test_nvme_present(self, mock_execute):
@@ -213,6 +287,8 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
 
     @mock.patch.object(nvmeof.NVMeOFConnector, '_execute', autospec=True)
     def test__try_connect_nvme_idempotent(self, mock_execute):
+        options = {'transport': 'tcp', 'nqn': TARGET_NQN, 'traddr': 'portal',
+                   'trsvcid': 4420, 'hostnqn': None}
         cmd = [
             'nvme', 'connect',
             '-t', 'tcp',
@@ -220,11 +296,134 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
             '-a', 'portal',
             '-s', 4420]
         mock_execute.side_effect = putils.ProcessExecutionError(exit_code=70)
-        self.connector._try_connect_nvme(cmd)
+        self.connector._try_connect_nvme(options)
         mock_execute.assert_called_once_with(self.connector,
                                              *cmd,
                                              root_helper=None,
-                                             run_as_root=True)
+                                             run_as_root=True,
+                                             check_exit_code=True)
+
+    def _setup_host_identity(self):
+        self.mock_object(utils, 'get_host_nqn', return_value='nqn.host')
+        hostid = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'hostid')
+        with open(hostid, 'w') as f:
+            f.write('a1b2c3d4-0000-1111-2222-333344445555\n')
+        self.mock_object(nvmeof, 'NVME_HOSTID_FILE', hostid)
+        return {'hostnqn': 'nqn.host',
+                'hostid': 'a1b2c3d4-0000-1111-2222-333344445555'}
+
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl')
+    def test__try_connect_nvme_fabrics_device_idempotent(self, mock_connect):
+        host = self._setup_host_identity()
+        self.connector.use_fabrics_device = True
+        mock_connect.side_effect = OSError(errno.EALREADY, 'Already')
+        options = {'transport': 'tcp', 'nqn': TARGET_NQN}
+        self.connector._try_connect_nvme(options)
+        mock_connect.assert_called_once_with(dict(options, **host))
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_nvme_cli')
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl', return_value='nvme3')
+    def test_connect_nvme_fabrics_device(self, mock_connect, mock_cli):
+        host = self._setup_host_identity()
+        self.connector.use_fabrics_device = True
+        options = {'transport': 'tcp', 'nqn': TARGET_NQN}
+        self.connector.connect_nvme(self.connector, options, timeout=30)
+        mock_connect.assert_called_once_with(dict(options, **host))
+        mock_cli.assert_not_called()
+
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl', return_value='nvme3')
+    def test_connect_nvme_fabrics_device_host_options(self, mock_connect):
+        self._setup_host_identity()
+        self.mock_object(nvmeof, 'NVME_HOSTID_FILE', '/nonexistent')
+        self.connector.use_fabrics_device = True
+        options = {'transport': 'tcp', 'nqn': TARGET_NQN,
+                   'hostnqn': 'nqn.volume'}
+        self.connector.connect_nvme(self.connector, options)
+        # Host NQN from the connection properties is kept
+        mock_connect.assert_called_once_with(dict(options))
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_nvme_cli')
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl')
+    def test_connect_nvme_fabrics_device_timeout(self, mock_connect,
+                                                 mock_cli):
+        self._setup_host_identity()
+        self.connector.use_fabrics_device = True
+        unblock = threading.Event()
+        self.addCleanup(unblock.set)
+        mock_connect.side_effect = lambda options: unblock.wait(10)
+        self.assertRaises(exception.ExecutionTimeout,
+                          self.connector.connect_nvme, self.connector,
+                          {'transport': 'tcp'}, timeout=0.1)
+        mock_cli.assert_not_called()
+
+    @mock.patch('os_brick.utils._time_sleep')
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl')
+    def test__try_connect_nvme_fabrics_device_timeout(self, mock_connect,
+                                                      mock_sleep):
+        # Timeouts are retried like those of nvme-cli
+        self._setup_host_identity()
+        self.connector.use_fabrics_device = True
+        mock_connect.side_effect = [exception.ExecutionTimeout(), 'nvme3']
+        self.connector._try_connect_nvme({'transport': 'tcp'})
+        self.assertEqual(2, mock_connect.call_count)
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_nvme_cli')
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl')
+    def test_connect_nvme_fabrics_device_missing(self, mock_connect,
+                                                 mock_cli):
+        host = self._setup_host_identity()
+        self.connector.use_fabrics_device = True
+        mock_connect.side_effect = FileNotFoundError(errno.ENOENT, 'Missing')
+        options = {'transport': 'tcp', 'nqn': TARGET_NQN, 'hostnqn': None,
+                   'nr_io_queues': 4}
+        self.connector.connect_nvme(self.connector, options, timeout=30)
+        mock_connect.assert_called_once_with(dict(options, **host))
+        # nvme-cli adds the host identity itself
+        mock_cli.assert_called_once_with(
+            self.connector,
+            ('connect', '-t', 'tcp', '-n', TARGET_NQN, '-i', 4), timeout=30)
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_nvme_cli')
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl')
+    def test_connect_nvme_fabrics_device_error(self, mock_connect, mock_cli):
+        self._setup_host_identity()
+        self.connector.use_fabrics_device = True
+        mock_connect.side_effect = ConnectionRefusedError(errno.ECONNREFUSED,
+                                                          'Refused')
+        self.assertRaises(ConnectionRefusedError,
+                          self.connector.connect_nvme,
+                          self.connector, {'transport': 'tcp'})
+        mock_cli.assert_not_called()
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_nvme_cli')
+    @mock.patch.object(nvmeof.priv_nvme, 'connect_ctrl')
+    def test_connect_nvme_cli(self, mock_connect, mock_cli):
+        options = {'transport': 'tcp', 'nqn': TARGET_NQN}
+        self.connector.connect_nvme(self.connector, options)
+        mock_connect.assert_not_called()
+        mock_cli.assert_called_once_with(
+            self.connector, ('connect', '-t', 'tcp', '-n', TARGET_NQN))
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_nvme_cli')
+    @mock.patch.object(nvmeof.priv_nvme, 'delete_ctrl')
+    def test_disconnect_nvme_fabrics_device(self, mock_delete, mock_cli):
+        self.connector.use_fabrics_device = True
+        self.connector.disconnect_nvme(self.connector, 'nvme3')
+        mock_delete.assert_called_once_with('nvme3')
+        mock_cli.assert_not_called()
+
+    @ddt.data(True, False)
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_nvme_cli')
+    @mock.patch.object(nvmeof.priv_nvme, 'delete_ctrl',
+                       side_effect=FileNotFoundError)
+    def test_disconnect_nvme_cli(self, use_fabrics_device, mock_delete,
+                                 mock_cli):
+        self.connector.use_fabrics_device = use_fabrics_device
+        self.connector.disconnect_nvme(self.connector, 'nvme3')
+        self.assertEqual(use_fabrics_device, mock_delete.called)
+        mock_cli.assert_called_once_with(
+            self.connector, ('disconnect', '-d', '/dev/nvme3'))
 
     @mock.patch.object(nvmeof.NVMeOFConnector, '_get_nvme_devices')
     def test__get_device_path(self, mock_nvme_devices):
@@ -243,25 +442,26 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
                           self.connector._get_device_path,
                           current_devices)
 
-    @mock.patch.object(nvmeof.NVMeOFConnector, '_execute', autospec=True)
-    def test__get_device_path_by_nguid(self, mock_execute):
-        mock_execute.return_value = '/dev/nvme0n1\n', None
-        res = self.connector._get_device_path_by_nguid(NVME_DEVICE_NGUID)
-        self.assertEqual(res, '/dev/nvme0n1')
-
-    @mock.patch.object(nvmeof.NVMeOFConnector, '_execute', autospec=True)
-    def test__get_device_path_by_nguid_empty_response(self, mock_execute):
-        mock_execute.return_value = None, None
-        self.assertRaises(exception.VolumePathsNotFound,
-                          self.connector._get_device_path_by_nguid,
-                          NVME_DEVICE_NGUID)
-
-    @mock.patch.object(nvmeof.NVMeOFConnector, '_execute', autospec=True)
-    def test__get_device_path_by_nguid_exception(self, mock_execute):
-        mock_execute.side_effect = putils.ProcessExecutionError()
+    def test__get_device_path_by_nguid(self):
+        self._setup_nvme_sysfs()
+        res = self.connector._get_device_path_by_nguid(
+            '4941ef7595b8ee978ccf096800f205c6')
+        self.assertEqual('/dev/nvme0n1', res)
+        self.assertEqual([], self.cmds)
+
+    def test__get_device_path_by_nguid_from_wwid(self):
+        self._setup_nvme_sysfs()
+        # nvme2n1 has no nguid file, like in old kernels
+        res = self.connector._get_device_path_by_nguid('0025388b91c2d6e4')
+        self.assertEqual('/dev/nvme2n1', res)
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'get_nvme_namespaces',
+                       return_value=[])
+    def test__get_device_path_by_nguid_not_found(self, mock_namespaces):
         self.assertRaises(exception.VolumeDeviceNotFound,
                           self.connector._get_device_path_by_nguid,
                           NVME_DEVICE_NGUID)
+        self.assertEqual(3, mock_namespaces.call_count)
 
     @mock.patch.object(nvmeof.NVMeOFConnector, '_connect_target_volume')
     def test_connect_volume_single_rep(
@@ -301,8 +501,10 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
     @mock.patch.object(nvmeof.NVMeOFConnector, '_connect_target_volume')
     def test_connect_volume_replicated(
             self, mock_connect_target_volume, mock_replicated_volume):
+        paths = {'fakenqn1': '/dev/nvme0n1', 'fakenqn2': '/dev/nvme1n2',
+                 'fakenqn3': '/dev/nvme2n1'}
         mock_connect_target_volume.side_effect = (
-            '/dev/nvme0n1', '/dev/nvme1n2', '/dev/nvme2n1')
+            lambda nqn, uuid, portals: paths[nqn])
         mock_replicated_volume.return_value = '/dev/md/md1'
         actual = self.connector.connect_volume(connection_properties)
         mock_connect_target_volume.assert_any_call(
@@ -314,9 +516,69 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
         mock_replicated_volume.assert_called_with(
             ['/dev/nvme0n1', '/dev/nvme1n2', '/dev/nvme2n1'],
             connection_properties['alias'],
-            len(connection_properties['volume_replicas']))
+            len(connection_properties['volume_replicas']),
+            {'assume_clean': True, 'bitmap': 'internal',
+             'bitmap_chunk': None, 'sync_speed_min': None,
+             'sync_speed_max': None})
         self.assertEqual(actual, {'type': 'block', 'path': '/dev/md/md1'})
 
+    @ddt.data({'md_assume_clean': 'maybe'},
+              {'md_bitmap': 'external'},
+              {'md_bitmap_chunk': '64X'},
+              {'md_sync_speed_min': 0},
+              {'md_sync_speed_max': '1000'})
+    @mock.patch.object(nvmeof.NVMeOFConnector, '_connect_target_volume')
+    def test_connect_volume_replicated_invalid_raid_options(
+            self, options, mock_connect_target_volume):
+        props = dict(connection_properties, **options)
+        self.assertRaises(exception.InvalidParameterValue,
+                          self.connector.connect_volume, props)
+        mock_connect_target_volume.assert_not_called()
+
+    def test__get_raid_options(self):
+        props = dict(connection_properties, md_assume_clean=False,
+                     md_bitmap='none', md_bitmap_chunk='64M',
+                     md_sync_speed_min=1000, md_sync_speed_max=50000)
+        self.assertEqual({'assume_clean': False, 'bitmap': 'none',
+                          'bitmap_chunk': '64M', 'sync_speed_min': 1000,
+                          'sync_speed_max': 50000},
+                         self.connector._get_raid_options(props))
+
+    @ddt.data(('False', False), ('no', False), ('0', False), (False, False),
+              ('True', True), ('yes', True), (True, True))
+    @ddt.unpack
+    def test__get_raid_options_assume_clean(self, value, expected):
+        props = dict(connection_properties, md_assume_clean=value)
+        self.assertIs(expected,
+                      self.connector._get_raid_options(props)['assume_clean'])
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, '_connect_target_volume')
+    def test__connect_replicas_concurrent(self, mock_connect_target_volume):
+        # Replicas wait for each other, so they must be connected in parallel
+        barrier = threading.Barrier(3, timeout=10)
+
+        def connect(nqn, uuid, portals):
+            barrier.wait()
+            if nqn == 'fakenqn2':
+                raise exception.VolumeDeviceNotFound(device=nqn)
+            return '/dev/%s' % uuid
+
+        mock_connect_target_volume.side_effect = connect
+        res = self.connector._connect_replicas(volume_replicas)
+        self.assertEqual(['/dev/fakeuuid1', '/dev/fakeuuid3'], res)
+        self.assertEqual(3, mock_connect_target_volume.call_count)
+
+    @mock.patch.object(nvmeof.brick_executor, 'Thread')
+    @mock.patch.object(nvmeof.NVMeOFConnector, '_connect_target_volume',
+                       return_value='/dev/nvme0n1')
+    def test__connect_replicas_single(self, mock_connect_target_volume,
+                                      mock_thread):
+        res = self.connector._connect_replicas(volume_replicas[:1])
+        self.assertEqual(['/dev/nvme0n1'], res)
+        mock_connect_target_volume.assert_called_once_with(
+            'fakenqn1', 'fakeuuid1', [('10.0.0.1', 4420, 'tcp')])
+        mock_thread.assert_not_called()
+
     @mock.patch.object(nvmeof.NVMeOFConnector, '_handle_replicated_volume')
     @mock.patch.object(nvmeof.NVMeOFConnector, '_connect_target_volume')
     def test_connect_volume_replicated_exception(
@@ -387,6 +649,33 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
         self.assertIsNone(res)
         mock_flush.assert_called_once_with(mock.ANY, device)
 
+    @ddt.data(('/dev/nvme2n1', 'nqn.other', ['nvme2']),
+              # Its controllers have other namespaces
+              ('/dev/nvme0n1', TARGET_NQN, []))
+    @ddt.unpack
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'disconnect_nvme')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'flush_device_io', autospec=True)
+    def test_disconnect_volume_fabrics_device(self, device, nqn, expected,
+                                              mock_flush, mock_disconnect):
+        self._setup_nvme_sysfs()
+        self.connector.use_fabrics_device = True
+        self.connector.disconnect_volume({'nqn': nqn, 'device_path': device},
+                                         None)
+        mock_flush.assert_called_once_with(mock.ANY, device)
+        self.assertEqual(
+            [mock.call(self.connector, ctrl) for ctrl in expected],
+            mock_disconnect.call_args_list)
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'disconnect_nvme')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'flush_device_io', autospec=True)
+    def test_disconnect_volume_keeps_controllers(self, mock_flush,
+                                                 mock_disconnect):
+        self._setup_nvme_sysfs()
+        self.connector.disconnect_volume(
+            {'nqn': 'nqn.other', 'device_path': '/dev/nvme2n1'}, None)
+        mock_flush.assert_called_once_with(mock.ANY, '/dev/nvme2n1')
+        mock_disconnect.assert_not_called()
+
     @mock.patch.object(nvmeof.NVMeOFConnector, '_get_fs_type')
     def test_disconnect_unreplicated_volume_nova(self, mock_get_fs_type):
         connection_properties = {
@@ -553,8 +842,8 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
         mock_rescan.assert_called_with(self.connector, 'fakenqn')
         mock_connect_portal.assert_called_with(
             self.connector, 'fakenqn', [('fake', 'portal', 'tcp')], {})
-        mock_get_live_nvme_controllers_map.assert_called_with(self.connector,
-                                                              'fakenqn')
+        mock_get_live_nvme_controllers_map.assert_called_with(
+            self.connector, 'fakenqn', [('fake', 'portal', 'tcp')])
         fake_controllers_map_values = fake_controllers_map.values()
         mock_device_path.assert_called_with(
             self.connector, 'fakenqn', 'fakeuuid',
@@ -583,6 +872,101 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
             False)
         mock_nvme_cli.assert_called_with(self.connector, nvme_command)
 
+    def _setup_concurrent_connect(self, blocked_portals=(),
+                                  failed_portals=()):
+        self.mock_object(nvmeof.NVMeOFConnector,
+                         'native_multipath_supported', True)
+        self.connector.use_multipath = True
+        self.connector.concurrent_connect = True
+        unblock = threading.Event()
+        self.addCleanup(unblock.set)
+
+        def run_nvme_cli(executor, nvme_command, **kwargs):
+            address = nvme_command[2]
+            if address in blocked_portals:
+                unblock.wait(10)
+            if address in failed_portals:
+                raise putils.ProcessExecutionError()
+            return '', ''
+
+        return self.mock_object(nvmeof.NVMeOFConnector, 'run_nvme_cli',
+                                side_effect=run_nvme_cli), unblock
+
+    PORTALS = [('10.0.0.%s' % i, 4420, 'tcp') for i in range(1, 5)]
+
+    def test_connect_to_portals_concurrent(self):
+        mock_cli, unblock = self._setup_concurrent_connect()
+
+        self.assertTrue(self.connector.connect_to_portals(
+            self.connector, 'fakenqn', self.PORTALS, {}))
+
+        mock_cli.assert_has_calls(
+            [mock.call(self.connector,
+                       ('connect', '-a', portal[0], '-s', 4420, '-t', 'tcp',
+                        '-n', 'fakenqn', '-Q', '128', '-l', '-1'),
+                       timeout=nvmeof.PORTAL_CONNECT_TIMEOUT_DEFAULT)
+             for portal in self.PORTALS],
+            any_order=True)
+
+    def test_connect_to_portals_concurrent_some_fail(self):
+        mock_cli, unblock = self._setup_concurrent_connect(
+            failed_portals=('10.0.0.1', '10.0.0.2', '10.0.0.3'))
+        self.assertTrue(self.connector.connect_to_portals(
+            self.connector, 'fakenqn', self.PORTALS, {}))
+
+    def test_connect_to_portals_concurrent_all_fail(self):
+        portals = [portal[0] for portal in self.PORTALS]
+        mock_cli, unblock = self._setup_concurrent_connect(
+            failed_portals=portals)
+        self.assertFalse(self.connector.connect_to_portals(
+            self.connector, 'fakenqn', self.PORTALS, {}))
+        self.assertEqual(4, mock_cli.call_count)
+
+    def test_connect_to_portals_concurrent_already_connected(self):
+        mock_cli, unblock = self._setup_concurrent_connect()
+        ctrls = {'traddr=10.0.0.2,trsvcid=4420': 'nvme1'}
+
+        # Only the missing portals are connected, and we wait for them
+        self.assertTrue(self.connector.connect_to_portals(
+            self.connector, 'fakenqn', self.PORTALS, ctrls))
+
+        self.assertEqual(3, mock_cli.call_count)
+        self.assertNotIn('10.0.0.2',
+                         [c[0][1][2] for c in mock_cli.call_args_list])
+
+    @mock.patch.object(nvmeof.brick_executor, 'Thread')
+    def test_connect_to_portals_concurrent_all_connected(self, mock_thread):
+        mock_cli, unblock = self._setup_concurrent_connect()
+        ctrls = {'traddr=10.0.0.%s,trsvcid=4420' % i: 'nvme%s' % i
+                 for i in range(1, 5)}
+        self.assertFalse(self.connector.connect_to_portals(
+            self.connector, 'fakenqn', self.PORTALS, ctrls))
+        mock_thread.assert_not_called()
+        mock_cli.assert_not_called()
+
+    @mock.patch.object(nvmeof.LOG, 'warning')
+    def test_connect_to_portals_concurrent_deadline(self, mock_warning):
+        mock_cli, unblock = self._setup_concurrent_connect(
+            blocked_portals=('10.0.0.3', '10.0.0.4'))
+        self.connector.portal_connect_timeout = 0.1
+
+        # The blocked portals don't stall the attach
+        self.assertTrue(self.connector.connect_to_portals(
+            self.connector, 'fakenqn', self.PORTALS, {}))
+        self.assertEqual(4, mock_cli.call_count)
+        mock_warning.assert_called_once_with(
+            mock.ANY, {'pending': 2, 'nqn': 'fakenqn', 'timeout': 0.1})
+
+    def test_connect_to_portals_concurrent_disabled(self):
+        mock_cli, unblock = self._setup_concurrent_connect(
+            failed_portals=('10.0.0.1',))
+        self.connector.concurrent_connect = False
+        self.assertTrue(self.connector.connect_to_portals(
+            self.connector, 'fakenqn', self.PORTALS, {}))
+        # Sequential connections without timeout
+        self.assertEqual(4, mock_cli.call_count)
+        self.assertEqual({}, mock_cli.call_args[1])
+
     @mock.patch.object(nvmeof.NVMeOFConnector, 'stop_and_assemble_raid')
     @mock.patch.object(nvmeof.NVMeOFConnector, '_is_device_in_raid')
     def test_handle_replicated_volume_existing(
@@ -625,7 +1009,26 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
         mock_device_raid.assert_any_call(self.connector, '/dev/nvme1n3')
         mock_create_raid.assert_called_with(
             self.connector, ['/dev/nvme1n1', '/dev/nvme1n2', '/dev/nvme1n3'],
-            '1', 'fakealias', 'fakealias', False)
+            '1', 'fakealias', 'fakealias', False, None)
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'set_raid_sync_speed')
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'create_raid')
+    @mock.patch.object(nvmeof.NVMeOFConnector, '_is_device_in_raid',
+                       return_value=False)
+    def test_handle_replicated_volume_new_options(
+            self, mock_device_raid, mock_create_raid, mock_sync_speed):
+        options = {'assume_clean': False, 'bitmap': 'internal',
+                   'bitmap_chunk': '64M', 'sync_speed_min': None,
+                   'sync_speed_max': 50000}
+        self.assertEqual(
+            '/dev/md/fakealias',
+            self.connector._handle_replicated_volume(
+                ['/dev/nvme1n1', '/dev/nvme1n2'], 'fakealias', 2, options))
+        mock_create_raid.assert_called_with(
+            self.connector, ['/dev/nvme1n1', '/dev/nvme1n2'],
+            '1', 'fakealias', 'fakealias', False, options)
+        mock_sync_speed.assert_called_once_with('/dev/md/fakealias', None,
+                                                50000)
 
     @mock.patch.object(nvmeof.NVMeOFConnector, 'ks_readlink')
     @mock.patch.object(nvmeof.NVMeOFConnector, 'get_md_name')
@@ -697,6 +1100,78 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
              '--failfast', '--assume-clean', '/dev/sda'])
         mock_os.assert_called_with('/dev/md/name')
 
+    @ddt.data(({'assume_clean': False, 'bitmap': 'internal',
+                'bitmap_chunk': '128M'},
+               ['--bitmap=internal', '--bitmap-chunk=128M', '--homehost=any',
+                '--failfast']),
+              ({'assume_clean': True, 'bitmap': 'none',
+                'bitmap_chunk': '128M'},
+               ['--bitmap=none', '--homehost=any', '--failfast',
+                '--assume-clean']))
+    @ddt.unpack
+    @mock.patch.object(os.path, 'exists', return_value=True)
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'run_mdadm')
+    def test_create_raid_options(self, options, expected, mock_run_mdadm,
+                                 mock_exists):
+        self.connector.create_raid(self.connector, ['/dev/sda'], '1', 'md1',
+                                   'name', False, options)
+        mock_run_mdadm.assert_called_with(
+            self.connector,
+            ['mdadm', '-C', 'md1', '-R', '-N', 'name', '--level', '1',
+             '--raid-devices=1'] + expected + ['/dev/sda'])
+
+    def _setup_md_sysfs(self, **attrs):
+        self.sysfs = self.useFixture(fixtures.TempDir()).path
+        self.mock_object(nvmeof, 'SYSFS_PATH', self.sysfs)
+        self._write_sysfs('block', 'md127/md', **attrs)
+        self.mock_object(os.path, 'realpath', return_value='/dev/md127')
+
+    @mock.patch.object(nvmeof.priv_rootwrap, 'write_sys')
+    def test_set_raid_sync_speed(self, mock_write):
+        self._setup_md_sysfs()
+        mock_write.side_effect = [None, PermissionError]
+        self.connector.set_raid_sync_speed('/dev/md/alias', 1000, 50000)
+        path = os.path.join(self.sysfs, 'block', 'md127', 'md')
+        mock_write.assert_has_calls(
+            [mock.call(os.path.join(path, 'sync_speed_min'), '1000'),
+             mock.call(os.path.join(path, 'sync_speed_max'), '50000')])
+        os.path.realpath.assert_called_once_with('/dev/md/alias')
+
+    def test_get_raid_sync_progress(self):
+        self._setup_md_sysfs(sync_action='resync',
+                             sync_completed='524288 / 2097152',
+                             sync_speed='102400')
+        self.assertEqual({'action': 'resync', 'completed': 524288,
+                          'total': 2097152, 'progress': 0.25,
+                          'speed': 102400},
+                         self.connector.get_raid_sync_progress(
+                             '/dev/md/alias'))
+
+    def test_get_raid_sync_progress_idle(self):
+        self._setup_md_sysfs(sync_action='idle', sync_completed='none',
+                             sync_speed='none')
+        self.assertEqual({'action': 'idle', 'completed': None, 'total': None,
+                          'progress': None, 'speed': None},
+                         self.connector.get_raid_sync_progress(
+                             '/dev/md/alias'))
+
+    def test_get_raid_sync_progress_not_md(self):
+        self._setup_md_sysfs()
+        self.assertIsNone(self.connector.get_raid_sync_progress('/dev/sda'))
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'get_raid_sync_progress')
+    def test_get_resync_progress(self, mock_progress):
+        self.assertEqual(
+            mock_progress.return_value,
+            self.connector.get_resync_progress(connection_properties))
+        mock_progress.assert_called_once_with('/dev/md/fakealias')
+
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'get_raid_sync_progress')
+    def test_get_resync_progress_not_replicated(self, mock_progress):
+        props = {'vol_uuid': VOL_UUID, 'target_nqn': TARGET_NQN}
+        self.assertIsNone(self.connector.get_resync_progress(props))
+        mock_progress.assert_not_called()
+
     @mock.patch.object(nvmeof.NVMeOFConnector, 'stop_raid')
     @mock.patch.object(nvmeof.NVMeOFConnector, 'is_raid_exists')
     def test_end_raid_simple(self, mock_raid_exists, mock_stop_raid):
@@ -889,42 +1364,24 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
         self.assertEqual(args[1], cmd[1])
         self.assertEqual(args[2], cmd[2])
 
-    @mock.patch.object(executor.Executor, '_execute')
-    @mock.patch.object(glob, 'glob')
     @mock.patch.object(nvmeof.NVMeOFConnector, 'get_nvme_controllers')
-    def test_get_nvme_device_path(self, mock_get_nvme_controllers, mock_glob,
-                                  mock_execute):
+    def test_get_nvme_device_path(self, mock_get_nvme_controllers):
+        self._setup_nvme_sysfs()
         mock_get_nvme_controllers.return_value = ['nvme1']
-        block_dev_path = '/sys/class/block/nvme1n*/uuid'
-        mock_glob.side_effect = [['/sys/class/block/nvme1n1/uuid']]
-        mock_execute.return_value = (VOL_UUID + "\n", "")
-        cmd = ['cat', '/sys/class/block/nvme1n1/uuid']
         result = self.connector.get_nvme_device_path(EXECUTOR, TARGET_NQN,
                                                      VOL_UUID)
         mock_get_nvme_controllers.assert_called_with(EXECUTOR, TARGET_NQN)
-        self.assertEqual(NVME_NS_PATH, result)
-        mock_glob.assert_any_call(block_dev_path)
-        args, kwargs = mock_execute.call_args
-        self.assertEqual(args[0], cmd[0])
-        self.assertEqual(args[1], cmd[1])
-
-    def execute_side_effect(self, value, run_as_root, root_helper):
-        if 'nqn' in value:
-            return TARGET_NQN + "\n", ""
-        if 'state' in value:
-            return 'live' + "\n", ""
-
-    def execute_side_effect_not_live(self, value, run_as_root, root_helper):
-        if 'nqn' in value:
-            return TARGET_NQN + "\n", ""
-        if 'state' in value:
-            return 'dead' + "\n", ""
+        self.assertEqual('/dev/nvme0n1', result)
+        self.assertEqual([], self.cmds)
 
-    def execute_side_effect_not_found(self, value, run_as_root, root_helper):
-        if 'nqn' in value:
-            return "dummy" + "\n", ""
-        if 'state' in value:
-            return 'live' + "\n", ""
+    @mock.patch.object(nvmeof.NVMeOFConnector, 'get_nvme_controllers')
+    def test_get_nvme_device_path_other_controller(self,
+                                                   mock_get_nvme_controllers):
+        self._setup_nvme_sysfs()
+        self.assertRaises(exception.VolumeDeviceNotFound,
+                          self.connector.get_nvme_device_path,
+                          EXECUTOR, TARGET_NQN, VOL_UUID, ['nvme2'])
+        mock_get_nvme_controllers.assert_not_called()
 
     @mock.patch.object(nvmeof.NVMeOFConnector, 'get_live_nvme_controllers_map')
     def test_get_nvme_controllers(self, mock_get_live_nvme_controllers_map):
@@ -936,34 +1393,140 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
         mock_get_live_nvme_controllers_map.assert_called_with(EXECUTOR,
                                                               TARGET_NQN)
 
-    @mock.patch.object(executor.Executor, '_execute',
-                       side_effect=execute_side_effect_not_live)
-    @mock.patch.object(glob, 'glob')
-    def test_get_nvme_controllers_not_live(self, mock_glob, mock_execute):
-        ctrl_path = '/sys/class/nvme-fabrics/ctl/nvme*'
-        mock_glob.side_effect = [['/sys/class/nvme-fabrics/ctl/nvme1']]
-        cmd = ['cat', '/sys/class/nvme-fabrics/ctl/nvme1/state']
+    def test_get_live_nvme_controllers_map(self):
+        self._setup_nvme_sysfs()
+        res = self.connector.get_live_nvme_controllers_map(EXECUTOR,
+                                                           TARGET_NQN)
+        # nvme1 is not live
+        self.assertEqual({'traddr=10.0.0.1,trsvcid=4420': 'nvme0'}, res)
+        self.assertEqual([], self.cmds)
+
+    def test_get_live_nvme_controllers_map_new_controller(self):
+        self._setup_nvme_sysfs()
+        index = nvmeof.NVMeIndex.get()
+        index.refresh()
+        # A new controller for a known NQN whose uevent we haven't handled
+        self._write_sysfs('class/nvme', 'nvme3', state='live',
+                          subsysnqn=TARGET_NQN,
+                          address='traddr=10.0.0.4,trsvcid=4420')
+        self.assertEqual(
+            {'traddr=10.0.0.1,trsvcid=4420': 'nvme0'},
+            self.connector.get_live_nvme_controllers_map(EXECUTOR,
+                                                         TARGET_NQN))
+        res = self.connector.get_live_nvme_controllers_map(
+            EXECUTOR, TARGET_NQN, [('10.0.0.4', '4420', 'tcp')])
+        self.assertEqual({'traddr=10.0.0.1,trsvcid=4420': 'nvme0',
+                          'traddr=10.0.0.4,trsvcid=4420': 'nvme3'}, res)
+
+    def test_get_nvme_controllers_not_live(self):
+        self._setup_nvme_sysfs()
+        self._write_sysfs('class/nvme', 'nvme0', state='deleting')
         self.assertRaises(exception.VolumeDeviceNotFound,
                           self.connector.get_nvme_controllers, EXECUTOR,
                           TARGET_NQN)
-        mock_glob.assert_any_call(ctrl_path)
-        args, kwargs = mock_execute.call_args
-        self.assertEqual(args[0], cmd[0])
-        self.assertEqual(args[1], cmd[1])
 
-    @mock.patch.object(executor.Executor, '_execute',
-                       side_effect=execute_side_effect_not_found)
-    @mock.patch.object(glob, 'glob')
-    def test_get_nvme_controllers_not_found(self, mock_glob, mock_execute):
-        ctrl_path = '/sys/class/nvme-fabrics/ctl/nvme*'
-        mock_glob.side_effect = [['/sys/class/nvme-fabrics/ctl/nvme1']]
-        cmd = ['cat', '/sys/class/nvme-fabrics/ctl/nvme1/state']
+    def test_get_nvme_controllers_not_found(self):
+        self._setup_nvme_sysfs()
         self.assertRaises(exception.VolumeDeviceNotFound,
                           self.connector.get_nvme_controllers, EXECUTOR,
-                          TARGET_NQN)
-        mock_glob.assert_any_call(ctrl_path)
-        args, kwargs = mock_execute.call_args
-        self.assertEqual(args[0], cmd[0])
+                          'nqn.missing')
+
+    def test_nvme_index_miss_refreshes(self):
+        self._setup_nvme_sysfs()
+        index = nvmeof.NVMeIndex.get()
+        self.assertEqual('nvme0n1', index.get_namespace(uuid=VOL_UUID).name)
+        self._write_sysfs('block', 'nvme2n2', dev='259:4', uuid='fake-uuid')
+        os.makedirs(os.path.join(self.sysfs, 'class/nvme/nvme2/nvme2n2'))
+        self.assertEqual('nvme2n2', index.get_namespace(uuid='fake-uuid').name)
+        self.assertIsNone(index.get_namespace(uuid='missing'))
+
+    def test_nvme_index_stale(self):
+        self._setup_nvme_sysfs()
+        index = nvmeof.NVMeIndex.get()
+        self.assertEqual('nvme0n1', index.get_namespace(uuid=VOL_UUID).name)
+        # Same uuid now belongs to another device
+        self._write_sysfs('block', 'nvme0n1', uuid='fake-uuid')
+        self._write_sysfs('block', 'nvme0n2', uuid=VOL_UUID)
+        self.assertEqual('nvme0n1', index.get_namespace(uuid=VOL_UUID).name)
+        # A uevent arrives
+        index._stale = True
+        self.assertEqual('nvme0n2', index.get_namespace(uuid=VOL_UUID).name)
+
+    @mock.patch('time.monotonic')
+    def test_nvme_index_poll(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self._setup_nvme_sysfs()
+        index = nvmeof.NVMeIndex.get()
+        self.assertEqual('nvme0n1', index.get_namespace(uuid=VOL_UUID).name)
+        self._write_sysfs('block', 'nvme0n1', uuid='fake-uuid')
+        self._write_sysfs('block', 'nvme0n2', uuid=VOL_UUID)
+        mock_monotonic.return_value = 105
+        self.assertEqual('nvme0n1', index.get_namespace(uuid=VOL_UUID).name)
+        mock_monotonic.return_value = 111
+        self.assertEqual('nvme0n2', index.get_namespace(uuid=VOL_UUID).name)
+
+    def test_nvme_index_get_namespace_controllers(self):
+        self._setup_nvme_sysfs()
+        index = nvmeof.NVMeIndex.get()
+        self.assertIsNone(index.get_namespace(uuid=VOL_UUID,
+                                              controllers=['nvme2']))
+        self.assertEqual(
+            'nvme2n1',
+            index.get_namespace(nguid='0025388B-91C2-D6E4',
+                                controllers=['nvme2']).name)
+
+    def test_nvme_index_get(self):
+        self.mock_object(nvmeof.NVMeIndex, '_instance', None)
+        self.mock_object(nvmeof.NVMeIndex, '_listen_uevents',
+                         return_value=False)
+        index = nvmeof.NVMeIndex.get()
+        self.assertIs(index, nvmeof.NVMeIndex.get())
+
+    @ddt.data((b'add@/devices/virtual/nvme-fabrics/ctl/nvme3\0ACTION=add\0'
+               b'SUBSYSTEM=nvme\0DEVNAME=nvme3\0', True),
+              (b'remove@/devices/virtual/nvme-subsystem/nvme-subsys0/nvme0n1'
+               b'\0ACTION=remove\0SUBSYSTEM=block\0DEVNAME=nvme0n1\0', True),
+              (b'change@/devices/virtual/block/dm-0\0ACTION=change\0'
+               b'SUBSYSTEM=block\0DEVNAME=dm-0\0', False),
+              (b'add@/module/nvme_tcp\0ACTION=add\0SUBSYSTEM=module\0',
+               False))
+    @ddt.unpack
+    def test_nvme_index_is_nvme_uevent(self, data, expected):
+        self.assertEqual(expected, nvmeof.NVMeIndex._is_nvme_uevent(data))
+
+    @mock.patch.object(nvmeof.NVMeIndex, '_open_uevent_socket',
+                       side_effect=PermissionError)
+    def test_nvme_index_no_uevents(self, mock_open):
+        index = nvmeof.NVMeIndex()
+        self.assertFalse(index._uevents)
+        mock_open.assert_called_once_with()
+
+    @mock.patch.object(nvmeof.brick_executor, 'Thread')
+    @mock.patch.object(nvmeof.NVMeIndex, '_open_uevent_socket')
+    def test_nvme_index_uevents(self, mock_open, mock_thread):
+        index = nvmeof.NVMeIndex()
+        self.assertTrue(index._uevents)
+        mock_thread.assert_called_once_with(
+            target=index._watch_uevents, args=(mock_open.return_value,),
+            name='nvme-index', daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
+
+    def test_nvme_index_watch_uevents(self):
+        index = nvmeof.NVMeIndex(use_uevents=False)
+        index._stale = False
+        index._uevents = True
+        sock = mock.Mock()
+        sock.recv.side_effect = [
+            b'change@/devices/virtual/block/dm-0\0SUBSYSTEM=block\0',
+            OSError(errno.ENOBUFS, 'No buffer space'),
+            OSError(errno.EBADF, 'Bad file descriptor')]
+
+        index._watch_uevents(sock)
+
+        self.assertTrue(index._stale)
+        self.assertFalse(index._uevents)
+        self.assertEqual(3, sock.recv.call_count)
+        sock.close.assert_called_once_with()
 
     @mock.patch.object(builtins, 'open')
     def test_get_host_nqn_file_available(self, mock_open):
@@ -1051,17 +1614,12 @@ class NVMeOFConnectorTestCase(test_connector.ConnectorTestCase):
                           self.connector._is_nvme_available,
                           'nvme1')
 
-    @mock.patch.object(executor.Executor, '_execute')
-    def test__get_nvme_devices(self, mock_execute):
-        mock_execute.return_value = nvme_list_stdout, None
+    def test__get_nvme_devices(self):
+        self._setup_nvme_sysfs()
         res = self.connector._get_nvme_devices()
-        self.assertEqual(set(res), {'/dev/nvme0n1', '/dev/nvme0n2'})
-
-    @mock.patch.object(executor.Executor, '_execute')
-    def test__get_nvme_devices_failed(self, mock_execute):
-        mock_execute.side_effect = putils.ProcessExecutionError()
-        self.assertRaises(exception.CommandExecutionFailed,
-                          self.connector._get_nvme_devices)
+        self.assertEqual(['/dev/nvme0n1', '/dev/nvme0n2', '/dev/nvme2n1'],
+                         res)
+        self.assertEqual([], self.cmds)
 
     @mock.patch.object(nvmeof.NVMeOFConnector, '_is_nvme_available')
     @mock.patch.object(nvmeof.NVMeOFConnector, '_get_nvme_subsys')
@@ -11,9 +11,13 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import errno
+import os
+import stat
 from unittest import mock
 
 import ddt
+import fixtures
 
 from os_brick import exception
 from os_brick.initiator.connectors import rbd
@@ -28,6 +32,15 @@ from os_brick import utils
 class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
                            test_connector.ConnectorTestCase):
 
+    def setUp(self):
+        super(RBDConnectorTestCase, self).setUp()
+        self.mock_object(linuxrbd.RadosPool, '_instance',
+                         linuxrbd.RadosPool())
+        self.conf_dir = self.useFixture(fixtures.TempDir()).path
+        self.mock_object(rbd, 'CEPH_CONF_DIR', self.conf_dir)
+        self.mock_object(rbd.RBDConnector, '_rbd_cli_available', False)
+        self.mock_object(rbd, 'RBD_SYSFS_PATH', '/nonexistent/rbd/devices')
+
     def test_get_search_path(self):
         rbd_connector = rbd.RBDConnector(None)
         path = rbd_connector.get_search_path()
@@ -122,24 +135,108 @@ class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
                               conn._check_or_get_keyring_contents, keyring,
                               'cluster', 'user')
 
-    @mock.patch('os_brick.initiator.connectors.rbd.tempfile.mkstemp')
-    def test_create_ceph_conf(self, mock_mkstemp):
-        mockopen = mock.mock_open()
-        fd = mock.sentinel.fd
-        tmpfile = mock.sentinel.tmpfile
-        mock_mkstemp.return_value = (fd, tmpfile)
-
-        with mock.patch('os.fdopen', mockopen, create=True):
-            rbd_connector = rbd.RBDConnector(None)
-            conf_path = rbd_connector._create_ceph_conf(
-                self.hosts, self.ports, self.clustername, self.user,
-                self.keyring)
-        self.assertEqual(conf_path, tmpfile)
-        mock_mkstemp.assert_called_once_with(prefix='brickrbd_')
-        # Bug #1865754 - make sure generated config file has a '[global]'
-        # section
-        _, args, _ = mockopen().writelines.mock_calls[0]
-        self.assertIn('[global]', args[0])
+    def _create_ceph_conf(self, keyring=None):
+        return rbd.RBDConnector._create_ceph_conf(
+            self.hosts, self.ports, self.clustername, self.user,
+            keyring or self.keyring)
+
+    def test_create_ceph_conf(self):
+        conf_path = self._create_ceph_conf()
+
+        self.assertEqual(self.conf_dir, os.path.dirname(conf_path))
+        self.assertTrue(os.path.basename(conf_path).startswith('brickrbd_'))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(conf_path).st_mode))
+        with open(conf_path) as f:
+            # Bug #1865754 - make sure generated config file has a '[global]'
+            # section
+            self.assertEqual('[global]\nmon_host = 192.168.10.2:6789\n' +
+                             self.keyring + '\n', f.read())
+        self.assertEqual(1, rbd.RBDConnector._read_ceph_conf_refs(conf_path))
+        self.assertEqual(
+            0o600,
+            stat.S_IMODE(os.stat(conf_path + '.refs').st_mode))
+
+    def test_create_ceph_conf_shared(self):
+        conf_path = self._create_ceph_conf()
+        with mock.patch.object(rbd.RBDConnector, '_write_ceph_conf') as write:
+            self.assertEqual(conf_path, self._create_ceph_conf())
+            write.assert_not_called()
+        other_path = self._create_ceph_conf('[client.other]\n  key = 1\n')
+        self.assertNotEqual(conf_path, other_path)
+
+        rbd.RBDConnector._release_ceph_conf(conf_path)
+        self.assertTrue(os.path.exists(conf_path))
+        rbd.RBDConnector._release_ceph_conf(conf_path)
+        self.assertFalse(os.path.exists(conf_path))
+        self.assertFalse(os.path.exists(conf_path + '.refs'))
+        self.assertEqual(1, rbd.RBDConnector._read_ceph_conf_refs(other_path))
+
+        # Files with an unknown number of users are not deleted
+        os.unlink(other_path + '.refs')
+        rbd.RBDConnector._release_ceph_conf(other_path)
+        self.assertTrue(os.path.exists(other_path))
+
+    def test_release_ceph_conf_other_process(self):
+        # The number of users is shared with other processes and restarts
+        conf_path = self._create_ceph_conf()
+        rbd.RBDConnector._write_ceph_conf_refs(conf_path, 2)
+        rbd.RBDConnector._release_ceph_conf(conf_path)
+        self.assertTrue(os.path.exists(conf_path))
+        self.assertEqual(1, rbd.RBDConnector._read_ceph_conf_refs(conf_path))
+
+    def test_ceph_conf_refs_untrusted(self):
+        conf_path = self._create_ceph_conf()
+        refs_path = conf_path + '.refs'
+
+        # Files others can change are ignored
+        os.chmod(refs_path, 0o622)
+        self.assertIsNone(rbd.RBDConnector._read_ceph_conf_refs(conf_path))
+
+        # Symlinks are not followed, and are replaced instead of written to
+        target = os.path.join(self.conf_dir, 'target')
+        with open(target, 'w') as f:
+            f.write('5')
+        os.chmod(target, 0o600)
+        os.unlink(refs_path)
+        os.symlink(target, refs_path)
+        self.assertIsNone(rbd.RBDConnector._read_ceph_conf_refs(conf_path))
+        rbd.RBDConnector._write_ceph_conf_refs(conf_path, 1)
+        self.assertFalse(os.path.islink(refs_path))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(refs_path).st_mode))
+        self.assertEqual(1, rbd.RBDConnector._read_ceph_conf_refs(conf_path))
+        with open(target) as f:
+            self.assertEqual('5', f.read())
+
+    def test_release_ceph_conf_private(self):
+        # Not shared files, ie: from older releases, are always deleted
+        path = os.path.join(self.conf_dir, 'brickrbd_a1b2c3')
+        open(path, 'w').close()
+        rbd.RBDConnector._release_ceph_conf(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_create_ceph_conf_recreated(self):
+        conf_path = self._create_ceph_conf()
+        os.unlink(conf_path)
+        self.assertEqual(conf_path, self._create_ceph_conf())
+        self.assertTrue(os.path.exists(conf_path))
+
+        # Files readable by others are not trusted
+        os.chmod(conf_path, 0o644)
+        self.assertEqual(conf_path, self._create_ceph_conf())
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(conf_path).st_mode))
+        self.assertEqual(3, rbd.RBDConnector._read_ceph_conf_refs(conf_path))
+
+    @mock.patch.object(rbd.os, 'replace',
+                       side_effect=OSError(errno.EPERM, 'Not owner'))
+    def test_create_ceph_conf_not_owner(self, mock_replace):
+        conf_path = self._create_ceph_conf()
+        self.assertTrue(os.path.exists(conf_path))
+        mock_replace.assert_called_once_with(conf_path, mock.ANY)
+        # The private file is not shared, so it has no users count
+        self.assertFalse(rbd.RBDConnector._is_shared_ceph_conf(conf_path))
+        self.assertFalse(os.path.exists(conf_path + '.refs'))
+        rbd.RBDConnector._release_ceph_conf(conf_path)
+        self.assertFalse(os.path.exists(conf_path))
 
     @mock.patch('os_brick.privileged.rbd.root_create_ceph_conf')
     def test_create_non_openstack_config(self, mock_priv_create):
@@ -249,7 +346,7 @@ class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
                     'conf': mock_rbd_cfg.return_value}
         self.assertEqual(expected, res)
 
-    @mock.patch('os_brick.privileged.rbd.delete_if_exists')
+    @mock.patch('os_brick.privileged.rbd.root_release_ceph_conf')
     @mock.patch.object(rbd.RBDConnector, '_get_rbd_args')
     @mock.patch.object(rbd.RBDConnector, 'create_non_openstack_config')
     @mock.patch.object(rbd.RBDConnector, '_execute')
@@ -298,7 +395,7 @@ class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
          "1":{"pool":"pool","device":"/dev/rdb1","name":"image_2"}}
         """,  # old-style output
     )
-    @mock.patch('os_brick.privileged.rbd.delete_if_exists')
+    @mock.patch('os_brick.privileged.rbd.root_release_ceph_conf')
     @mock.patch.object(priv_rootwrap, 'execute', return_value=None)
     def test_disconnect_local_volume(self, rbd_map_out, mock_execute,
                                      mock_delete):
@@ -323,7 +420,7 @@ class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
 
         mock_delete.assert_not_called()
 
-    @mock.patch('os_brick.privileged.rbd.delete_if_exists')
+    @mock.patch('os_brick.privileged.rbd.root_release_ceph_conf')
     @mock.patch.object(rbd.RBDConnector, '_find_root_device')
     @mock.patch.object(rbd.RBDConnector, '_execute')
     def test_disconnect_local_volume_non_openstack(self, mock_execute,
@@ -406,7 +503,7 @@ class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
         mock_handle.return_value.close.assert_called_once_with()
 
     @mock.patch.object(rbd, 'open')
-    @mock.patch('os_brick.privileged.rbd.delete_if_exists')
+    @mock.patch('os_brick.privileged.rbd.root_release_ceph_conf')
     @mock.patch.object(rbd.RBDConnector, '_find_root_device')
     @mock.patch.object(rbd.RBDConnector, 'create_non_openstack_config')
     def test_extend_volume_block(self, mock_config, mock_find, mock_delete,
@@ -427,7 +524,7 @@ class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
         self.assertEqual(123456789, res)
 
     @mock.patch.object(rbd, 'open')
-    @mock.patch('os_brick.privileged.rbd.delete_if_exists')
+    @mock.patch('os_brick.privileged.rbd.root_release_ceph_conf')
     @mock.patch.object(rbd.RBDConnector, '_find_root_device')
     @mock.patch.object(rbd.RBDConnector, 'create_non_openstack_config')
     def test_extend_volume_no_device_local(self, mock_config, mock_find,
@@ -463,6 +560,177 @@ class RBDConnectorTestCase(test_base_rbd.RBDConnectorTestMixin,
             root_helper=connector._root_helper, run_as_root=True)
         self.assertEqual('/dev/rbd1', res)
 
+    def _setup_rbd_sysfs(self):
+        sysfs = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(sysfs, 'bus', 'rbd', 'devices')
+        self.mock_object(rbd, 'RBD_SYSFS_PATH', path)
+        for dev_id, attrs in (
+                ('0', {'pool': 'pool', 'name': 'image',
+                       'current_snap': '-'}),
+                ('1', {'pool': 'fake_pool', 'pool_ns': '',
+                       'name': 'fake_volume', 'current_snap': '-'}),
+                ('2', {'pool': 'fake_pool', 'pool_ns': 'ns',
+                       'name': 'fake_volume', 'current_snap': 'snap'}),
+                # Being removed
+                ('3', {})):
+            os.makedirs(os.path.join(path, dev_id))
+            for name, value in attrs.items():
+                with open(os.path.join(path, dev_id, name), 'w') as f:
+                    f.write(value + '\n')
+        return path
+
+    def test_get_rbd_mappings(self):
+        self._setup_rbd_sysfs()
+        res = rbd.RBDConnector.get_rbd_mappings()
+        expected = [
+            rbd.RBDMapping('0', 'pool', '', 'image', '-'),
+            rbd.RBDMapping('1', 'fake_pool', '', 'fake_volume', '-'),
+            rbd.RBDMapping('2', 'fake_pool', 'ns', 'fake_volume', 'snap')]
+        self.assertEqual({m.key: m for m in expected}, res)
+        self.assertEqual('/dev/rbd2', expected[2].device)
+
+    def test_get_rbd_mappings_no_module(self):
+        path = self._setup_rbd_sysfs()
+        # sysfs is there but the rbd module is not loaded
+        self.mock_object(rbd, 'RBD_SYSFS_PATH', os.path.join(path, 'missing'))
+        self.assertEqual({}, rbd.RBDConnector.get_rbd_mappings())
+
+    def test_get_rbd_mappings_no_sysfs(self):
+        self.assertIsNone(rbd.RBDConnector.get_rbd_mappings())
+
+    @mock.patch.object(rbd.RBDConnector, '_execute')
+    def test_find_root_device_sysfs(self, mock_execute):
+        self._setup_rbd_sysfs()
+        connector = rbd.RBDConnector(None)
+        res = connector._find_root_device(self.connection_properties, None)
+        self.assertEqual('/dev/rbd1', res)
+
+        conn = dict(self.connection_properties, name='fake_pool/other')
+        self.assertIsNone(connector._find_root_device(conn, None))
+        mock_execute.assert_not_called()
+
+    @mock.patch.object(rbd.RBDConnector, '_execute')
+    def test__local_attach_volume_already_mapped(self, mock_execute):
+        self._setup_rbd_sysfs()
+        connector = rbd.RBDConnector(None, do_local_attach=True)
+        conn = {'name': 'pool/image', 'auth_username': 'fake_user'}
+
+        res = connector._local_attach_volume(conn)
+        # Without the udev symlink we return the kernel's device
+        self.assertEqual({'path': '/dev/rbd0', 'type': 'block'}, res)
+        res = connector._local_attach_volume(conn)
+        self.assertEqual({'path': '/dev/rbd0', 'type': 'block'}, res)
+
+        # The rbd CLI check is done only once
+        mock_execute.assert_called_once_with('which', 'rbd')
+
+    @mock.patch.object(rbd.RBDConnector, '_execute')
+    def test__local_attach_volume_sysfs(self, mock_execute):
+        path = self._setup_rbd_sysfs()
+
+        def map_volume(*cmd, **kwargs):
+            if cmd[:2] == ('rbd', 'map'):
+                os.makedirs(os.path.join(path, '4'))
+                for name, value in (('pool', 'pool'), ('name', 'new')):
+                    with open(os.path.join(path, '4', name), 'w') as f:
+                        f.write(value)
+
+        mock_execute.side_effect = map_volume
+        connector = rbd.RBDConnector(None, do_local_attach=True)
+        conn = {'name': 'pool/new', 'auth_username': 'fake_user'}
+
+        res = connector._local_attach_volume(conn)
+
+        self.assertEqual({'path': '/dev/rbd4', 'type': 'block'}, res)
+        self.assertEqual(2, mock_execute.call_count)
+        mock_execute.assert_called_with(
+            'rbd', 'map', 'new', '--pool', 'pool', '--id', 'fake_user',
+            root_helper=connector._root_helper, run_as_root=True)
+
+    @mock.patch('os.uname')
+    def test__get_rbd_map_options(self, mock_uname):
+        mock_uname.return_value.release = '5.14.0-284.el9.x86_64'
+        connector = rbd.RBDConnector(
+            None, rbd_map_options='queue_depth=256,notrim,lock_on_read')
+        conn = {'rbd_map_options': {'queue_depth': 512,
+                                    'read_from_replica': 'localize',
+                                    'crush_location': 'host:node1',
+                                    'alloc_size': '65536',
+                                    'lock_on_read': False}}
+
+        res = connector._get_rbd_map_options(conn)
+
+        self.assertEqual(['queue_depth=512', 'notrim',
+                          'read_from_replica=localize',
+                          'crush_location=host:node1', 'alloc_size=65536'],
+                         res)
+        self.assertEqual(['queue_depth=256', 'notrim', 'lock_on_read'],
+                         connector._get_rbd_map_options({}))
+        self.assertEqual([], rbd.RBDConnector(None)._get_rbd_map_options({}))
+
+    @mock.patch('os.uname')
+    def test__get_rbd_map_options_old_kernel(self, mock_uname):
+        mock_uname.return_value.release = '4.18.0-553.el8_10.x86_64'
+        connector = rbd.RBDConnector(None)
+        conn = {'rbd_map_options': 'ms_mode=secure,exclusive,rxbounce'}
+        self.assertEqual(['exclusive'],
+                         connector._get_rbd_map_options(conn))
+
+    @ddt.data('unknown=1', 'queue_depth=0', 'queue_depth=many',
+              'alloc_size=1000', 'alloc_size=256', 'lock_timeout=-1',
+              'read_from_replica=nearest', 'ms_mode=fast', 'notrim=yes',
+              {'queue_depth': True}, {'crush_location': ''})
+    def test__get_rbd_map_options_invalid(self, options):
+        connector = rbd.RBDConnector(None)
+        self.assertRaises(exception.InvalidParameterValue,
+                          connector._get_rbd_map_options,
+                          {'rbd_map_options': options})
+
+    @mock.patch('os_brick.privileged.rbd.root_get_rbd_map_options')
+    @mock.patch.object(rbd.RBDConnector, '_execute')
+    def test__local_attach_volume_map_options(self, mock_execute,
+                                              mock_get_options):
+        path = self._setup_rbd_sysfs()
+
+        def map_volume(*cmd, **kwargs):
+            if cmd[:2] == ('rbd', 'map'):
+                os.makedirs(os.path.join(path, '4'))
+                for name, value in (('pool', 'pool'), ('name', 'new')):
+                    with open(os.path.join(path, '4', name), 'w') as f:
+                        f.write(value)
+
+        mock_execute.side_effect = map_volume
+        connector = rbd.RBDConnector(None, do_local_attach=True,
+                                     rbd_map_options={'queue_depth': 256})
+        conn = {'name': 'pool/new', 'auth_username': 'fake_user',
+                'rbd_map_options': 'notrim'}
+
+        connector._local_attach_volume(conn)
+
+        mock_execute.assert_called_with(
+            'rbd', 'map', 'new', '--pool', 'pool', '-o',
+            'queue_depth=256,notrim', '--id', 'fake_user',
+            root_helper=connector._root_helper, run_as_root=True)
+        mock_get_options.assert_called_once_with('/dev/rbd4')
+
+    @mock.patch.object(rbd.RBDConnector, '_execute')
+    def test__local_attach_volume_invalid_map_options(self, mock_execute):
+        connector = rbd.RBDConnector(None, do_local_attach=True)
+        conn = {'name': 'pool/new', 'rbd_map_options': 'bad'}
+        self.assertRaises(exception.InvalidParameterValue,
+                          connector._local_attach_volume, conn)
+        mock_execute.assert_called_once_with('which', 'rbd')
+
+    def test_get_rbd_map_options(self):
+        path = self._setup_rbd_sysfs()
+        with open(os.path.join(path, '0', 'config_info'), 'w') as f:
+            f.write('10.0.0.1:6789 name=admin,key=client.admin,'
+                    'queue_depth=256,notrim pool image -\n')
+        self.assertEqual({'queue_depth': '256', 'notrim': True},
+                         rbd.RBDConnector.get_rbd_map_options('/dev/rbd0'))
+        # Not readable
+        self.assertIsNone(rbd.RBDConnector.get_rbd_map_options('/dev/rbd1'))
+
     @mock.patch.object(rbd.RBDConnector, '_check_valid_device')
     @mock.patch('os_brick.privileged.rbd.check_valid_path')
     @mock.patch.object(rbd, 'open')
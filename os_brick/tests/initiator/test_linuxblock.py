@@ -0,0 +1,262 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+import fixtures
+
+from os_brick.initiator import linuxblock
+from os_brick.tests import base
+
+
+class FakeSysfs(object):
+    """Fake /sys/block tree in a temporary directory."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, 'block'))
+
+    def write(self, name, rel_path, contents):
+        path = os.path.join(self.path, 'block', name, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(contents + '\n')
+
+    def add_device(self, name, dev, size=2097152, ro='0',
+                   scheduler='[none] mq-deadline', hctl=None, **files):
+        self.write(name, 'dev', dev)
+        self.write(name, 'size', str(size))
+        self.write(name, 'ro', ro)
+        self.write(name, 'queue/scheduler', scheduler)
+        for subdir in ('holders', 'slaves'):
+            os.makedirs(os.path.join(self.path, 'block', name, subdir),
+                        exist_ok=True)
+        if hctl:
+            os.makedirs(os.path.join(self.path, 'devices', hctl))
+            os.symlink(os.path.join(self.path, 'devices', hctl),
+                       os.path.join(self.path, 'block', name, 'device'))
+        for rel_path, contents in files.items():
+            self.write(name, rel_path.replace('__', '/'), contents)
+
+    def add_nvme_controller(self, name, nqn, address, state, namespaces):
+        path = os.path.join(self.path, 'class', 'nvme', name)
+        os.makedirs(path)
+        for attr, value in (('subsysnqn', nqn), ('address', address),
+                            ('state', state)):
+            with open(os.path.join(path, attr), 'w') as f:
+                f.write(value + '\n')
+        for ns in namespaces:
+            os.makedirs(os.path.join(path, ns))
+
+    def link(self, holder, slave):
+        os.symlink('../../' + slave,
+                   os.path.join(self.path, 'block', holder, 'slaves', slave))
+        os.symlink('../../' + holder,
+                   os.path.join(self.path, 'block', slave, 'holders', holder))
+
+    def remove_device(self, name):
+        for root, dirs, files in os.walk(
+                os.path.join(self.path, 'block', name), topdown=False):
+            for f in files:
+                os.unlink(os.path.join(root, f))
+            for d in dirs:
+                path = os.path.join(root, d)
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    os.rmdir(path)
+        os.rmdir(os.path.join(self.path, 'block', name))
+
+
+class BlockDeviceTopologyTestCase(base.TestCase):
+    def setUp(self):
+        super(BlockDeviceTopologyTestCase, self).setUp()
+        self.sysfs = FakeSysfs(self.useFixture(fixtures.TempDir()).path)
+        self.wwid = 'naa.600a0b8000112233'
+        self.sysfs.add_device('sda', '8:0', hctl='6:0:2:1',
+                              device__wwid=self.wwid)
+        self.sysfs.add_device('sdb', '8:16', hctl='7:0:1:1',
+                              device__wwid=self.wwid)
+        self.sysfs.add_device('dm-0', '253:0',
+                              dm__uuid='mpath-3600a0b8000112233',
+                              dm__name='mpatha')
+        self.sysfs.link('dm-0', 'sda')
+        self.sysfs.link('dm-0', 'sdb')
+        self.sysfs.add_device('nvme0n1', '259:0', ro='1',
+                              scheduler='none',
+                              wwid='uuid.1234', uuid='1234',
+                              nguid='abcd')
+        self.sysfs.add_device('loop0', '7:0')
+
+    def test_snapshot(self):
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path)
+
+        self.assertEqual(4, len(topology))
+        self.assertNotIn('loop0', topology)
+        sda = topology.get('/dev/sda')
+        self.assertEqual(
+            linuxblock.BlockDevice(name='sda', dev='8:0', size=1073741824,
+                                   ro=False, scheduler='none',
+                                   hctl=('6', '0', '2', '1'), wwid=self.wwid,
+                                   nguid=None, uuid=None, dm_name=None,
+                                   holders=('dm-0',), slaves=()),
+            sda)
+        self.assertEqual('/dev/sda', sda.path)
+        self.assertEqual('3600a0b8000112233', sda.scsi_wwn)
+
+        nvme = topology.get('nvme0n1')
+        self.assertTrue(nvme.ro)
+        self.assertEqual('none', nvme.scheduler)
+        self.assertIsNone(nvme.hctl)
+        self.assertIsNone(nvme.scsi_wwn)
+
+        dm = topology.get('dm-0')
+        self.assertEqual(('sda', 'sdb'), dm.slaves)
+        self.assertEqual('mpatha', dm.dm_name)
+
+    def test_indexes(self):
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path)
+        sda, sdb = topology.get('sda'), topology.get('sdb')
+        dm = topology.get('dm-0')
+        nvme = topology.get('nvme0n1')
+
+        self.assertEqual((sda, sdb), topology.get_by_wwid(self.wwid))
+        self.assertEqual((sda, sdb),
+                         topology.get_by_scsi_wwn('3600a0b8000112233'))
+        self.assertEqual((nvme,), topology.get_by_wwid('uuid.1234'))
+        self.assertEqual((nvme,), topology.get_by_uuid('1234'))
+        self.assertEqual((nvme,), topology.get_by_nguid('abcd'))
+        self.assertEqual(sdb, topology.get_by_hctl(7, 0, 1, 1))
+        self.assertEqual(dm, topology.get_by_dm_name('mpatha'))
+        self.assertEqual(dm, topology.get_multipath('3600a0b8000112233'))
+        self.assertEqual((dm,), topology.get_holders('sda'))
+        self.assertEqual((sda, sdb), topology.get_slaves('dm-0'))
+
+        self.assertEqual((), topology.get_by_wwid('naa.missing'))
+        self.assertIsNone(topology.get_by_hctl(1, 2, 3, 4))
+        self.assertIsNone(topology.get_multipath('missing'))
+        self.assertEqual((), topology.get_holders('sdz'))
+        self.assertEqual((), topology.get_slaves('sdz'))
+
+    def test_immutable(self):
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path)
+
+        def _set_item():
+            topology.devices['sdc'] = None
+
+        self.assertRaises(TypeError, _set_item)
+        self.assertRaises(AttributeError, setattr, topology.get('sda'),
+                          'size', 0)
+
+    def test_snapshot_patterns(self):
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path,
+                                                           patterns=('nvme*',))
+        self.assertEqual(['nvme0n1'], [d.name for d in topology])
+
+        self.sysfs.add_device('nvme0n2', '259:1')
+        self.sysfs.add_device('sdc', '8:32')
+        new = topology.refresh()
+        self.assertEqual(['nvme0n1', 'nvme0n2'],
+                         sorted(d.name for d in new))
+
+    def test_snapshot_no_sysfs(self):
+        topology = linuxblock.BlockDeviceTopology.snapshot('/nonexistent')
+        self.assertEqual(0, len(topology))
+
+    def test_refresh(self):
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path)
+
+        # Extend sda, remove sdb, and add a new nvme namespace
+        self.sysfs.write('sda', 'size', '4194304')
+        self.sysfs.write('sdb', 'size', '4194304')
+        os.unlink(os.path.join(self.sysfs.path, 'block/dm-0/slaves/sdb'))
+        self.sysfs.remove_device('sdb')
+        self.sysfs.add_device('nvme0n2', '259:1', wwid='uuid.5678',
+                              uuid='5678')
+
+        new = topology.refresh()
+        self.assertIsNot(topology, new)
+        self.assertEqual(4, len(new))
+        self.assertNotIn('sdb', new)
+        self.assertIsNone(new.get_by_hctl(7, 0, 1, 1))
+        self.assertEqual(('sda',), new.get('dm-0').slaves)
+        self.assertEqual('5678', new.get('nvme0n2').uuid)
+        # Known devices are not read again unless requested
+        self.assertEqual(1073741824, new.get('sda').size)
+        # Original snapshot is unchanged
+        self.assertIn('sdb', topology)
+        self.assertEqual(('sda', 'sdb'), topology.get('dm-0').slaves)
+
+        new = topology.refresh(['sda'])
+        self.assertEqual(2147483648, new.get('sda').size)
+
+    def test_nvme_controllers(self):
+        self.sysfs.add_nvme_controller('nvme0', 'nqn.a',
+                                       'traddr=10.0.0.1,trsvcid=4420', 'live',
+                                       ('nvme0c0n1', 'nvme0c0n2'))
+        self.sysfs.add_nvme_controller('nvme1', 'nqn.a',
+                                       'traddr=10.0.0.2,trsvcid=4420',
+                                       'connecting', ('nvme0c1n1',))
+        self.sysfs.add_nvme_controller('nvme2', 'nqn.b',
+                                       'traddr=10.0.0.3,trsvcid=4420', 'live',
+                                       ('nvme2n1',))
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path)
+
+        nvme0, nvme1, nvme2 = (topology.nvme_controllers[name]
+                               for name in ('nvme0', 'nvme1', 'nvme2'))
+        self.assertEqual(
+            linuxblock.NVMeController(
+                name='nvme0', nqn='nqn.a',
+                address='traddr=10.0.0.1,trsvcid=4420', state='live',
+                namespaces=('nvme0n1', 'nvme0n2')),
+            nvme0)
+        self.assertEqual((nvme0, nvme1),
+                         topology.get_nvme_controllers('nqn.a'))
+        self.assertEqual((nvme0, nvme1),
+                         topology.get_namespace_controllers('/dev/nvme0n1'))
+        self.assertEqual((nvme0,),
+                         topology.get_namespace_controllers('nvme0n2'))
+        self.assertEqual((nvme2,),
+                         topology.get_namespace_controllers('nvme2n1'))
+        self.assertEqual((), topology.get_nvme_controllers('nqn.missing'))
+
+        # Controllers are always read again
+        self.sysfs.add_nvme_controller('nvme3', 'nqn.b',
+                                       'traddr=10.0.0.4,trsvcid=4420', 'live',
+                                       ('nvme2n1',))
+        new = topology.refresh()
+        self.assertEqual(['nvme2', 'nvme3'],
+                         [c.name for c in new.get_nvme_controllers('nqn.b')])
+
+        # Snapshots without NVMe namespaces don't read them
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path,
+                                                           patterns=('sd*',))
+        self.assertEqual({}, dict(topology.nvme_controllers))
+
+    def test_read_sysfs(self):
+        self.assertEqual('8:0', linuxblock.read_sysfs(self.sysfs.path, 'block',
+                                                      'sda', 'dev'))
+        self.assertIsNone(linuxblock.read_sysfs(self.sysfs.path, 'missing'))
+        self.assertEqual(('dev', 'dm', 'holders', 'queue', 'ro', 'size',
+                          'slaves'),
+                         linuxblock.list_sysfs(self.sysfs.path, 'block',
+                                               'dm-0'))
+        self.assertEqual((), linuxblock.list_sysfs(self.sysfs.path, 'missing'))
+
+    def test_refresh_reused_name(self):
+        topology = linuxblock.BlockDeviceTopology.snapshot(self.sysfs.path)
+        self.sysfs.write('nvme0n1', 'dev', '259:7')
+        self.sysfs.write('nvme0n1', 'uuid', '9999')
+
+        new = topology.refresh()
+        self.assertEqual('9999', new.get('nvme0n1').uuid)
+        self.assertEqual((), new.get_by_uuid('1234'))
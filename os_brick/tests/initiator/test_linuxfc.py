@@ -15,6 +15,7 @@
 import os.path
 from unittest import mock
 
+import fixtures
 
 from os_brick.initiator import linuxfc
 from os_brick.tests import base
@@ -26,9 +27,11 @@ class LinuxFCTestCase(base.TestCase):
         super(LinuxFCTestCase, self).setUp()
         self.cmds = []
 
+        self._real_path_funcs = (os.path.exists, os.path.isdir)
         self.mock_object(os.path, 'exists', return_value=True)
         self.mock_object(os.path, 'isdir', return_value=True)
         self.lfc = linuxfc.LinuxFibreChannel(None, execute=self.fake_execute)
+        self.mock_object(self.lfc, 'get_fc_targets_index', return_value={})
 
     def fake_execute(self, *cmd, **kwargs):
         self.cmds.append(" ".join(cmd))
@@ -80,163 +83,135 @@ class LinuxFCTestCase(base.TestCase):
             del connection_properties['initiator_target_lun_map']
         return hbas, connection_properties
 
+    def _add_sysfs_dir(self, *path, **attrs):
+        path = os.path.join(self.sysfs, *path)
+        os.makedirs(path)
+        for attr, value in attrs.items():
+            with open(os.path.join(path, attr), 'w') as f:
+                f.write(value + '\n')
+
+    def _setup_fc_targets(self):
+        self.sysfs = self.useFixture(fixtures.TempDir()).path
+        self.mock_object(linuxfc, 'FC_TRANSPORT_SYSFS_PATH',
+                         os.path.join(self.sysfs, 'fc_transport'))
+        self.mock_object(linuxfc, 'FC_REMOTE_PORTS_SYSFS_PATH',
+                         os.path.join(self.sysfs, 'fc_remote_ports'))
+        # We need a real filesystem for the fake sysfs
+        self.mock_object(os.path, 'exists', self._real_path_funcs[0])
+        self.mock_object(os.path, 'isdir', self._real_path_funcs[1])
+        for name, wwpn in (('target6:0:1', '0x514F0C50023F6C00'),
+                           ('target6:0:2', '0x514f0c50023f6c01'),
+                           ('target7:0:1', '0x514f0c50023f6c01')):
+            self._add_sysfs_dir('fc_transport', name, port_name=wwpn)
+        for name, wwpn, target_id in (
+                ('rport-6:0-1', '0x514f0c50023f6c00', '1'),
+                ('rport-6:0-2', '0x514f0c50023f6c01', '2'),
+                # Target without fc_transport entry
+                ('rport-7:0-3', '0x514f0c50023f6c00', '3'),
+                # Initiator port
+                ('rport-7:0-4', '0x514f0c50023f6c02', '-1')):
+            self._add_sysfs_dir('fc_remote_ports', name, port_name=wwpn,
+                                scsi_target_id=target_id)
+
+    def test_get_fc_targets_index(self):
+        self._setup_fc_targets()
+        res = linuxfc.LinuxFibreChannel.get_fc_targets_index()
+        expected = {'514f0c50023f6c00': [('6', '0', '1'), ('7', '0', '3')],
+                    '514f0c50023f6c01': [('6', '0', '2'), ('7', '0', '1')]}
+        self.assertEqual(expected, res)
+        self.assertEqual([], self.cmds)
+
+    def test_get_fc_targets_index_no_sysfs(self):
+        self.mock_object(linuxfc, 'FC_TRANSPORT_SYSFS_PATH', '/nonexistent')
+        self.mock_object(linuxfc, 'FC_REMOTE_PORTS_SYSFS_PATH',
+                         '/nonexistent')
+        self.assertEqual({}, linuxfc.LinuxFibreChannel.get_fc_targets_index())
+
+    TARGETS_INDEX = {'514f0c50023f6c00': [('6', '0', '1'), ('7', '0', '1')],
+                     '514f0c50023f6c01': [('6', '0', '2')]}
+
     def test__get_hba_channel_scsi_target_lun_single_wwpn(self):
-        execute_results = ('/sys/class/fc_transport/target6:0:1/port_name\n',
-                           '')
         hbas, con_props = self.__get_rescan_info()
         con_props['target_wwn'] = con_props['target_wwn'][0]
         con_props['targets'] = con_props['targets'][0:1]
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=execute_results) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            execute_mock.assert_called_once_with(
-                'grep -Gil "514f0c50023f6c00" '
-                '/sys/class/fc_transport/target6:*/port_name',
-                shell=True)
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props,
+                                                        self.TARGETS_INDEX)
         expected = ([['0', '1', 1]], set())
         self.assertEqual(expected, res)
 
+    def test__get_hba_channel_scsi_target_lun_builds_index(self):
+        self._setup_fc_targets()
+        hbas, con_props = self.__get_rescan_info()
+        con_props['targets'] = [('514F0C50023F6C00', 1)]
+        lfc = linuxfc.LinuxFibreChannel(None, execute=self.fake_execute)
+        res = lfc._get_hba_channel_scsi_target_lun(hbas[1], con_props)
+        expected = ([['0', '3', 1]], set())
+        self.assertEqual(expected, res)
+        self.assertEqual([], self.cmds)
+
     def test__get_hba_channel_scsi_target_lun_with_initiator_target_map(self):
-        execute_results = ('/sys/class/fc_transport/target6:0:1/port_name\n',
-                           '')
         hbas, con_props = self.__get_rescan_info(zone_manager=True)
         con_props['target_wwn'] = con_props['target_wwn'][0]
         con_props['targets'] = con_props['targets'][0:1]
         hbas[0]['port_name'] = '50014380186af83e'
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=execute_results) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            execute_mock.assert_called_once_with(
-                'grep -Gil "514f0c50023f6c01" '
-                '/sys/class/fc_transport/target6:*/port_name',
-                shell=True)
-        expected = ([['0', '1', 1]], set())
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props,
+                                                        self.TARGETS_INDEX)
+        expected = ([['0', '2', 1]], set())
         self.assertEqual(expected, res)
 
     def test__get_hba_channel_scsi_target_lun_with_initiator_target_map_none(
             self):
-        execute_results = ('/sys/class/fc_transport/target6:0:1/port_name\n',
-                           '')
         hbas, con_props = self.__get_rescan_info()
         con_props['target_wwn'] = con_props['target_wwn'][0]
         con_props['targets'] = con_props['targets'][0:1]
         con_props['initiator_target_map'] = None
         hbas[0]['port_name'] = '50014380186af83e'
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=execute_results) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            execute_mock.assert_called_once_with(
-                'grep -Gil "514f0c50023f6c00" '
-                '/sys/class/fc_transport/target6:*/port_name',
-                shell=True)
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props,
+                                                        self.TARGETS_INDEX)
         expected = ([['0', '1', 1]], set())
         self.assertEqual(expected, res)
 
     def test__get_hba_channel_scsi_target_lun_multiple_wwpn(self):
-        execute_results = [
-            ['/sys/class/fc_transport/target6:0:1/port_name\n', ''],
-            ['/sys/class/fc_transport/target6:0:2/port_name\n', ''],
-        ]
         hbas, con_props = self.__get_rescan_info()
-        with mock.patch.object(self.lfc, '_execute',
-                               side_effect=execute_results) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            expected_cmds = [
-                mock.call('grep -Gil "514f0c50023f6c00" '
-                          '/sys/class/fc_transport/target6:*/port_name',
-                          shell=True),
-                mock.call('grep -Gil "514f0c50023f6c01" '
-                          '/sys/class/fc_transport/target6:*/port_name',
-                          shell=True),
-            ]
-            execute_mock.assert_has_calls(expected_cmds)
-
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props,
+                                                        self.TARGETS_INDEX)
         expected = ([['0', '1', 1], ['0', '2', 1]], set())
         self.assertEqual(expected, res)
 
     def test__get_hba_channel_scsi_target_lun_multiple_wwpn_and_luns(self):
-        execute_results = [
-            ['/sys/class/fc_transport/target6:0:1/port_name\n', ''],
-            ['/sys/class/fc_transport/target6:0:2/port_name\n', ''],
-        ]
         hbas, con_props = self.__get_rescan_info()
         con_props['target_lun'] = [1, 7]
         con_props['targets'] = [
             ('514f0c50023f6c00', 1),
             ('514f0c50023f6c01', 7),
         ]
-        with mock.patch.object(self.lfc, '_execute',
-                               side_effect=execute_results) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            expected_cmds = [
-                mock.call('grep -Gil "514f0c50023f6c00" '
-                          '/sys/class/fc_transport/target6:*/port_name',
-                          shell=True),
-                mock.call('grep -Gil "514f0c50023f6c01" '
-                          '/sys/class/fc_transport/target6:*/port_name',
-                          shell=True),
-            ]
-            execute_mock.assert_has_calls(expected_cmds)
-
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props,
+                                                        self.TARGETS_INDEX)
         expected = ([['0', '1', 1], ['0', '2', 7]], set())
         self.assertEqual(expected, res)
 
     def test__get_hba_channel_scsi_target_lun_zone_manager(self):
-        execute_results = ('/sys/class/fc_transport/target6:0:1/port_name\n',
-                           '')
         hbas, con_props = self.__get_rescan_info(zone_manager=True)
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=execute_results) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            execute_mock.assert_called_once_with(
-                'grep -Gil "514f0c50023f6c00" '
-                '/sys/class/fc_transport/target6:*/port_name',
-                shell=True)
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props,
+                                                        self.TARGETS_INDEX)
         expected = ([['0', '1', 1]], set())
         self.assertEqual(expected, res)
 
     def test__get_hba_channel_scsi_target_lun_not_found(self):
         hbas, con_props = self.__get_rescan_info(zone_manager=True)
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=('', '')) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            execute_mock.assert_called_once_with(
-                'grep -Gil "514f0c50023f6c00" '
-                '/sys/class/fc_transport/target6:*/port_name',
-                shell=True)
-        self.assertEqual(([], set()), res)
-
-    def test__get_hba_channel_scsi_target_lun_exception(self):
-        hbas, con_props = self.__get_rescan_info(zone_manager=True)
-        with mock.patch.object(self.lfc, '_execute',
-                               side_effect=Exception) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            execute_mock.assert_called_once_with(
-                'grep -Gil "514f0c50023f6c00" '
-                '/sys/class/fc_transport/target6:*/port_name',
-                shell=True)
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[1], con_props,
+                                                        self.TARGETS_INDEX)
         self.assertEqual(([], {1}), res)
 
-    def test__get_hba_channel_scsi_target_lun_some_exception(self):
-        execute_effects = [
-            ('/sys/class/fc_transport/target6:0:1/port_name\n', ''),
-            Exception()
-        ]
-        expected_cmds = [
-            mock.call('grep -Gil "514f0c50023f6c00" '
-                      '/sys/class/fc_transport/target6:*/port_name',
-                      shell=True),
-            mock.call('grep -Gil "514f0c50023f6c01" '
-                      '/sys/class/fc_transport/target6:*/port_name',
-                      shell=True),
-        ]
+    def test__get_hba_channel_scsi_target_lun_some_not_found(self):
         hbas, con_props = self.__get_rescan_info()
-
-        with mock.patch.object(self.lfc, '_execute',
-                               side_effect=execute_effects) as execute_mock:
-            res = self.lfc._get_hba_channel_scsi_target_lun(hbas[0], con_props)
-            execute_mock.assert_has_calls(expected_cmds)
-        expected = ([['0', '1', 1]], {1})
+        con_props['targets'] = [
+            ('514f0c50023f6c00', 1),
+            ('514f0c50023f6c01', 7),
+        ]
+        res = self.lfc._get_hba_channel_scsi_target_lun(hbas[1], con_props,
+                                                        self.TARGETS_INDEX)
+        expected = ([['0', '1', 1]], {7})
         self.assertEqual(expected, res)
 
     def test_rescan_hosts_initiator_map(self):
@@ -254,28 +229,22 @@ class LinuxFCTestCase(base.TestCase):
                      'node_name': '50014380186af83g',
                      'port_name': '50014380186af83h'})
 
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=None) as execute_mock, \
+        with mock.patch.object(linuxfc.priv_rootwrap,
+                               'write_sys') as write_mock, \
             mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
                               side_effect=get_chan_results) as mock_get_chan:
 
             self.lfc.rescan_hosts(hbas, con_props)
             expected_commands = [
-                mock.call('tee', '-a', '/sys/class/scsi_host/host6/scan',
-                          process_input='2 3 1',
-                          root_helper=None, run_as_root=True),
-                mock.call('tee', '-a', '/sys/class/scsi_host/host6/scan',
-                          process_input='4 5 1',
-                          root_helper=None, run_as_root=True),
-                mock.call('tee', '-a', '/sys/class/scsi_host/host7/scan',
-                          process_input='6 7 1',
-                          root_helper=None, run_as_root=True)]
-
-            execute_mock.assert_has_calls(expected_commands)
-            self.assertEqual(len(expected_commands), execute_mock.call_count)
-
-            expected_calls = [mock.call(hbas[0], con_props),
-                              mock.call(hbas[1], con_props)]
+                mock.call('/sys/class/scsi_host/host6/scan', '2 3 1'),
+                mock.call('/sys/class/scsi_host/host6/scan', '4 5 1'),
+                mock.call('/sys/class/scsi_host/host7/scan', '6 7 1')]
+
+            write_mock.assert_has_calls(expected_commands, any_order=True)
+            self.assertEqual(len(expected_commands), write_mock.call_count)
+
+            expected_calls = [mock.call(hbas[0], con_props, {}),
+                              mock.call(hbas[1], con_props, {})]
             mock_get_chan.assert_has_calls(expected_calls)
 
     def test_rescan_hosts_single_wwnn(self):
@@ -295,28 +264,22 @@ class LinuxFCTestCase(base.TestCase):
                      'node_name': '50014380186af83g',
                      'port_name': '50014380186af83h'})
 
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=None) as execute_mock, \
+        with mock.patch.object(linuxfc.priv_rootwrap,
+                               'write_sys') as write_mock, \
             mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
                               side_effect=get_chan_results) as mock_get_chan:
 
             self.lfc.rescan_hosts(hbas, con_props)
             expected_commands = [
-                mock.call('tee', '-a', '/sys/class/scsi_host/host6/scan',
-                          process_input='2 3 1',
-                          root_helper=None, run_as_root=True),
-                mock.call('tee', '-a', '/sys/class/scsi_host/host6/scan',
-                          process_input='4 5 1',
-                          root_helper=None, run_as_root=True),
-                mock.call('tee', '-a', '/sys/class/scsi_host/host7/scan',
-                          process_input='6 7 1',
-                          root_helper=None, run_as_root=True)]
-
-            execute_mock.assert_has_calls(expected_commands)
-            self.assertEqual(len(expected_commands), execute_mock.call_count)
-
-            expected_calls = [mock.call(hbas[0], con_props),
-                              mock.call(hbas[1], con_props)]
+                mock.call('/sys/class/scsi_host/host6/scan', '2 3 1'),
+                mock.call('/sys/class/scsi_host/host6/scan', '4 5 1'),
+                mock.call('/sys/class/scsi_host/host7/scan', '6 7 1')]
+
+            write_mock.assert_has_calls(expected_commands, any_order=True)
+            self.assertEqual(len(expected_commands), write_mock.call_count)
+
+            expected_calls = [mock.call(hbas[0], con_props, {}),
+                              mock.call(hbas[1], con_props, {})]
             mock_get_chan.assert_has_calls(expected_calls)
 
     def test_rescan_hosts_initiator_map_single_wwnn(self):
@@ -326,25 +289,21 @@ class LinuxFCTestCase(base.TestCase):
 
         hbas, con_props = self.__get_rescan_info(zone_manager=True)
 
-        with mock.patch.object(self.lfc, '_execute',
-                               return_value=None) as execute_mock, \
+        with mock.patch.object(linuxfc.priv_rootwrap,
+                               'write_sys') as write_mock, \
             mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
                               side_effect=get_chan_results) as mock_get_chan:
 
             self.lfc.rescan_hosts(hbas, con_props)
             expected_commands = [
-                mock.call('tee', '-a', '/sys/class/scsi_host/host6/scan',
-                          process_input='2 3 1',
-                          root_helper=None, run_as_root=True),
-                mock.call('tee', '-a', '/sys/class/scsi_host/host6/scan',
-                          process_input='4 5 1',
-                          root_helper=None, run_as_root=True)]
-
-            execute_mock.assert_has_calls(expected_commands)
-            self.assertEqual(len(expected_commands), execute_mock.call_count)
-
-            expected_calls = [mock.call(hbas[0], con_props),
-                              mock.call(hbas[1], con_props)]
+                mock.call('/sys/class/scsi_host/host6/scan', '2 3 1'),
+                mock.call('/sys/class/scsi_host/host6/scan', '4 5 1')]
+
+            write_mock.assert_has_calls(expected_commands, any_order=True)
+            self.assertEqual(len(expected_commands), write_mock.call_count)
+
+            expected_calls = [mock.call(hbas[0], con_props, {}),
+                              mock.call(hbas[1], con_props, {})]
             mock_get_chan.assert_has_calls(expected_calls)
 
     def test_rescan_hosts_port_not_found(self):
@@ -356,20 +315,16 @@ class LinuxFCTestCase(base.TestCase):
         con_props.pop('initiator_target_lun_map')
         with mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
                                side_effect=get_chan_results), \
-            mock.patch.object(self.lfc, '_execute',
-                              side_effect=None) as execute_mock:
+            mock.patch.object(linuxfc.priv_rootwrap,
+                              'write_sys') as write_mock:
 
             self.lfc.rescan_hosts(hbas, con_props)
 
             expected_commands = [
-                mock.call('tee', '-a', '/sys/class/scsi_host/host6/scan',
-                          process_input='- - 1',
-                          root_helper=None, run_as_root=True),
-                mock.call('tee', '-a', '/sys/class/scsi_host/host7/scan',
-                          process_input='- - 1',
-                          root_helper=None, run_as_root=True)]
-            execute_mock.assert_has_calls(expected_commands)
-            self.assertEqual(len(expected_commands), execute_mock.call_count)
+                mock.call('/sys/class/scsi_host/host6/scan', '- - 1'),
+                mock.call('/sys/class/scsi_host/host7/scan', '- - 1')]
+            write_mock.assert_has_calls(expected_commands, any_order=True)
+            self.assertEqual(len(expected_commands), write_mock.call_count)
 
     def test_rescan_hosts_port_not_found_driver_disables_wildcards(self):
         """Test when we don't find the target ports but driver forces scan."""
@@ -378,142 +333,250 @@ class LinuxFCTestCase(base.TestCase):
         con_props['enable_wildcard_scan'] = False
         with mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
                                side_effect=get_chan_results), \
-            mock.patch.object(self.lfc, '_execute',
-                              side_effect=None) as execute_mock:
+            mock.patch.object(linuxfc.priv_rootwrap,
+                              'write_sys') as write_mock:
 
             self.lfc.rescan_hosts(hbas, con_props)
-            execute_mock.assert_not_called()
+            write_mock.assert_not_called()
 
-    def test_get_fc_hbas_fail(self):
-        def fake_exec1(a, b, c, d, run_as_root=True, root_helper='sudo'):
-            raise OSError
+    @mock.patch.object(linuxfc.executor, 'Thread')
+    @mock.patch.object(linuxfc.LinuxFibreChannel, '_scan_hba')
+    def test_rescan_hosts_concurrent(self, scan_mock, thread_mock):
+        get_chan_results = [([['0', '1', 1]], set()), ([['0', '2', 1]], set())]
+        hbas, con_props = self.__get_rescan_info(zone_manager=True)
+        with mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
+                               side_effect=get_chan_results):
+            self.lfc.rescan_hosts(hbas, con_props)
+
+        scan_mock.assert_not_called()
+        self.assertEqual(
+            [mock.call(target=self.lfc._scan_hba,
+                       args=(hbas[0], [['0', '1', 1]], mock.ANY)),
+             mock.call(target=self.lfc._scan_hba,
+                       args=(hbas[1], [['0', '2', 1]], mock.ANY))],
+            thread_mock.call_args_list)
+        self.assertEqual(2, thread_mock.return_value.start.call_count)
+        self.assertEqual(2, thread_mock.return_value.join.call_count)
+
+    @mock.patch.object(linuxfc.executor, 'Thread')
+    def test_rescan_hosts_single_hba_not_threaded(self, thread_mock):
+        hbas, con_props = self.__get_rescan_info(zone_manager=True)
+        with mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
+                               side_effect=[([['0', '1', 1]], set())]), \
+                mock.patch.object(linuxfc.priv_rootwrap,
+                                  'write_sys') as write_mock:
+            self.lfc.rescan_hosts(hbas[:1], con_props)
+
+        thread_mock.assert_not_called()
+        write_mock.assert_called_once_with('/sys/class/scsi_host/host6/scan',
+                                           '0 1 1')
+
+    def test_rescan_hosts_fail(self):
+        get_chan_results = [([['0', '1', 1], ['0', '2', 1]], set()),
+                            ([['0', '3', 1]], set())]
+        hbas, con_props = self.__get_rescan_info(zone_manager=True)
+        error = OSError('Device busy')
 
-        def fake_exec2(a, b, c, d, run_as_root=True, root_helper='sudo'):
-            return None, 'None found'
+        def write_sys(path, content):
+            if content == '0 1 1':
+                raise error
 
-        self.lfc._execute = fake_exec1
+        with mock.patch.object(self.lfc, '_get_hba_channel_scsi_target_lun',
+                               side_effect=get_chan_results), \
+                mock.patch.object(linuxfc.priv_rootwrap, 'write_sys',
+                                  side_effect=write_sys) as write_mock:
+            exc = self.assertRaises(OSError, self.lfc.rescan_hosts, hbas,
+                                    con_props)
+
+        self.assertIs(error, exc)
+        # A failed scan doesn't prevent the others from happening
+        self.assertEqual(3, write_mock.call_count)
+
+    def _add_fc_host(self, host, device_path, **attrs):
+        """Create an HBA in the fake /sys/class/fc_host directory."""
+        device_dir = os.path.join(self.sysfs, device_path.lstrip('/'))
+        os.makedirs(os.path.join(device_dir, 'power'))
+        os.symlink(device_dir, os.path.join(self.fc_host_path, host))
+        attrs.setdefault('uevent', '')
+        for attr, value in attrs.items():
+            with open(os.path.join(device_dir, attr), 'w') as f:
+                f.write(value + '\n')
+        # Store only attributes fail to open for reading, even for root
+        os.mkdir(os.path.join(device_dir, 'issue_lip'))
+
+    def _add_fc_hosts(self, port_state='Online'):
+        for host, pci, port_name, node_name in (
+                ('host0', '0000:21:00.0', '0x50014380242b9750',
+                 '0x50014380242b9751'),
+                ('host2', '0000:21:00.1', '0x50014380242b9752',
+                 '0x50014380242b9753')):
+            self._add_fc_host(
+                host,
+                '/devices/pci0000:20/0000:20:03.0/%s/%s/fc_host/%s' %
+                (pci, host, host),
+                port_name=port_name,
+                node_name=node_name,
+                port_state=port_state,
+                port_type='NPort (fabric via point-to-point)',
+                speed='8 Gbit')
+
+    def _setup_fc_host(self):
+        # We need a real filesystem for the fake sysfs
+        self.mock_object(os.path, 'exists', self._real_path_funcs[0])
+        self.mock_object(os.path, 'isdir', self._real_path_funcs[1])
+        self.sysfs = self.useFixture(fixtures.TempDir()).path
+        self.fc_host_path = os.path.join(self.sysfs, 'class', 'fc_host')
+        os.makedirs(self.fc_host_path)
+        self.mock_object(linuxfc, 'FC_HOST_SYSFS_PATH', self.fc_host_path)
+        self.mock_object(linuxfc.LinuxFibreChannel, '_hbas_cache', {})
+
+    def _hba_device_path(self, pci, host):
+        return os.path.join(self.sysfs, 'devices/pci0000:20/0000:20:03.0',
+                            pci, host, 'fc_host', host)
+
+    def test_get_fc_hbas_no_fc_support(self):
+        self.mock_object(os.path, 'isdir', return_value=False)
+        with mock.patch('os.listdir') as mock_listdir:
+            hbas = self.lfc.get_fc_hbas()
+        self.assertEqual([], hbas)
+        mock_listdir.assert_not_called()
+
+    def test_get_fc_hbas_fail(self):
+        self.mock_object(linuxfc, 'FC_HOST_SYSFS_PATH', '/nonexistent')
         hbas = self.lfc.get_fc_hbas()
         self.assertEqual(0, len(hbas))
-        self.lfc._execute = fake_exec2
+
+    def test_get_fc_hbas_none(self):
+        self._setup_fc_host()
         hbas = self.lfc.get_fc_hbas()
         self.assertEqual(0, len(hbas))
+        self.assertEqual([], self.cmds)
 
     def test_get_fc_hbas(self):
-        def fake_exec(a, b, c, d, run_as_root=True, root_helper='sudo'):
-            return SYSTOOL_FC, None
-        self.lfc._execute = fake_exec
+        self._setup_fc_host()
+        self._add_fc_hosts()
         hbas = self.lfc.get_fc_hbas()
         self.assertEqual(2, len(hbas))
-        hba1 = hbas[0]
-        self.assertEqual("host0", hba1["ClassDevice"])
-        hba2 = hbas[1]
-        self.assertEqual("host2", hba2["ClassDevice"])
+        expected = {'ClassDevice': 'host0',
+                    'ClassDevicepath': self._hba_device_path('0000:21:00.0',
+                                                             'host0'),
+                    'node_name': '0x50014380242b9751',
+                    'port_name': '0x50014380242b9750',
+                    'port_state': 'Online',
+                    'port_type': 'NPort (fabric via point-to-point)',
+                    'speed': '8 Gbit'}
+        self.assertEqual(expected, hbas[0])
+        self.assertEqual("host2", hbas[1]["ClassDevice"])
+        self.assertEqual([], self.cmds)
+
+    def test_get_fc_hbas_sorted(self):
+        self._setup_fc_host()
+        for host in ('host10', 'host9'):
+            self._add_fc_host(host, '/devices/%s/fc_host/%s' % (host, host),
+                              port_name='0x1', node_name='0x2')
+        hbas = self.lfc.get_fc_hbas()
+        self.assertEqual(['host9', 'host10'],
+                         [hba['ClassDevice'] for hba in hbas])
+
+    def test_get_fc_hbas_cached(self):
+        self._setup_fc_host()
+        self._add_fc_hosts()
+        hbas = self.lfc.get_fc_hbas()
+        # Returned data is a copy
+        hbas[0]['port_name'] = 'changed'
+
+        device_path = os.path.realpath(
+            os.path.join(self.fc_host_path, 'host0'))
+        with open(os.path.join(device_path, 'speed'), 'w') as f:
+            f.write('16 Gbit\n')
+        with open(os.path.join(device_path, 'port_state'), 'w') as f:
+            f.write('Linkdown\n')
+
+        with mock.patch.object(self.lfc, '_read_fc_host',
+                               wraps=self.lfc._read_fc_host) as read_mock:
+            hbas = self.lfc.get_fc_hbas()
+            read_mock.assert_not_called()
+
+            # Port state is read again, the rest comes from the cache
+            self.assertEqual('0x50014380242b9750', hbas[0]['port_name'])
+            self.assertEqual('Linkdown', hbas[0]['port_state'])
+            self.assertEqual('8 Gbit', hbas[0]['speed'])
+
+            hbas = self.lfc.get_fc_hbas(refresh=True)
+            self.assertEqual(2, read_mock.call_count)
+            self.assertEqual('16 Gbit', hbas[0]['speed'])
+
+    def test_get_fc_hbas_cache_invalidation(self):
+        self._setup_fc_host()
+        self._add_fc_hosts()
+        self.assertEqual(2, len(self.lfc.get_fc_hbas()))
+
+        # HBA removed
+        os.unlink(os.path.join(self.fc_host_path, 'host2'))
+        hbas = self.lfc.get_fc_hbas()
+        self.assertEqual(['host0'], [hba['ClassDevice'] for hba in hbas])
+
+        # HBA added
+        self._add_fc_host('host3', '/devices/host3/fc_host/host3',
+                          port_name='0x3', node_name='0x4')
+        hbas = self.lfc.get_fc_hbas()
+        self.assertEqual(['host0', 'host3'],
+                         [hba['ClassDevice'] for hba in hbas])
+        self.assertEqual('0x4', hbas[1]['node_name'])
+
+        # HBA replaced using the same host name
+        device_path = os.path.realpath(
+            os.path.join(self.fc_host_path, 'host3'))
+        for attr, value in (('port_name', '0x5'), ('node_name', '0x6')):
+            with open(os.path.join(device_path, attr), 'w') as f:
+                f.write(value + '\n')
+        hbas = self.lfc.get_fc_hbas()
+        self.assertEqual('0x5', hbas[1]['port_name'])
+        self.assertEqual('0x6', hbas[1]['node_name'])
 
     def test_get_fc_hbas_info(self):
-        def fake_exec(a, b, c, d, run_as_root=True, root_helper='sudo'):
-            return SYSTOOL_FC, None
-        self.lfc._execute = fake_exec
+        self._setup_fc_host()
+        self._add_fc_hosts()
         hbas_info = self.lfc.get_fc_hbas_info()
-        expected_info = [{'device_path': '/sys/devices/pci0000:20/'
-                                         '0000:20:03.0/0000:21:00.0/'
-                                         'host0/fc_host/host0',
+        expected_info = [{'device_path': self._hba_device_path(
+                          '0000:21:00.0', 'host0'),
                           'host_device': 'host0',
                           'node_name': '50014380242b9751',
                           'port_name': '50014380242b9750'},
-                         {'device_path': '/sys/devices/pci0000:20/'
-                                         '0000:20:03.0/0000:21:00.1/'
-                                         'host2/fc_host/host2',
+                         {'device_path': self._hba_device_path(
+                          '0000:21:00.1', 'host2'),
                           'host_device': 'host2',
                           'node_name': '50014380242b9753',
                           'port_name': '50014380242b9752'}, ]
         self.assertEqual(expected_info, hbas_info)
 
-    def test_get_fc_wwpns(self):
-        def fake_exec(a, b, c, d, run_as_root=True, root_helper='sudo'):
-            return SYSTOOL_FC, None
+    @mock.patch.object(linuxfc.LinuxFibreChannel, 'get_fc_hbas',
+                       return_value=[])
+    def test_get_fc_hbas_info_refresh(self, get_hbas_mock):
+        self.lfc.get_fc_hbas_info(refresh=True)
+        get_hbas_mock.assert_called_once_with(refresh=True)
 
-        self.lfc._execute = fake_exec
+    def test_get_fc_wwpns(self):
+        self._setup_fc_host()
+        self._add_fc_hosts()
         wwpns = self.lfc.get_fc_wwpns()
         expected_wwpns = ['50014380242b9750', '50014380242b9752']
         self.assertEqual(expected_wwpns, wwpns)
 
+    def test_get_fc_wwpns_offline(self):
+        self._setup_fc_host()
+        self._add_fc_hosts(port_state='Linkdown')
+        self.assertEqual([], self.lfc.get_fc_wwpns())
+        self.assertEqual([], self.lfc.get_fc_wwnns())
+
     def test_get_fc_wwnns(self):
-        def fake_exec(a, b, c, d, run_as_root=True, root_helper='sudo'):
-            return SYSTOOL_FC, None
-        self.lfc._execute = fake_exec
-        wwnns = self.lfc.get_fc_wwpns()
-        expected_wwnns = ['50014380242b9750', '50014380242b9752']
+        self._setup_fc_host()
+        self._add_fc_hosts()
+        wwnns = self.lfc.get_fc_wwnns()
+        expected_wwnns = ['50014380242b9751', '50014380242b9753']
         self.assertEqual(expected_wwnns, wwnns)
 
 
-SYSTOOL_FC = """
-Class = "fc_host"
-
-  Class Device = "host0"
-  Class Device path = "/sys/devices/pci0000:20/0000:20:03.0/\
-0000:21:00.0/host0/fc_host/host0"
-    dev_loss_tmo        = "16"
-    fabric_name         = "0x100000051ea338b9"
-    issue_lip           = <store method only>
-    max_npiv_vports     = "0"
-    node_name           = "0x50014380242b9751"
-    npiv_vports_inuse   = "0"
-    port_id             = "0x960d0d"
-    port_name           = "0x50014380242b9750"
-    port_state          = "Online"
-    port_type           = "NPort (fabric via point-to-point)"
-    speed               = "8 Gbit"
-    supported_classes   = "Class 3"
-    supported_speeds    = "1 Gbit, 2 Gbit, 4 Gbit, 8 Gbit"
-    symbolic_name       = "QMH2572 FW:v4.04.04 DVR:v8.03.07.12-k"
-    system_hostname     = ""
-    tgtid_bind_type     = "wwpn (World Wide Port Name)"
-    uevent              =
-    vport_create        = <store method only>
-    vport_delete        = <store method only>
-
-    Device = "host0"
-    Device path = "/sys/devices/pci0000:20/0000:20:03.0/0000:21:00.0/host0"
-      edc                 = <store method only>
-      optrom_ctl          = <store method only>
-      reset               = <store method only>
-      uevent              = "DEVTYPE=scsi_host"
-
-
-  Class Device = "host2"
-  Class Device path = "/sys/devices/pci0000:20/0000:20:03.0/\
-0000:21:00.1/host2/fc_host/host2"
-    dev_loss_tmo        = "16"
-    fabric_name         = "0x100000051ea33b79"
-    issue_lip           = <store method only>
-    max_npiv_vports     = "0"
-    node_name           = "0x50014380242b9753"
-    npiv_vports_inuse   = "0"
-    port_id             = "0x970e09"
-    port_name           = "0x50014380242b9752"
-    port_state          = "Online"
-    port_type           = "NPort (fabric via point-to-point)"
-    speed               = "8 Gbit"
-    supported_classes   = "Class 3"
-    supported_speeds    = "1 Gbit, 2 Gbit, 4 Gbit, 8 Gbit"
-    symbolic_name       = "QMH2572 FW:v4.04.04 DVR:v8.03.07.12-k"
-    system_hostname     = ""
-    tgtid_bind_type     = "wwpn (World Wide Port Name)"
-    uevent              =
-    vport_create        = <store method only>
-    vport_delete        = <store method only>
-
-    Device = "host2"
-    Device path = "/sys/devices/pci0000:20/0000:20:03.0/0000:21:00.1/host2"
-      edc                 = <store method only>
-      optrom_ctl          = <store method only>
-      reset               = <store method only>
-      uevent              = "DEVTYPE=scsi_host"
-
-
-"""
-
-
 class LinuxFCS390XTestCase(LinuxFCTestCase):
 
     def setUp(self):
@@ -521,14 +584,25 @@ class LinuxFCS390XTestCase(LinuxFCTestCase):
         self.cmds = []
         self.lfc = linuxfc.LinuxFibreChannelS390X(None,
                                                   execute=self.fake_execute)
+        self.mock_object(self.lfc, 'get_fc_targets_index', return_value={})
 
     def test_get_fc_hbas_info(self):
-        def fake_exec(a, b, c, d, run_as_root=True, root_helper='sudo'):
-            return SYSTOOL_FC_S390X, None
-        self.lfc._execute = fake_exec
+        self._setup_fc_host()
+        device_path = '/devices/css0/0.0.02ea/0.0.3080/host0/fc_host/host0'
+        self._add_fc_host('host0', device_path,
+                          node_name='0x1234567898765432',
+                          permanent_port_name='0xc05076ffe6803081',
+                          port_name='0xc05076ffe680a960',
+                          port_state='Online',
+                          port_type='NPIV VPORT')
+        self._add_fc_host('host1', '/devices/css0/0.0.02ea/0.0.3081/host1/'
+                                   'fc_host/host1',
+                          node_name='0x1234567898765433',
+                          port_name='0xc05076ffe680a961',
+                          port_state='Linkdown')
         hbas_info = self.lfc.get_fc_hbas_info()
-        expected = [{'device_path': '/sys/devices/css0/0.0.02ea/'
-                                    '0.0.3080/host0/fc_host/host0',
+        expected = [{'device_path': os.path.join(self.sysfs,
+                                                 device_path.lstrip('/')),
                      'host_device': 'host0',
                      'node_name': '1234567898765432',
                      'port_name': 'c05076ffe680a960'}]
@@ -554,38 +628,3 @@ class LinuxFCS390XTestCase(LinuxFCTestCase):
         expected_commands = [('tee -a /sys/bus/ccw/drivers/zfcp/'
                               '0.0.2319/0x50014380242b9751/unit_remove')]
         self.assertEqual(expected_commands, self.cmds)
-
-
-SYSTOOL_FC_S390X = """
-Class = "fc_host"
-
-  Class Device = "host0"
-  Class Device path = "/sys/devices/css0/0.0.02ea/0.0.3080/host0/fc_host/host0"
-    active_fc4s         = "0x00 0x00 0x01 0x00 0x00 0x00 0x00 0x00 0x00 0x00 \
-    0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 \
-    0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 "
-    dev_loss_tmo        = "60"
-    maxframe_size       = "2112 bytes"
-    node_name           = "0x1234567898765432"
-    permanent_port_name = "0xc05076ffe6803081"
-    port_id             = "0x010014"
-    port_name           = "0xc05076ffe680a960"
-    port_state          = "Online"
-    port_type           = "NPIV VPORT"
-    serial_number       = "IBM00000000000P30"
-    speed               = "8 Gbit"
-    supported_classes   = "Class 2, Class 3"
-    supported_fc4s      = "0x00 0x00 0x01 0x00 0x00 0x00 0x00 0x00 0x00 0x00 \
-    0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 \
-    0x00 0x00 0x00 0x00 0x00 0x00 0x00 0x00 "
-    supported_speeds    = "2 Gbit, 4 Gbit"
-    symbolic_name       = "IBM     2827            00000000000P30  \
-    PCHID: 0308 NPIV UlpId: 01EA0A00   DEVNO: 0.0.1234 NAME: dummy"
-    tgtid_bind_type     = "wwpn (World Wide Port Name)"
-    uevent              =
-
-    Device = "host0"
-    Device path = "/sys/devices/css0/0.0.02ea/0.0.3080/host0"
-      uevent              = "DEVTYPE=scsi_host"
-
-"""
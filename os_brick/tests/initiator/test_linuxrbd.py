@@ -10,6 +10,11 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import errno
+import hashlib
+import io
+import shutil
+import threading
 from unittest import mock
 
 from os_brick import exception
@@ -57,15 +62,114 @@ class MockRados(object):
             pass
 
 
+class FakeImage(object):
+    """In memory RBD image that fails on out of bounds reads like librbd."""
+
+    def __init__(self, size, obj_size=4096):
+        self.data = bytearray(i % 251 for i in range(size))
+        self.obj_size = obj_size
+        self.size = mock.Mock(side_effect=lambda: len(self.data))
+        self.read = mock.Mock(side_effect=self._read)
+        # Allocated (offset, length) ranges reported by diff_iterate
+        self.extents = [(0, size)]
+        self.diff_calls = []
+
+    def _read(self, offset, length):
+        if offset + length > len(self.data):
+            raise ValueError('Out of bounds')
+        return bytes(self.data[offset:offset + length])
+
+    def write(self, data, offset):
+        self.data[offset:offset + len(data)] = data
+
+    def resize(self, size):
+        del self.data[size:]
+        self.data.extend(bytes(size - len(self.data)))
+
+    def stat(self):
+        return {'obj_size': self.obj_size}
+
+    def diff_iterate(self, offset, length, from_snapshot, iterate_cb,
+                     include_parent=True, whole_object=False):
+        self.diff_calls.append((offset, length, whole_object))
+        for ext_offset, ext_length in self.extents:
+            if whole_object:
+                end = ext_offset + ext_length
+                ext_offset -= ext_offset % self.obj_size
+                ext_length = -(-end // self.obj_size) * self.obj_size
+                ext_length -= ext_offset
+            start = max(ext_offset, offset)
+            stop = min(ext_offset + ext_length, offset + length)
+            if start < stop:
+                iterate_cb(start, stop - start, True)
+
+
+class FakeCompletion(object):
+    def __init__(self, ret):
+        self.ret = ret
+
+    def get_return_value(self):
+        return self.ret
+
+
+class FakeAIOImage(FakeImage):
+    """FakeImage with asynchronous requests that complete out of order.
+
+    Each request takes a bit less time than the previous one in flight, and
+    the maximum number of requests in flight is recorded.
+    """
+
+    def __init__(self, size, obj_size=4096, latency=0.02, fail_offset=None):
+        super(FakeAIOImage, self).__init__(size, obj_size)
+        self.latency = latency
+        self.fail_offset = fail_offset
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.aio_read = mock.Mock(side_effect=self._aio_read)
+        self.aio_write = mock.Mock(side_effect=self._aio_write)
+        self.flush = mock.Mock()
+        self._lock = threading.Lock()
+
+    def _submit(self, offset, func):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.latency / self.in_flight
+
+        def complete():
+            with self._lock:
+                self.in_flight -= 1
+            if offset == self.fail_offset:
+                func(FakeCompletion(-errno.EIO))
+            else:
+                func(FakeCompletion(0))
+
+        threading.Timer(delay, complete).start()
+
+    def _aio_read(self, offset, length, oncomplete):
+        data = self._read(offset, length)
+        self._submit(offset, lambda c: oncomplete(c, data))
+
+    def _aio_write(self, data, offset, oncomplete):
+        def complete(completion):
+            if completion.get_return_value() == 0:
+                self.write(data, offset)
+            oncomplete(completion)
+        self._submit(offset, complete)
+
+
 class RBDClientTestCase(base.TestCase):
 
     def setUp(self):
         super(RBDClientTestCase, self).setUp()
+        self.pool = linuxrbd.RadosPool()
+        self.mock_object(linuxrbd.RadosPool, '_instance', self.pool)
 
     @mock.patch('os_brick.initiator.linuxrbd.rbd')
     @mock.patch('os_brick.initiator.linuxrbd.rados')
     def test_with_client(self, mock_rados, mock_rbd):
-        with linuxrbd.RBDClient('test_user', 'test_pool') as client:
+        with linuxrbd.RBDClient('test_user', 'test_pool',
+                                use_pool=False) as client:
 
             # Verify object attributes are assigned as expected
             self.assertEqual('/etc/ceph/ceph.conf', client.rbd_conf)
@@ -86,6 +190,116 @@ class RBDClientTestCase(base.TestCase):
 
         self.assertEqual(1, mock_rados.Rados.return_value.shutdown.call_count)
 
+    @mock.patch('os_brick.initiator.linuxrbd.rbd')
+    @mock.patch('os_brick.initiator.linuxrbd.rados')
+    def test_pooled(self, mock_rados, mock_rbd):
+        mock_rados.Rados.side_effect = lambda **kw: mock.Mock(
+            state='connected', **{'open_ioctx.return_value.state': 'open'})
+
+        with linuxrbd.RBDClient('user', 'pool') as client:
+            with linuxrbd.RBDClient('user', 'pool') as client2:
+                self.assertIs(client.client, client2.client)
+                self.assertIs(client.ioctx, client2.ioctx)
+            other = linuxrbd.RBDClient('user', 'pool2')
+            other.disconnect()
+        # Disconnecting twice doesn't release the connection twice
+        client.disconnect()
+
+        self.assertEqual(2, mock_rados.Rados.call_count)
+        self.assertEqual(2, len(self.pool))
+        client.client.shutdown.assert_not_called()
+
+        # Idle connections are reused
+        with linuxrbd.RBDClient('user', 'pool') as client3:
+            self.assertIs(client.client, client3.client)
+        self.assertEqual(2, mock_rados.Rados.call_count)
+
+        self.pool.evict_idle(0)
+        self.assertEqual(0, len(self.pool))
+        client.client.shutdown.assert_called_once_with()
+        client.ioctx.close.assert_called_once_with()
+        other.client.shutdown.assert_called_once_with()
+
+    def test_pool_idle_timeout(self):
+        self.mock_object(linuxrbd.time, 'monotonic', side_effect=[0, 10, 20,
+                                                                  70, 70])
+        conn = self.pool.acquire('key', lambda: (mock.Mock(), mock.Mock()))
+        self.assertEqual(0, conn.last_used)
+        self.pool._timer = mock.Mock()  # Don't start a timer
+        self.pool.release(conn)
+        self.assertEqual(10, conn.last_used)
+
+        # Not idle for long enough, check again when it could be
+        self.mock_object(self.pool, '_schedule_eviction')
+        self.pool.evict_idle()
+        self.pool._schedule_eviction.assert_called_once_with(50)
+        self.assertEqual(1, len(self.pool))
+
+        self.pool.evict_idle()
+        self.assertEqual(0, len(self.pool))
+        conn.client.shutdown.assert_called_once_with()
+        self.assertEqual(1, self.pool._schedule_eviction.call_count)
+
+    def test_pool_release_schedules_eviction(self):
+        pool = linuxrbd.RadosPool(idle_timeout=0.01)
+        conn = pool.acquire('key', lambda: (mock.Mock(), mock.Mock()))
+        pool.release(conn)
+        pool._timer.join()
+        self.assertEqual(0, len(pool))
+        conn.client.shutdown.assert_called_once_with()
+
+    def test_pool_no_idle_timeout(self):
+        pool = linuxrbd.RadosPool(idle_timeout=0)
+        conn = pool.acquire('key', lambda: (mock.Mock(), mock.Mock()))
+        pool.release(conn)
+        self.assertEqual(0, len(pool))
+        conn.client.shutdown.assert_called_once_with()
+
+    def test_pool_unhealthy(self):
+        connect = mock.Mock(side_effect=lambda: (
+            mock.Mock(state='connected'), mock.Mock(state='open')))
+        conn = self.pool.acquire('key', connect)
+        conn2 = self.pool.acquire('key', connect)
+        self.assertIs(conn, conn2)
+
+        conn.client.state = 'shutdown'
+        conn3 = self.pool.acquire('key', connect)
+        self.assertIsNot(conn, conn3)
+        self.assertEqual(2, connect.call_count)
+
+        # Broken connection is closed once its users are done with it
+        self.pool.release(conn)
+        conn.client.shutdown.assert_not_called()
+        self.pool.release(conn)
+        conn.client.shutdown.assert_called_once_with()
+        self.assertEqual(1, len(self.pool))
+
+    def test_pool_concurrent_connect(self):
+        def connect_other():
+            return mock.Mock(state='connected'), mock.Mock(state='open')
+
+        def connect():
+            # Someone else connects while we are connecting
+            self.others.append(self.pool.acquire('key', connect_other))
+            return connect_other()
+
+        self.others = []
+        conn = self.pool.acquire('key', connect)
+        self.assertIs(self.others[0], conn)
+        self.assertEqual(2, conn.refs)
+        self.assertEqual(1, len(self.pool))
+
+    def test_pool_after_fork(self):
+        conn = self.pool.acquire('key', lambda: (mock.Mock(), mock.Mock()))
+        linuxrbd.RadosPool._after_fork()
+        self.assertEqual(0, len(self.pool))
+
+        # Connection from the parent is not closed by the child
+        conn.pid = -1
+        self.pool.release(conn)
+        conn.client.shutdown.assert_not_called()
+        conn.ioctx.close.assert_not_called()
+
     @mock.patch.object(MockRados.Rados, 'connect', side_effect=MockRados.Error)
     def test_with_client_error(self, _):
         linuxrbd.rados = MockRados
@@ -170,7 +384,7 @@ class RBDVolumeIOWrapperTestCase(base.TestCase):
                          self.mock_volume_wrapper._offset)
 
         # test exceptions.
-        self.assertRaises(IOError, self.mock_volume_wrapper.seek, 0, 3)
+        self.assertRaises(IOError, self.mock_volume_wrapper.seek, 0, 5)
         self.assertRaises(IOError, self.mock_volume_wrapper.seek, -1)
         # offset should not have been changed by any of the previous
         # operations.
@@ -208,6 +422,458 @@ class RBDVolumeIOWrapperTestCase(base.TestCase):
         rbd_handle.close()
         self.assertEqual(1, rbd_disconnect.call_count)
 
+    @mock.patch('os_brick.initiator.linuxrbd.rbd')
+    @mock.patch('os_brick.initiator.linuxrbd.rados')
+    @mock.patch.object(linuxrbd.RBDClient, 'disconnect')
+    def test_close_volume(self, rbd_disconnect, mock_rados, mock_rbd):
+        rbd_client = linuxrbd.RBDClient('user', 'pool')
+        rbd_volume = linuxrbd.RBDVolume(rbd_client, 'volume')
+        rbd_handle = linuxrbd.RBDVolumeIOWrapper(rbd_volume)
+        rbd_handle.close()
+        rbd_volume.image.close.assert_called_once_with()
+        self.assertEqual(1, rbd_disconnect.call_count)
+
+
+class RBDVolumeIOWrapperFakeImageTestCase(base.TestCase):
+    def _get_wrapper(self, size=10000, **kwargs):
+        self.image = FakeImage(size)
+        volume = mock.Mock(image=self.image)
+        return linuxrbd.RBDVolumeIOWrapper(volume, **kwargs)
+
+    def test_readinto(self):
+        wrapper = self._get_wrapper()
+        buf = bytearray(6000)
+        self.assertEqual(6000, wrapper.readinto(buf))
+        self.assertEqual(self.image.data[:6000], buf)
+        self.assertEqual(4000, wrapper.readinto(memoryview(buf)[10:]))
+        self.assertEqual(self.image.data[6000:], buf[10:4010])
+        self.assertEqual(0, wrapper.readinto(buf))
+        self.assertEqual(10000, wrapper.tell())
+
+    def test_size_cached(self):
+        wrapper = self._get_wrapper()
+        for i in range(10):
+            wrapper.read(100)
+        self.image.size.assert_called_once_with()
+
+    def test_size_refreshed_at_end(self):
+        wrapper = self._get_wrapper()
+        self.assertEqual(10000, len(wrapper.read()))
+        # Image is extended by someone else
+        self.image.resize(12000)
+        self.assertEqual(2000, len(wrapper.read()))
+        self.assertEqual(b'', wrapper.read())
+
+    def test_invalidate_size(self):
+        wrapper = self._get_wrapper()
+        wrapper.read(1)
+        self.image.resize(5000)
+        wrapper.invalidate_size()
+        self.assertEqual(4999, len(wrapper.read()))
+
+    def test_truncate(self):
+        wrapper = self._get_wrapper()
+        wrapper.seek(3000)
+        self.assertEqual(3000, wrapper.truncate())
+        self.assertEqual(3000, len(self.image.data))
+        self.assertEqual(b'', wrapper.read())
+        self.assertEqual(20000, wrapper.truncate(20000))
+        self.assertEqual(17000, len(wrapper.read()))
+        # Only checked when we reached the end of the image
+        self.image.size.assert_called_once_with()
+
+    def test_read_ahead(self):
+        # Window is rounded up to the 4096 bytes object size
+        wrapper = self._get_wrapper(read_ahead=5000)
+        wrapper.seek(5000)
+        self.assertEqual(bytes(self.image.data[5000:5100]), wrapper.read(100))
+        self.image.read.assert_called_once_with(0, 8192)
+
+        buf = bytearray(3000)
+        self.assertEqual(3000, wrapper.readinto(buf))
+        self.assertEqual(self.image.data[5100:8100], buf)
+        self.assertEqual(bytes(self.image.data[8100:]), wrapper.read())
+        self.image.read.assert_has_calls([mock.call(0, 8192),
+                                          mock.call(8192, 1808)])
+        self.assertEqual(2, self.image.read.call_count)
+
+    def test_read_ahead_write(self):
+        wrapper = self._get_wrapper(read_ahead=4096)
+        wrapper.read(10)
+        wrapper.seek(20)
+        wrapper.write(b'new')
+        wrapper.seek(20)
+        self.assertEqual(b'new', wrapper.read(3))
+        self.assertEqual(2, self.image.read.call_count)
+
+    def test_copyfileobj(self):
+        wrapper = self._get_wrapper(size=100000, read_ahead=8192)
+        dst = io.BytesIO()
+        shutil.copyfileobj(io.BufferedReader(wrapper), dst)
+        self.assertEqual(self.image.data, dst.getvalue())
+        self.assertEqual(13, self.image.read.call_count)
+
+
+class RBDVolumeIOWrapperWriteBufferTestCase(base.TestCase):
+    def _get_wrapper(self, size=100000, write_buffer=8000, **kwargs):
+        self.image = FakeImage(size)
+        self.image.write = mock.Mock(side_effect=self.image.write)
+        self.image.close = mock.Mock()
+        volume = linuxrbd.RBDImageMetadata(self.image, 'pool', 'user',
+                                           None)
+        return linuxrbd.RBDVolumeIOWrapper(volume, write_buffer=write_buffer,
+                                           **kwargs)
+
+    def test_coalesce(self):
+        wrapper = self._get_wrapper()
+        wrapper.seek(1000)
+        data = bytes(range(250)) * 80
+        for i in range(0, len(data), 500):
+            self.assertEqual(500, wrapper.write(data[i:i + 500]))
+        self.assertEqual(21000, wrapper.tell())
+        # Buffer is rounded to 2 objects, writes end at object boundaries
+        self.image.write.assert_has_calls([mock.call(data[:7192], 1000),
+                                           mock.call(data[7192:15384], 8192)])
+        self.assertEqual(2, self.image.write.call_count)
+
+        wrapper.flush()
+        self.image.write.assert_called_with(data[15384:], 16384)
+        self.assertEqual(data, self.image.data[1000:21000])
+
+    def test_large_write_bypasses_buffer(self):
+        wrapper = self._get_wrapper()
+        data = b'x' * 20000
+        wrapper.write(data)
+        self.image.write.assert_called_once_with(data[:16384], 0)
+        wrapper.write(b'y' * 100)
+        self.assertEqual(1, self.image.write.call_count)
+        wrapper.flush()
+        self.image.write.assert_called_with(data[16384:] + b'y' * 100, 16384)
+
+    def test_flush_on_seek_read_and_close(self):
+        wrapper = self._get_wrapper()
+        wrapper.write(b'abc')
+        wrapper.seek(3)
+        self.image.write.assert_called_once_with(b'abc', 0)
+
+        wrapper.write(b'def')
+        self.assertEqual(bytes(self.image.data[6:10]), wrapper.read(4))
+        self.image.write.assert_called_with(b'def', 3)
+        self.assertEqual(2, self.image.write.call_count)
+
+        wrapper.write(b'ghi')
+        wrapper.close()
+        self.image.write.assert_called_with(b'ghi', 10)
+        self.image.close.assert_called_once_with()
+
+    def test_truncate(self):
+        wrapper = self._get_wrapper()
+        wrapper.seek(99990)
+        wrapper.write(b'end')
+        wrapper.truncate()
+        self.assertEqual(b'end', self.image.data[-3:])
+        self.assertEqual(99993, len(self.image.data))
+
+    def test_write_error(self):
+        wrapper = self._get_wrapper()
+        wrapper.write(b'abc')
+        self.image.write.side_effect = IOError
+        self.assertRaises(IOError, wrapper.flush)
+        # Data is kept so it can be written later
+        self.image.write.side_effect = None
+        wrapper.flush()
+        self.image.write.assert_called_with(b'abc', 0)
+
+    def test_close_error(self):
+        wrapper = self._get_wrapper()
+        wrapper.write(b'abc')
+        self.image.write.side_effect = IOError
+        self.assertRaises(IOError, wrapper.close)
+        self.image.close.assert_called_once_with()
+        self.assertEqual(b'', bytes(wrapper._write_buffer))
+
+    def test_aio(self):
+        self.image = FakeAIOImage(100000)
+        volume = mock.Mock(image=self.image)
+        wrapper = linuxrbd.RBDVolumeIOWrapper(volume, write_buffer=4096,
+                                              aio_depth=4)
+        data = bytes(range(200)) * 100
+        for i in range(0, len(data), 100):
+            wrapper.write(data[i:i + 100])
+        wrapper.flush()
+        self.assertEqual(data, self.image.data[:20000])
+        self.assertEqual(5, self.image.aio_write.call_count)
+
+
+class RBDExtentsTestCase(base.TestCase):
+    def setUp(self):
+        super(RBDExtentsTestCase, self).setUp()
+        self.image = FakeImage(100000)
+        self.image.extents = [(1000, 3000), (4000, 1000), (20000, 5000),
+                              (90000, 10000)]
+
+    def test_iter_extents(self):
+        self.assertEqual([(1000, 4000), (20000, 5000), (90000, 10000)],
+                         list(linuxrbd.iter_extents(self.image)))
+        self.assertEqual([(0, 100000, False)], self.image.diff_calls)
+
+    def test_iter_extents_range(self):
+        self.assertEqual([(2000, 3000), (20000, 1000)],
+                         list(linuxrbd.iter_extents(self.image, 2000, 19000)))
+
+    def test_iter_extents_whole_object(self):
+        self.assertEqual(
+            [(0, 8192), (16384, 12288), (86016, 13984)],
+            list(linuxrbd.iter_extents(self.image, whole_object=True)))
+
+    @mock.patch.object(linuxrbd, 'EXTENT_SCAN_SIZE', 3000)
+    def test_iter_extents_scan_size(self):
+        self.assertEqual([(1000, 4000), (20000, 5000), (90000, 10000)],
+                         list(linuxrbd.iter_extents(self.image)))
+        self.assertEqual(34, len(self.image.diff_calls))
+        self.assertEqual((99000, 1000, False), self.image.diff_calls[-1])
+
+    def test_iter_extents_empty(self):
+        self.image.extents = []
+        self.assertEqual([], list(linuxrbd.iter_extents(self.image)))
+
+    def test_volume_iter_extents(self):
+        volume = linuxrbd.RBDVolume.__new__(linuxrbd.RBDVolume)
+        volume.image = mock.Mock()
+        volume.image.size.return_value = 10
+        self.assertEqual([], list(volume.iter_extents(from_snapshot='snap')))
+        volume.image.diff_iterate.assert_called_once_with(
+            0, 10, 'snap', mock.ANY, whole_object=False)
+
+    def test_seek_data_hole(self):
+        wrapper = linuxrbd.RBDVolumeIOWrapper(mock.Mock(image=self.image))
+        self.assertEqual(1000, wrapper.seek(0, linuxrbd.SEEK_DATA))
+        self.assertEqual(1000, wrapper.tell())
+        self.assertEqual(5000, wrapper.seek(1000, linuxrbd.SEEK_HOLE))
+        self.assertEqual(5000, wrapper.seek(5000, linuxrbd.SEEK_HOLE))
+        self.assertEqual(20000, wrapper.seek(5000, linuxrbd.SEEK_DATA))
+        self.assertEqual(22000, wrapper.seek(22000, linuxrbd.SEEK_DATA))
+        self.assertEqual(90000, wrapper.seek(25000, linuxrbd.SEEK_DATA))
+        # The end of the image is a hole
+        self.assertEqual(100000, wrapper.seek(95000, linuxrbd.SEEK_HOLE))
+
+        for whence in (linuxrbd.SEEK_DATA, linuxrbd.SEEK_HOLE):
+            exc = self.assertRaises(IOError, wrapper.seek, 100000, whence)
+            self.assertEqual(errno.ENXIO, exc.errno)
+        self.assertRaises(IOError, wrapper.seek, -1, linuxrbd.SEEK_DATA)
+        self.assertEqual(100000, wrapper.tell())
+
+    def test_seek_data_none(self):
+        self.image.extents = self.image.extents[:-1]
+        wrapper = linuxrbd.RBDVolumeIOWrapper(mock.Mock(image=self.image))
+        exc = self.assertRaises(IOError, wrapper.seek, 25000,
+                                linuxrbd.SEEK_DATA)
+        self.assertEqual(errno.ENXIO, exc.errno)
+        self.assertEqual(0, wrapper.tell())
+
+
+class RBDChecksumTestCase(base.TestCase):
+    def setUp(self):
+        super(RBDChecksumTestCase, self).setUp()
+        self.image = FakeImage(100000)
+        # Blocks 1 and 2 of 16KiB are not allocated
+        self.image.data[16384:49152] = bytes(32768)
+        self.image.extents = [(0, 16384), (49152, 50848)]
+
+    @staticmethod
+    def _leaf(data):
+        return hashlib.sha256(b'\x00' + data).hexdigest()
+
+    def test_get_block_hashes(self):
+        res = linuxrbd.get_block_hashes(self.image, block_size=16384,
+                                        threads=3)
+        data = bytes(self.image.data)
+        expected = [self._leaf(data[i:i + 16384])
+                    for i in range(0, 100000, 16384)]
+        self.assertEqual(expected, res)
+        self.assertEqual(5, self.image.read.call_count)
+        self.image.read.assert_has_calls(
+            [mock.call(0, 16384), mock.call(49152, 16384),
+             mock.call(98304, 1696)], any_order=True)
+
+    def test_checksum_image(self):
+        res = linuxrbd.checksum_image(self.image, block_size=16384)
+        self.assertEqual(64, len(res))
+        # Independent of the number of threads and of sparseness
+        self.assertEqual(res, linuxrbd.checksum_image(
+            self.image, block_size=16384, threads=1))
+        self.image.extents = [(0, 100000)]
+        self.assertEqual(res, linuxrbd.checksum_image(self.image,
+                                                      block_size=16384))
+        # But not of the contents or block size
+        self.assertNotEqual(res, linuxrbd.checksum_image(self.image,
+                                                         block_size=8192))
+        self.image.data[99999] ^= 1
+        self.assertNotEqual(res, linuxrbd.checksum_image(self.image,
+                                                         block_size=16384))
+
+    def test_tree_hash(self):
+        leaves = ['%064x' % i for i in range(3)]
+
+        def node(*children):
+            return hashlib.sha256(
+                bytes([1]) + b''.join(children)).digest()
+
+        root = node(node(*(bytes.fromhex(h) for h in leaves[:2])),
+                    bytes.fromhex(leaves[2]))
+        expected = hashlib.sha256(b'\x02' + (10).to_bytes(8, 'big') +
+                                  root).hexdigest()
+        self.assertEqual(expected, linuxrbd.tree_hash(leaves, 10))
+        self.assertEqual(hashlib.sha256(bytes([2]) + bytes(8)).hexdigest(),
+                         linuxrbd.tree_hash([], 0))
+
+    def test_checksum_volume_and_wrapper(self):
+        expected = linuxrbd.checksum_image(self.image)
+        volume = linuxrbd.RBDVolume.__new__(linuxrbd.RBDVolume)
+        volume.image = self.image
+        self.assertEqual(expected, volume.checksum())
+
+        wrapper = linuxrbd.RBDVolumeIOWrapper(mock.Mock(image=self.image),
+                                              write_buffer=4096)
+        wrapper.write(b'new')
+        self.assertNotEqual(expected, wrapper.checksum())
+
+    def test_verify_image(self):
+        hashes = linuxrbd.get_block_hashes(self.image, block_size=16384)
+        self.assertEqual([], linuxrbd.verify_image(self.image, hashes,
+                                                   block_size=16384))
+        self.image.data[20000] = 1
+        self.image.extents.insert(1, (20000, 1))
+        self.assertEqual([16384], linuxrbd.verify_image(
+            self.image, hashes, block_size=16384))
+        self.assertEqual([16384, 114688], linuxrbd.verify_image(
+            self.image, hashes + ['00'], block_size=16384))
+
+    def test_read_error(self):
+        self.image.read.side_effect = IOError
+        self.assertRaises(IOError, linuxrbd.checksum_image, self.image,
+                          block_size=16384, threads=2)
+
+    def test_invalid(self):
+        self.assertRaises(exception.InvalidParameterValue,
+                          linuxrbd.get_block_hashes, self.image, 0)
+        self.assertRaises(exception.InvalidParameterValue,
+                          linuxrbd.get_block_hashes, self.image, threads=0)
+
+
+class RBDVolumeIOWrapperAIOTestCase(base.TestCase):
+    def _get_wrapper(self, size=100000, fail_offset=None, **kwargs):
+        self.image = FakeAIOImage(size, fail_offset=fail_offset)
+        volume = linuxrbd.RBDImageMetadata(self.image, 'pool', 'user',
+                                           None)
+        return linuxrbd.RBDVolumeIOWrapper(volume, **kwargs)
+
+    def test_read(self):
+        wrapper = self._get_wrapper(aio_depth=4)
+        dst = io.BytesIO()
+        shutil.copyfileobj(wrapper, dst, 3000)
+        self.assertEqual(self.image.data, dst.getvalue())
+        self.assertEqual(25, self.image.aio_read.call_count)
+        self.assertEqual(4, self.image.max_in_flight)
+        self.image.read.assert_not_called()
+
+    def test_read_seek(self):
+        wrapper = self._get_wrapper(aio_depth=4)
+        self.assertEqual(bytes(self.image.data[:10]), wrapper.read(10))
+        wrapper.seek(50000)
+        self.assertEqual(bytes(self.image.data[50000:60000]),
+                         wrapper.read(10000))
+        # Pipeline started again at the window of the new offset
+        self.image.aio_read.assert_any_call(49152, 4096, mock.ANY)
+
+    def test_read_error(self):
+        wrapper = self._get_wrapper(aio_depth=4, fail_offset=8192)
+        wrapper.read(8192)
+        exc = self.assertRaises(IOError, wrapper.read, 10)
+        self.assertEqual(errno.EIO, exc.errno)
+        # Read can be retried
+        self.image.fail_offset = None
+        self.assertEqual(bytes(self.image.data[8192:8202]), wrapper.read(10))
+
+    def test_write(self):
+        wrapper = self._get_wrapper(aio_depth=3)
+        data = bytes(range(200)) * 250
+        for i in range(0, len(data), 1000):
+            wrapper.write(data[i:i + 1000])
+        wrapper.flush()
+        self.assertEqual(data, self.image.data[:len(data)])
+        self.assertEqual(50, self.image.aio_write.call_count)
+        self.assertEqual(3, self.image.max_in_flight)
+        self.image.flush.assert_called_once_with()
+
+    def test_write_memory_bound(self):
+        wrapper = self._get_wrapper(aio_depth=8, aio_max_bytes=2500)
+        for i in range(10):
+            wrapper.write(b'x' * 1000)
+        self.assertEqual(2, self.image.max_in_flight)
+        wrapper.seek(0)
+        self.assertEqual(0, self.image.in_flight)
+        self.assertEqual(b'x' * 10000, wrapper.read(10000))
+
+    def test_write_error(self):
+        wrapper = self._get_wrapper(aio_depth=2, fail_offset=1000)
+        wrapper.write(b'a' * 1000)
+        wrapper.write(b'b' * 1000)
+        exc = self.assertRaises(IOError, wrapper.flush)
+        self.assertEqual(errno.EIO, exc.errno)
+        self.image.flush.assert_not_called()
+        self.assertEqual(b'a' * 1000, self.image.data[:1000])
+
+    def test_close_waits(self):
+        wrapper = self._get_wrapper(aio_depth=4)
+        wrapper.read(10)
+        wrapper.write(b'data')
+        self.image.close = mock.Mock()
+        wrapper.close()
+        self.image.close.assert_called_once_with()
+        self.assertEqual(0, self.image.in_flight)
+        self.assertEqual(b'data', self.image.data[10:14])
+
+
+class RBDVolumeStreamTestCase(base.TestCase):
+    def setUp(self):
+        super(RBDVolumeStreamTestCase, self).setUp()
+        self.image = FakeAIOImage(20000)
+        self.volume = linuxrbd.RBDVolume.__new__(linuxrbd.RBDVolume)
+        self.volume.image = self.image
+
+    def test_read_stream(self):
+        chunks = list(self.volume.read_stream(depth=3))
+        self.assertEqual([4096] * 4 + [3616], [len(c) for c in chunks])
+        self.assertEqual(self.image.data, b''.join(chunks))
+        self.assertEqual(3, self.image.max_in_flight)
+
+    def test_read_stream_range(self):
+        chunks = list(self.volume.read_stream(100, 1000, chunk_size=300))
+        self.assertEqual(bytes(self.image.data[100:1100]), b''.join(chunks))
+        self.assertEqual(4, len(chunks))
+
+    def test_read_stream_error(self):
+        self.image.fail_offset = 4096
+        stream = self.volume.read_stream(depth=2)
+        next(stream)
+        self.assertRaises(IOError, next, stream)
+        stream.close()
+
+    def test_write_stream(self):
+        data = [bytes([i]) * 1000 for i in range(12)]
+        end = self.volume.write_stream(data, offset=500, depth=4)
+        self.assertEqual(12500, end)
+        self.assertEqual(b''.join(data), self.image.data[500:12500])
+        self.assertEqual(4, self.image.max_in_flight)
+
+    def test_write_stream_error(self):
+        self.image.fail_offset = 2000
+        data = [b'x' * 1000] * 5
+        exc = self.assertRaises(IOError, self.volume.write_stream, data)
+        self.assertEqual(errno.EIO, exc.errno)
+        self.assertEqual(0, self.image.in_flight)
+
 
 class RBDVolumeTestCase(base.TestCase):
     def test_name_attribute(self):
@@ -14,7 +14,6 @@
 
 import os
 import os.path
-import textwrap
 from unittest import mock
 
 import ddt
@@ -22,6 +21,7 @@ from oslo_concurrency import processutils as putils
 from oslo_log import log as logging
 
 from os_brick import exception
+from os_brick.initiator import linuxblock
 from os_brick.initiator import linuxscsi
 from os_brick.tests import base
 
@@ -113,6 +113,15 @@ class LinuxSCSITestCase(base.TestCase):
                                       for name in names] * retries)
         self.assertEqual(retries - 1, sleep_mock.call_count)
 
+    @mock.patch('time.sleep')
+    @mock.patch('os.path.exists', return_value=True)
+    def test_wait_for_volumes_removal_timeout(self, exists_mock, sleep_mock):
+        self.assertRaises(exception.VolumePathNotRemoved,
+                          self.linuxscsi.wait_for_volumes_removal, ['sda'],
+                          timeout=2)
+        self.assertEqual(5, exists_mock.call_count)
+        self.assertEqual(4, sleep_mock.call_count)
+
     @mock.patch('os_brick.utils._time_sleep')
     @mock.patch('os.path.exists', side_effect=(True, True, False, False))
     def test_wait_for_volumes_removal_retry(self, exists_mock, sleep_mock):
@@ -187,34 +196,133 @@ class LinuxSCSITestCase(base.TestCase):
         self.linuxscsi.flush_device_io(device)
         exists_mock.assert_called_once_with(device)
 
+    def _mock_topology(self):
+        """Mock sysfs with multipath dm-3 with paths sde and sdf."""
+        def device(name, **kwargs):
+            values = dict(dev='0:0', size=None, ro=False, scheduler=None,
+                          hctl=None, wwid=None, nguid=None, uuid=None,
+                          dm_name=None, holders=(), slaves=())
+            values.update(kwargs)
+            return linuxblock.BlockDevice(name=name, **values)
+
+        topology = linuxblock.BlockDeviceTopology({
+            'sde': device('sde', hctl=('6', '0', '2', '0'),
+                          holders=('dm-3',)),
+            'sdf': device('sdf', hctl=('6', '1', '0', '3'),
+                          holders=('dm-3',)),
+            'dm-3': device('dm-3', uuid='mpath-350002ac20398383d',
+                           dm_name='mpath6', slaves=('dm-4', 'sde', 'sdf')),
+            'dm-4': device('dm-4', uuid='LVM-abc'),
+            'sdg': device('sdg', holders=('dm-5',)),
+            'dm-5': device('dm-5', uuid='CRYPT-LUKS2-abc', dm_name='crypt',
+                           slaves=('sdg',)),
+        })
+        return self.mock_object(linuxblock.BlockDeviceTopology, 'snapshot',
+                                return_value=topology)
+
+    def test_find_sysfs_multipath_dm_by_wwn(self):
+        snapshot = self._mock_topology()
+        res = self.linuxscsi.find_sysfs_multipath_dm_by_wwn(
+            '350002ac20398383d')
+        self.assertEqual('dm-3', res)
+        snapshot.assert_called_once_with(patterns=('dm-*',))
+
+    def test_find_sysfs_multipath_dm_by_wwn_not_found(self):
+        self._mock_topology()
+        res = self.linuxscsi.find_sysfs_multipath_dm_by_wwn('1234567890')
+        self.assertIsNone(res)
+
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_dm_name',
+                       return_value='mpatha')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm_by_wwn',
+                       return_value='dm-1')
     @mock.patch.object(os.path, 'exists', return_value=True)
-    def test_find_multipath_device_path(self, exists_mock):
+    def test_find_multipath_device_path(self, exists_mock, find_mock,
+                                        name_mock):
         fake_wwn = '1234567890'
         found_path = self.linuxscsi.find_multipath_device_path(fake_wwn)
         expected_path = '/dev/disk/by-id/dm-uuid-mpath-%s' % fake_wwn
         self.assertEqual(expected_path, found_path)
+        find_mock.assert_called_once_with(fake_wwn)
+        exists_mock.assert_called_once_with(expected_path)
 
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_dm_name',
+                       return_value='mpatha')
     @mock.patch('os_brick.utils._time_sleep')
-    @mock.patch.object(os.path, 'exists')
-    def test_find_multipath_device_path_mapper(self, exists_mock, sleep_mock):
-        # the wait loop tries 3 times before it gives up
-        # we want to test failing to find the
-        # /dev/disk/by-id/dm-uuid-mpath-<WWN> path
-        # but finding the
-        # /dev/mapper/<WWN> path
-        exists_mock.side_effect = [False, False, False, True]
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm_by_wwn',
+                       side_effect=[None, 'dm-1'])
+    @mock.patch.object(os.path, 'exists', side_effect=[False, True])
+    def test_find_multipath_device_path_mapper(self, exists_mock, find_mock,
+                                               sleep_mock, name_mock):
+        # The DM doesn't show up in sysfs on the first try and once it does
+        # the /dev/disk/by-id/dm-uuid-mpath-<WWN> link is not there yet.
         fake_wwn = '1234567890'
         found_path = self.linuxscsi.find_multipath_device_path(fake_wwn)
-        expected_path = '/dev/mapper/%s' % fake_wwn
-        self.assertEqual(expected_path, found_path)
+        self.assertEqual('/dev/mapper/mpatha', found_path)
+        self.assertEqual(2, find_mock.call_count)
         self.assertTrue(sleep_mock.called)
+        name_mock.assert_called_once_with('dm-1')
 
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_dm_name', return_value='')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm_by_wwn',
+                       return_value='dm-1')
     @mock.patch.object(os.path, 'exists', return_value=False)
+    def test_find_multipath_device_path_no_links(self, exists_mock,
+                                                 find_mock, name_mock):
+        found_path = self.linuxscsi.find_multipath_device_path('1234567890')
+        self.assertEqual('/dev/dm-1', found_path)
+
     @mock.patch('os_brick.utils._time_sleep')
-    def test_find_multipath_device_path_fail(self, exists_mock, sleep_mock):
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm_by_wwn',
+                       return_value=None)
+    def test_find_multipath_device_path_fail(self, find_mock, sleep_mock):
         fake_wwn = '1234567890'
         found_path = self.linuxscsi.find_multipath_device_path(fake_wwn)
         self.assertIsNone(found_path)
+        self.assertEqual(3, find_mock.call_count)
+
+    def test_get_sysfs_dm_devices(self):
+        snapshot = self._mock_topology()
+        res = self.linuxscsi.get_sysfs_dm_devices('dm-3')
+        # dm-4 is not a SCSI device
+        expected = [{'device': '/dev/sde', 'host': '6', 'channel': '0',
+                     'id': '2', 'lun': '0'},
+                    {'device': '/dev/sdf', 'host': '6', 'channel': '1',
+                     'id': '0', 'lun': '3'}]
+        self.assertEqual(expected, res)
+        snapshot.assert_called_once_with(patterns=('sd*', 'dm-*'))
+
+    def test_get_sysfs_dm_devices_no_dm(self):
+        self._mock_topology()
+        self.assertEqual([], self.linuxscsi.get_sysfs_dm_devices('dm-2'))
+
+    @ddt.data('/dev/sde', '/dev/dm-3', '350002ac20398383d', 'mpath6')
+    def test_find_multipath_device(self, device):
+        snapshot = self._mock_topology()
+        info = self.linuxscsi.find_multipath_device(device)
+
+        self.assertEqual(
+            {'id': '350002ac20398383d',
+             'name': 'mpath6',
+             'device': '/dev/mapper/mpath6',
+             'devices': [{'device': '/dev/sde', 'host': '6', 'channel': '0',
+                          'id': '2', 'lun': '0'},
+                         {'device': '/dev/sdf', 'host': '6', 'channel': '1',
+                          'id': '0', 'lun': '3'}]},
+            info)
+        # Everything comes from the same snapshot
+        snapshot.assert_called_once_with(patterns=('sd*', 'dm-*'))
+        os.stat.assert_called_once_with('/dev/mapper/mpath6')
+
+    @ddt.data('/dev/sdg', '/dev/dm-5', '/dev/dm-4', 'crypt', '/dev/sdz')
+    def test_find_multipath_device_not_multipath(self, device):
+        self._mock_topology()
+        self.assertIsNone(self.linuxscsi.find_multipath_device(device))
+
+    def test_find_multipath_device_missing_mapper(self):
+        self._mock_topology()
+        os.stat.side_effect = OSError
+        self.assertIsNone(self.linuxscsi.find_multipath_device('/dev/sde'))
 
     @mock.patch.object(os.path, 'exists', return_value=False)
     @mock.patch('os_brick.utils._time_sleep')
@@ -401,174 +509,6 @@ class LinuxSCSITestCase(base.TestCase):
         wait_mock.assert_called_once_with(devices_names)
         remove_link_mock.assert_called_once_with(devices_names)
 
-    def test_find_multipath_device_3par_ufn(self):
-        def fake_execute(*cmd, **kwargs):
-            out = ("mpath6 (350002ac20398383d) dm-3 3PARdata,VV\n"
-                   "size=2.0G features='0' hwhandler='0' wp=rw\n"
-                   "`-+- policy='round-robin 0' prio=-1 status=active\n"
-                   "  |- 0:0:0:1 sde 8:64 active undef running\n"
-                   "  `- 2:0:0:1 sdf 8:80 active undef running\n"
-                   )
-            return out, None
-
-        self.linuxscsi._execute = fake_execute
-
-        info = self.linuxscsi.find_multipath_device('/dev/sde')
-
-        self.assertEqual("350002ac20398383d", info["id"])
-        self.assertEqual("mpath6", info["name"])
-        self.assertEqual("/dev/mapper/mpath6", info["device"])
-
-        self.assertEqual("/dev/sde", info['devices'][0]['device'])
-        self.assertEqual("0", info['devices'][0]['host'])
-        self.assertEqual("0", info['devices'][0]['id'])
-        self.assertEqual("0", info['devices'][0]['channel'])
-        self.assertEqual("1", info['devices'][0]['lun'])
-
-        self.assertEqual("/dev/sdf", info['devices'][1]['device'])
-        self.assertEqual("2", info['devices'][1]['host'])
-        self.assertEqual("0", info['devices'][1]['id'])
-        self.assertEqual("0", info['devices'][1]['channel'])
-        self.assertEqual("1", info['devices'][1]['lun'])
-
-    def test_find_multipath_device_svc(self):
-        def fake_execute(*cmd, **kwargs):
-            out = ("36005076da00638089c000000000004d5 dm-2 IBM,2145\n"
-                   "size=954M features='1 queue_if_no_path' hwhandler='0'"
-                   " wp=rw\n"
-                   "|-+- policy='round-robin 0' prio=-1 status=active\n"
-                   "| |- 6:0:2:0 sde 8:64  active undef  running\n"
-                   "| `- 6:0:4:0 sdg 8:96  active undef  running\n"
-                   "`-+- policy='round-robin 0' prio=-1 status=enabled\n"
-                   "  |- 6:0:3:0 sdf 8:80  active undef  running\n"
-                   "  `- 6:0:5:0 sdh 8:112 active undef  running\n"
-                   )
-            return out, None
-
-        self.linuxscsi._execute = fake_execute
-
-        info = self.linuxscsi.find_multipath_device('/dev/sde')
-
-        self.assertEqual("36005076da00638089c000000000004d5", info["id"])
-        self.assertEqual("36005076da00638089c000000000004d5", info["name"])
-        self.assertEqual("/dev/mapper/36005076da00638089c000000000004d5",
-                         info["device"])
-
-        self.assertEqual("/dev/sde", info['devices'][0]['device'])
-        self.assertEqual("6", info['devices'][0]['host'])
-        self.assertEqual("0", info['devices'][0]['channel'])
-        self.assertEqual("2", info['devices'][0]['id'])
-        self.assertEqual("0", info['devices'][0]['lun'])
-
-        self.assertEqual("/dev/sdf", info['devices'][2]['device'])
-        self.assertEqual("6", info['devices'][2]['host'])
-        self.assertEqual("0", info['devices'][2]['channel'])
-        self.assertEqual("3", info['devices'][2]['id'])
-        self.assertEqual("0", info['devices'][2]['lun'])
-
-    def test_find_multipath_device_ds8000(self):
-        def fake_execute(*cmd, **kwargs):
-            out = ("36005076303ffc48e0000000000000101 dm-2 IBM,2107900\n"
-                   "size=1.0G features='1 queue_if_no_path' hwhandler='0'"
-                   " wp=rw\n"
-                   "`-+- policy='round-robin 0' prio=-1 status=active\n"
-                   "  |- 6:0:2:0  sdd 8:64  active undef  running\n"
-                   "  `- 6:1:0:3  sdc 8:32  active undef  running\n"
-                   )
-            return out, None
-
-        self.linuxscsi._execute = fake_execute
-
-        info = self.linuxscsi.find_multipath_device('/dev/sdd')
-
-        self.assertEqual("36005076303ffc48e0000000000000101", info["id"])
-        self.assertEqual("36005076303ffc48e0000000000000101", info["name"])
-        self.assertEqual("/dev/mapper/36005076303ffc48e0000000000000101",
-                         info["device"])
-
-        self.assertEqual("/dev/sdd", info['devices'][0]['device'])
-        self.assertEqual("6", info['devices'][0]['host'])
-        self.assertEqual("0", info['devices'][0]['channel'])
-        self.assertEqual("2", info['devices'][0]['id'])
-        self.assertEqual("0", info['devices'][0]['lun'])
-
-        self.assertEqual("/dev/sdc", info['devices'][1]['device'])
-        self.assertEqual("6", info['devices'][1]['host'])
-        self.assertEqual("1", info['devices'][1]['channel'])
-        self.assertEqual("0", info['devices'][1]['id'])
-        self.assertEqual("3", info['devices'][1]['lun'])
-
-    def test_find_multipath_device_with_error(self):
-        def fake_execute(*cmd, **kwargs):
-            out = ("Oct 13 10:24:01 | /lib/udev/scsi_id exited with 1\n"
-                   "36005076303ffc48e0000000000000101 dm-2 IBM,2107900\n"
-                   "size=1.0G features='1 queue_if_no_path' hwhandler='0'"
-                   " wp=rw\n"
-                   "`-+- policy='round-robin 0' prio=-1 status=active\n"
-                   "  |- 6:0:2:0  sdd 8:64  active undef  running\n"
-                   "  `- 6:1:0:3  sdc 8:32  active undef  running\n"
-                   )
-            return out, None
-
-        self.linuxscsi._execute = fake_execute
-
-        info = self.linuxscsi.find_multipath_device('/dev/sdd')
-
-        self.assertEqual("36005076303ffc48e0000000000000101", info["id"])
-        self.assertEqual("36005076303ffc48e0000000000000101", info["name"])
-        self.assertEqual("/dev/mapper/36005076303ffc48e0000000000000101",
-                         info["device"])
-
-        self.assertEqual("/dev/sdd", info['devices'][0]['device'])
-        self.assertEqual("6", info['devices'][0]['host'])
-        self.assertEqual("0", info['devices'][0]['channel'])
-        self.assertEqual("2", info['devices'][0]['id'])
-        self.assertEqual("0", info['devices'][0]['lun'])
-
-        self.assertEqual("/dev/sdc", info['devices'][1]['device'])
-        self.assertEqual("6", info['devices'][1]['host'])
-        self.assertEqual("1", info['devices'][1]['channel'])
-        self.assertEqual("0", info['devices'][1]['id'])
-        self.assertEqual("3", info['devices'][1]['lun'])
-
-    def test_find_multipath_device_with_multiple_errors(self):
-        def fake_execute(*cmd, **kwargs):
-            out = ("Jun 21 04:39:26 | 8:160: path wwid appears to have "
-                   "changed. Using old wwid.\n\n"
-                   "Jun 21 04:39:26 | 65:208: path wwid appears to have "
-                   "changed. Using old wwid.\n\n"
-                   "Jun 21 04:39:26 | 65:208: path wwid appears to have "
-                   "changed. Using old wwid.\n"
-                   "3624a93707edcfde1127040370004ee62 dm-84 PURE    ,"
-                   "FlashArray\n"
-                   "size=100G features='0' hwhandler='0' wp=rw\n"
-                   "`-+- policy='queue-length 0' prio=1 status=active\n"
-                   "  |- 8:0:0:9  sdaa 65:160 active ready running\n"
-                   "  `- 8:0:1:9  sdac 65:192 active ready running\n"
-                   )
-            return out, None
-
-        self.linuxscsi._execute = fake_execute
-
-        info = self.linuxscsi.find_multipath_device('/dev/sdaa')
-
-        self.assertEqual("3624a93707edcfde1127040370004ee62", info["id"])
-        self.assertEqual("3624a93707edcfde1127040370004ee62", info["name"])
-        self.assertEqual("/dev/mapper/3624a93707edcfde1127040370004ee62",
-                         info["device"])
-
-        self.assertEqual("/dev/sdaa", info['devices'][0]['device'])
-        self.assertEqual("8", info['devices'][0]['host'])
-        self.assertEqual("0", info['devices'][0]['channel'])
-        self.assertEqual("0", info['devices'][0]['id'])
-        self.assertEqual("9", info['devices'][0]['lun'])
-
-        self.assertEqual("/dev/sdac", info['devices'][1]['device'])
-        self.assertEqual("8", info['devices'][1]['host'])
-        self.assertEqual("0", info['devices'][1]['channel'])
-        self.assertEqual("1", info['devices'][1]['id'])
-        self.assertEqual("9", info['devices'][1]['lun'])
-
     @mock.patch('os_brick.utils._time_sleep')
     def test_wait_for_rw(self, mock_sleep):
         lsblk_output = """3624a93709a738ed78583fd1200143029 (dm-2)  0
@@ -726,39 +666,6 @@ loop0                                     0"""
 
         self.assertEqual(4, mock_sleep.call_count)
 
-    def test_find_multipath_device_with_action(self):
-        def fake_execute(*cmd, **kwargs):
-            out = textwrap.dedent("""
-                create: 36005076303ffc48e0000000000000101 dm-2 IBM,2107900
-                size=1.0G features='1 queue_if_no_path' hwhandler='0'
-                 wp=rw
-                `-+- policy='round-robin 0' prio=-1 status=active
-                  |- 6:0:2:0 sdd 8:64  active undef  running
-                  `- 6:1:0:3 sdc 8:32  active undef  running
-                """)
-            return out, None
-
-        self.linuxscsi._execute = fake_execute
-        info = self.linuxscsi.find_multipath_device('/dev/sdd')
-        LOG.error("Device info: %s", info)
-
-        self.assertEqual('36005076303ffc48e0000000000000101', info['id'])
-        self.assertEqual('36005076303ffc48e0000000000000101', info['name'])
-        self.assertEqual('/dev/mapper/36005076303ffc48e0000000000000101',
-                         info['device'])
-
-        self.assertEqual("/dev/sdd", info['devices'][0]['device'])
-        self.assertEqual("6", info['devices'][0]['host'])
-        self.assertEqual("0", info['devices'][0]['channel'])
-        self.assertEqual("2", info['devices'][0]['id'])
-        self.assertEqual("0", info['devices'][0]['lun'])
-
-        self.assertEqual("/dev/sdc", info['devices'][1]['device'])
-        self.assertEqual("6", info['devices'][1]['host'])
-        self.assertEqual("1", info['devices'][1]['channel'])
-        self.assertEqual("0", info['devices'][1]['id'])
-        self.assertEqual("3", info['devices'][1]['lun'])
-
     def test_get_device_size(self):
         mock_execute = mock.Mock()
         self.linuxscsi._execute = mock_execute
@@ -885,6 +792,112 @@ loop0                                     0"""
                          'multipathd reconfigure']
         self.assertEqual(expected_cmds, self.cmds)
 
+    @mock.patch('builtins.open', new_callable=mock.mock_open,
+                read_data='2097152\n')
+    def test_get_sysfs_device_size(self, mock_open):
+        self.assertEqual(1073741824,
+                         self.linuxscsi.get_sysfs_device_size('sda'))
+        mock_open.assert_called_once_with('/sys/block/sda/size')
+
+    @mock.patch('builtins.open', side_effect=IOError)
+    def test_get_sysfs_device_size_missing(self, mock_open):
+        self.assertIsNone(self.linuxscsi.get_sysfs_device_size('sda'))
+
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_sysfs_device_size')
+    @mock.patch('os.readlink', side_effect=['../../0:0:0:1',
+                                            '../../1:0:0:1'])
+    def test_extend_volume_concurrent_no_mpath(self, mock_readlink,
+                                               mock_size, mock_find_dm):
+        os.path.realpath.side_effect = ['/dev/sda', '/dev/sdb']
+        mock_size.side_effect = [1024, 1024, 2048, 2048]
+
+        ret_size = self.linuxscsi.extend_volume(['/dev/fake1', '/dev/fake2'],
+                                                concurrent=True)
+        self.assertEqual(2048, ret_size)
+        self.assertEqual(
+            {'tee -a /sys/bus/scsi/drivers/sd/0:0:0:1/rescan',
+             'tee -a /sys/bus/scsi/drivers/sd/1:0:0:1/rescan'},
+            set(self.cmds))
+        mock_readlink.assert_has_calls(
+            [mock.call('/sys/block/sda/device'),
+             mock.call('/sys/block/sdb/device')], any_order=True)
+        mock_find_dm.assert_not_called()
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_dm_uuid',
+                       return_value='mpath-1234567890123456')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm',
+                       return_value='dm-0')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_sysfs_device_size')
+    @mock.patch('os.readlink', side_effect=['../../0:0:0:1',
+                                            '../../1:0:0:1'])
+    def test_extend_volume_concurrent_with_mpath(self, mock_readlink,
+                                                 mock_size, mock_find_dm,
+                                                 mock_uuid, mock_sleep):
+        os.path.realpath.side_effect = ['/dev/sda', '/dev/sdb']
+        mock_size.side_effect = [
+            # Initial sizes
+            1024, 1024,
+            # One of the paths hasn't been resized yet
+            2048, 1024,
+            2048, 2048,
+            # multipath size before and after resize
+            1024,
+            2048, 2048, 2048]
+
+        ret_size = self.linuxscsi.extend_volume(['/dev/fake1', '/dev/fake2'],
+                                                use_multipath=True,
+                                                concurrent=True)
+        self.assertEqual(2048, ret_size)
+        # Rescans can happen in any order, but always before the resize
+        self.assertEqual(
+            {'tee -a /sys/bus/scsi/drivers/sd/0:0:0:1/rescan',
+             'tee -a /sys/bus/scsi/drivers/sd/1:0:0:1/rescan'},
+            set(self.cmds[:2]))
+        self.assertEqual(['multipathd resize map 1234567890123456'],
+                         self.cmds[2:])
+        mock_find_dm.assert_called_once_with(['sda', 'sdb'])
+        mock_uuid.assert_called_once_with('dm-0')
+        mock_sleep.assert_called_once_with(0.1)
+
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'multipath_reconfigure')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'multipath_resize_map',
+                       return_value='fail')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_dm_uuid',
+                       return_value='mpath-1234567890123456')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm',
+                       return_value='dm-0')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_sysfs_device_size')
+    @mock.patch('os.readlink', return_value='../../0:0:0:1')
+    def test_extend_volume_concurrent_with_mpath_fail(self, mock_readlink,
+                                                      mock_size, mock_find_dm,
+                                                      mock_uuid, mock_resize,
+                                                      mock_reconfigure):
+        os.path.realpath.side_effect = ['/dev/sda']
+        mock_size.side_effect = [1024, 2048, 1024]
+
+        ret_size = self.linuxscsi.extend_volume(['/dev/fake1'],
+                                                use_multipath=True,
+                                                concurrent=True)
+        self.assertIsNone(ret_size)
+        self.assertEqual(2, mock_resize.call_count)
+        mock_reconfigure.assert_called_once_with()
+
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'find_sysfs_multipath_dm')
+    @mock.patch.object(linuxscsi.LinuxSCSI, 'get_sysfs_device_size',
+                       return_value=1024)
+    @mock.patch('os.readlink', side_effect=OSError)
+    def test_extend_volume_concurrent_rescan_fail(self, mock_readlink,
+                                                  mock_size, mock_find_dm):
+        os.path.realpath.side_effect = ['/dev/sda', '/dev/sdb']
+        ret_size = self.linuxscsi.extend_volume(['/dev/fake1', '/dev/fake2'],
+                                                use_multipath=True,
+                                                concurrent=True)
+        self.assertIsNone(ret_size)
+        self.assertEqual([], self.cmds)
+        mock_find_dm.assert_not_called()
+
     def test_process_lun_id_list(self):
         lun_list = [2, 255, 88, 370, 5, 256]
         result = self.linuxscsi.process_lun_id(lun_list)
@@ -966,7 +979,21 @@ loop0                                     0"""
         self.assertFalse(res)
         mock_log.error.assert_not_called()
 
-    def test_get_device_info(self):
+    @mock.patch('os.readlink')
+    def test_get_device_info_sysfs(self, readlink_mock):
+        readlink_mock.return_value = ('../../devices/pci0000:00/0000:00:02.0/'
+                                      'host6/rport-6:0-1/target6:0:1/6:0:1:2')
+        with mock.patch.object(self.linuxscsi, '_execute') as exec_mock:
+            info = self.linuxscsi.get_device_info('/dev/sdb')
+
+        exec_mock.assert_not_called()
+        readlink_mock.assert_called_once_with('/sys/block/sdb/device')
+        self.assertEqual({'channel': '0', 'device': '/dev/sdb', 'host': '6',
+                          'id': '1', 'lun': '2'},
+                         info)
+
+    @mock.patch('os.readlink', side_effect=FileNotFoundError)
+    def test_get_device_info(self, readlink_mock):
         ret = "[1:1:0:0] disk Vendor Array 0100 /dev/adevice\n"
         with mock.patch.object(self.linuxscsi, '_execute') as exec_mock:
             exec_mock.return_value = (ret, "")
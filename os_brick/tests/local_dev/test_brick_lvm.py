@@ -19,6 +19,7 @@ from oslo_concurrency import processutils
 from os_brick import exception
 from os_brick import executor as os_brick_executor
 from os_brick.local_dev import lvm as brick
+from os_brick.privileged import lvm as priv_lvm
 from os_brick.privileged import rootwrap as priv_rootwrap
 from os_brick.tests import base
 
@@ -433,6 +434,172 @@ class BrickLvmTestCase(base.TestCase):
                                return_value=['owi-----', '']):
             self.assertFalse(self.vg._lv_is_active('test'))
 
+    def _lvm_env(self):
+        env = {'LC_ALL': 'C'}
+        if self.configuration.lvm_suppress_fd_warnings:
+            env['LVM_SUPPRESS_FD_WARNINGS'] = '1'
+        return env
+
+    def test_use_lvm_shell(self):
+        shell_mock = self.mock_object(priv_lvm, 'execute',
+                                      return_value=('  fake-vg\n', ''))
+        exec_mock = mock.Mock(return_value=('', ''))
+        self.vg.set_execute(exec_mock)
+        self.vg.use_lvm_shell = True
+
+        self.assertTrue(self.vg._vg_exists())
+        shell_mock.assert_called_once_with('fake-vg', self._lvm_env(), 'vgs',
+                                           '--noheadings', '-o', 'name',
+                                           'fake-vg')
+        exec_mock.assert_not_called()
+
+        # Non LVM commands are not run in the shell
+        self.vg._execute('udevadm', 'settle', root_helper='sudo',
+                         run_as_root=True)
+        exec_mock.assert_called_once_with('udevadm', 'settle',
+                                          root_helper='sudo',
+                                          run_as_root=True)
+        shell_mock.assert_called_once()
+
+    def test_use_lvm_shell_fallback(self):
+        shell_mock = self.mock_object(
+            priv_lvm, 'execute',
+            side_effect=priv_lvm.LVMShellUnavailable('busy'))
+        exec_mock = mock.Mock(return_value=('  fake-vg\n', ''))
+        self.vg.set_execute(exec_mock)
+        self.vg.use_lvm_shell = True
+
+        self.assertTrue(self.vg._vg_exists())
+        shell_mock.assert_called_once()
+        exec_mock.assert_called_once_with(*brick.LVM.LVM_CMD_PREFIX,
+                                          'vgs', '--noheadings', '-o', 'name',
+                                          'fake-vg', root_helper='sudo',
+                                          run_as_root=True)
+
+    def test_use_lvm_shell_failure_readonly(self):
+        shell_mock = self.mock_object(
+            priv_lvm, 'execute', side_effect=priv_lvm.LVMShellError('dead'))
+        exec_mock = mock.Mock(return_value=('  fake-vg\n', ''))
+        self.vg.set_execute(exec_mock)
+        self.vg.use_lvm_shell = True
+
+        # Reports are run again as a command if the shell fails
+        self.assertTrue(self.vg._vg_exists())
+        shell_mock.assert_called_once()
+        exec_mock.assert_called_once()
+
+    def test_use_lvm_shell_failure(self):
+        shell_mock = self.mock_object(
+            priv_lvm, 'execute', side_effect=priv_lvm.LVMShellError('dead'))
+        exec_mock = mock.Mock(return_value=('', ''))
+        self.vg.set_execute(exec_mock)
+        self.vg.use_lvm_shell = True
+
+        # Commands that may have changed something are not run again
+        exc = self.assertRaises(processutils.ProcessExecutionError,
+                                self.vg._execute, 'lvextend', '-L', '2G',
+                                'fake-vg/lv0', root_helper='sudo',
+                                run_as_root=True)
+        self.assertEqual('lvextend -L 2G fake-vg/lv0', exc.cmd)
+        self.assertEqual('dead', exc.stderr)
+        shell_mock.assert_called_once()
+        exec_mock.assert_not_called()
+
+    def test_use_lvm_shell_check_exit_code(self):
+        error = processutils.ProcessExecutionError(
+            exit_code=5, stdout='out', stderr='err')
+        shell_mock = self.mock_object(priv_lvm, 'execute', side_effect=error)
+        exec_mock = mock.Mock(return_value=('', ''))
+        self.vg.set_execute(exec_mock)
+        self.vg.use_lvm_shell = True
+
+        self.assertEqual(('out', 'err'),
+                         self.vg._execute('lvchange', '-an', 'fake-vg/lv0',
+                                          root_helper='sudo',
+                                          run_as_root=True,
+                                          check_exit_code=False))
+        self.assertEqual(('out', 'err'),
+                         self.vg._execute('lvchange', '-an', 'fake-vg/lv0',
+                                          check_exit_code=[0, 5]))
+        self.assertRaises(processutils.ProcessExecutionError,
+                          self.vg._execute, 'lvchange', '-an', 'fake-vg/lv0',
+                          check_exit_code=[0])
+        self.assertRaises(processutils.ProcessExecutionError,
+                          self.vg._execute, 'lvchange', '-an', 'fake-vg/lv0')
+        self.assertEqual(4, shell_mock.call_count)
+        exec_mock.assert_not_called()
+
+    def test_use_lvm_shell_check_exit_code_shell_failure(self):
+        self.mock_object(priv_lvm, 'execute',
+                         side_effect=priv_lvm.LVMShellError('dead'))
+        self.vg.use_lvm_shell = True
+
+        # We don't know if the command failed, so it cannot be ignored
+        self.assertRaises(processutils.ProcessExecutionError,
+                          self.vg._execute, 'lvchange', '-an', 'fake-vg/lv0',
+                          check_exit_code=False)
+
+    def test_use_lvm_shell_unsupported_kwargs(self):
+        shell_mock = self.mock_object(priv_lvm, 'execute')
+        exec_mock = mock.Mock(return_value=('', ''))
+        self.vg.set_execute(exec_mock)
+        self.vg.use_lvm_shell = True
+
+        self.vg._execute('lvchange', '-an', 'fake-vg/lv0', root_helper='sudo',
+                         run_as_root=True, attempts=3)
+        exec_mock.assert_called_once_with('lvchange', '-an', 'fake-vg/lv0',
+                                          root_helper='sudo',
+                                          run_as_root=True, attempts=3)
+        shell_mock.assert_not_called()
+
+    def test_delete_lvm_shell(self):
+        shell_mock = self.mock_object(priv_lvm, 'execute',
+                                      return_value=('', ''))
+        exec_mock = mock.Mock(return_value=('', ''))
+        self.vg.set_execute(exec_mock)
+        self.vg.use_lvm_shell = True
+
+        self.vg.delete('lv0')
+
+        args = ('lvremove', '--config',
+                'activation { retry_deactivation = 1} ', '-f', 'fake-vg/lv0')
+        shell_mock.assert_called_once_with('fake-vg', {}, *args)
+        exec_mock.assert_not_called()
+        # The shell adds its settings to the command's --config
+        shell_args = priv_lvm.LVMShell._get_shell_args(args)
+        self.assertEqual(1, shell_args.count('--config'))
+        self.assertIn(priv_lvm.LVM_SHELL_CONFIG, shell_args[2])
+        self.assertTrue(shell_args[2].startswith(args[2]))
+
+    def test_use_lvm_shell_error(self):
+        error = processutils.ProcessExecutionError(
+            exit_code=5, stderr='Volume group "fake-vg" not found')
+        self.mock_object(priv_lvm, 'execute', side_effect=error)
+        exec_mock = self.mock_object(priv_rootwrap, 'execute')
+
+        # Command failures are not retried outside the shell
+        self.assertEqual([], self.vg.get_lv_info('sudo', 'fake-vg',
+                                                 use_lvm_shell=True))
+        exec_mock.assert_not_called()
+
+    def test_get_all_volume_groups_lvm_shell(self):
+        shell_mock = self.mock_object(
+            priv_lvm, 'execute',
+            return_value=('fake-vg:10.00:10.00:0:'
+                          'kVxztV-dKpG-Rz7E-xtKY-jeju-QsYU-SLG6Z1\n', ''))
+        exec_mock = self.mock_object(priv_rootwrap, 'execute')
+
+        vgs = self.vg.get_all_volume_groups('sudo', 'fake-vg',
+                                            use_lvm_shell=True)
+
+        self.assertEqual(1, len(vgs))
+        self.assertEqual(10.0, vgs[0]['size'])
+        shell_mock.assert_called_once_with(
+            'fake-vg', self._lvm_env(), 'vgs', '--noheadings', '--unit=g',
+            '-o', 'name,size,free,lv_count,uuid', '--separator', ':',
+            '--nosuffix', 'fake-vg')
+        exec_mock.assert_not_called()
+
 
 class BrickLvmTestCaseIgnoreFDWarnings(BrickLvmTestCase):
     def setUp(self):
@@ -0,0 +1,262 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os
+import sys
+from unittest import mock
+
+import fixtures
+from oslo_concurrency import processutils as putils
+
+from os_brick.local_dev import lvm as brick
+import os_brick.privileged as privsep_brick
+import os_brick.privileged.lvm as privsep_lvm
+from os_brick.tests import base
+
+# Emulates the lvm shell: prints a prompt, reads a command per line and writes
+# its JSON report and command log to LVM_REPORT_FD.
+FAKE_LVM_SHELL = r'''
+import json
+import os
+import sys
+import time
+
+report = os.fdopen(int(os.environ['LVM_REPORT_FD']), 'w')
+
+
+def split(line):
+    # Words starting with a quote end at the same quote, # starts a comment
+    args = []
+    i = 0
+    while i < len(line):
+        if line[i].isspace():
+            i += 1
+        elif line[i] == '#':
+            break
+        elif line[i] in '\'"':
+            end = line.index(line[i], i + 1)
+            args.append(line[i + 1:end])
+            i = end + 1
+        else:
+            end = i
+            while end < len(line) and not line[end].isspace():
+                end += 1
+            args.append(line[i:end])
+            i = end
+    return args
+
+
+def status(code, message):
+    log = [{'log_type': 'status', 'log_ret_code': str(code),
+            'log_message': message}]
+    if code != 1:
+        log.insert(0, {'log_type': 'error', 'log_ret_code': '0',
+                       'log_message': message})
+    return {'log': log}
+
+
+while True:
+    sys.stdout.write('lvm> ')
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    args = split(line)
+    cmd = args[0]
+    if cmd == 'crash':
+        os._exit(139)
+    elif cmd == 'hang':
+        time.sleep(60)
+    elif cmd == 'lvs':
+        rows = [{'vg_name': 'fake-vg', 'lv_name': 'lv%d' % i,
+                 'lv_size': '1.00'} for i in range(2)]
+        doc = {'report': [{'lv': rows}]}
+        report.write(json.dumps(doc))
+        report.write(json.dumps(status(1, '')))
+    elif cmd == 'locale':
+        rows = [{'lc_all': os.environ.get('LC_ALL', '')}]
+        report.write(json.dumps({'report': [{'locale': rows}]}))
+        report.write(json.dumps(status(1, '')))
+    elif cmd == 'env':
+        rows = [{'name': os.environ.get('LVM_SYSTEM_DIR', ''),
+                 'pid': str(os.getpid()), 'args': args[1]}]
+        report.write(json.dumps({'report': [{'env': rows}]}))
+        report.write(json.dumps(status(1, '')))
+    elif cmd == 'echo':
+        rows = [{'arg': arg} for arg in args[1:]]
+        report.write(json.dumps({'report': [{'echo': rows}]}))
+        report.write(json.dumps(status(1, '')))
+    else:
+        sys.stderr.write('  WARNING: %s\n' % cmd)
+        sys.stderr.flush()
+        report.write(json.dumps(status(5, 'Failed to find %s' % cmd)))
+    report.flush()
+'''
+
+
+class PrivLVMTestCase(base.TestCase):
+    def setUp(self):
+        super(PrivLVMTestCase, self).setUp()
+
+        # Disable privsep server/client mode
+        privsep_brick.default.set_client_mode(False)
+        self.addCleanup(privsep_brick.default.set_client_mode, True)
+
+        script = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'lvm.py')
+        with open(script, 'w') as f:
+            f.write(FAKE_LVM_SHELL)
+        self.mock_object(privsep_lvm, 'LVM_SHELL_CMD',
+                         [sys.executable, script])
+        self.mock_object(privsep_lvm, '_shells', {})
+        self.mock_object(privsep_lvm, '_start_failures', {})
+        self.addCleanup(privsep_lvm.close_shells)
+
+    def test_execute(self):
+        out, err = privsep_lvm.execute('fake-vg', {}, 'lvs', '--noheadings')
+        self.assertEqual('fake-vg lv0 1.00\nfake-vg lv1 1.00\n', out)
+        self.assertEqual('', err)
+
+    def test_execute_separator(self):
+        out, _err = privsep_lvm.execute('fake-vg', {}, 'lvs', '--separator',
+                                        ':')
+        self.assertEqual('fake-vg:lv0:1.00\nfake-vg:lv1:1.00\n', out)
+
+    def test_execute_reuses_shell(self):
+        env = {'LVM_SYSTEM_DIR': '/etc/cinder'}
+        out1, _err = privsep_lvm.execute('fake-vg', env, 'env', 'a b')
+        out2, _err = privsep_lvm.execute('fake-vg', env, 'env', 'c')
+        other, _err = privsep_lvm.execute('fake-vg', {}, 'env', 'd')
+
+        dir1, pid1, arg1 = out1.split('\n')[0].split(' ', 2)
+        dir2, pid2, arg2 = out2.split('\n')[0].split(' ', 2)
+        self.assertEqual(('/etc/cinder', '/etc/cinder'), (dir1, dir2))
+        self.assertEqual(('a b', 'c'), (arg1, arg2))
+        self.assertEqual(pid1, pid2)
+        # Different environments get different shells
+        self.assertEqual(2, len(privsep_lvm._shells))
+        self.assertNotEqual(pid1, other.split()[0])
+
+    def test_execute_lvm_env(self):
+        # Same environment the LVM class sends for its commands
+        env = dict(arg.split('=', 1) for arg in brick.LVM.LVM_CMD_PREFIX[1:])
+        out, _err = privsep_lvm.execute('fake-vg', env, 'lvs', '--noheadings')
+        self.assertEqual('fake-vg lv0 1.00\nfake-vg lv1 1.00\n', out)
+
+        out, _err = brick.LVM._shell_execute(
+            brick.LVM.LVM_CMD_PREFIX + ['lvs', '--noheadings'], 'fake-vg')
+        self.assertEqual('fake-vg lv0 1.00\nfake-vg lv1 1.00\n', out)
+
+    def test_execute_locale(self):
+        out, _err = privsep_lvm.execute('fake-vg', {}, 'locale')
+        self.assertEqual('C\n', out)
+        out, _err = privsep_lvm.execute('fake-vg', {'LC_ALL': 'en_US.UTF-8'},
+                                        'locale')
+        self.assertEqual('en_US.UTF-8\n', out)
+
+    def test_execute_busy_shell(self):
+        out1, _err = privsep_lvm.execute('fake-vg', {}, 'env', 'a')
+        busy = privsep_lvm._acquire_shell(('fake-vg', ()), {})
+        self.addCleanup(privsep_lvm._release_shell, busy)
+        # Commands don't wait for a busy shell, they get another one
+        out2, _err = privsep_lvm.execute('fake-vg', {}, 'env', 'b')
+        self.assertNotEqual(out1.split()[1], out2.split()[1])
+        self.assertEqual(2, len(privsep_lvm._shells[('fake-vg', ())]))
+
+    def test_execute_all_shells_busy(self):
+        self.mock_object(privsep_lvm, 'LVM_SHELLS_PER_VG', 1)
+        busy = privsep_lvm._acquire_shell(('fake-vg', ()), {})
+        self.addCleanup(privsep_lvm._release_shell, busy)
+        self.assertRaises(privsep_lvm.LVMShellUnavailable,
+                          privsep_lvm.execute, 'fake-vg', {}, 'lvs')
+
+    def test_execute_config(self):
+        out, _err = privsep_lvm.execute('fake-vg', {}, 'echo', 'a b')
+        self.assertEqual(['a b', '--config', privsep_lvm.LVM_SHELL_CONFIG,
+                          '--reportformat', 'json'], out.splitlines())
+
+    def test_execute_merge_config(self):
+        out, _err = privsep_lvm.execute(
+            'fake-vg', {}, 'echo', '--config',
+            'activation { retry_deactivation = 1} ', '-f', 'vg/lv')
+        self.assertEqual(['--config',
+                          'activation { retry_deactivation = 1}  ' +
+                          privsep_lvm.LVM_SHELL_CONFIG,
+                          '-f', 'vg/lv', '--reportformat', 'json'],
+                         out.splitlines())
+
+    def test_execute_error(self):
+        exc = self.assertRaises(putils.ProcessExecutionError,
+                                privsep_lvm.execute, 'fake-vg', {}, 'lvcreate',
+                                '-n', 'lv0')
+        self.assertEqual(5, exc.exit_code)
+        self.assertEqual('lvcreate -n lv0', exc.cmd)
+        self.assertIn('WARNING: lvcreate', exc.stderr)
+        self.assertIn('Failed to find lvcreate', exc.stderr)
+
+        # Shell is still usable after a failed command
+        out, _err = privsep_lvm.execute('fake-vg', {}, 'lvs')
+        self.assertIn('lv0', out)
+
+    def test_execute_crash_recovery(self):
+        self.assertRaises(privsep_lvm.LVMShellError,
+                          privsep_lvm.execute, 'fake-vg', {}, 'crash')
+        shell, = privsep_lvm._shells[('fake-vg', ())]
+        self.assertFalse(shell.alive)
+
+        # A new shell is started on the next command
+        out, _err = privsep_lvm.execute('fake-vg', {}, 'lvs')
+        self.assertIn('lv1', out)
+        self.assertTrue(shell.alive)
+
+    def test_execute_timeout(self):
+        shell = privsep_lvm.LVMShell({}, timeout=0.5)
+        privsep_lvm._shells[('fake-vg', ())] = [shell]
+        exc = self.assertRaises(privsep_lvm.LVMShellError,
+                                privsep_lvm.execute, 'fake-vg', {}, 'hang')
+        # The command was sent, so the caller must not run it again
+        self.assertNotIsInstance(exc, privsep_lvm.LVMShellUnavailable)
+        self.assertFalse(shell.alive)
+
+    def test_execute_cannot_start(self):
+        cmd = privsep_lvm.LVM_SHELL_CMD
+        self.mock_object(privsep_lvm, 'LVM_SHELL_CMD', ['/nonexistent/lvm'])
+        self.assertRaises(privsep_lvm.LVMShellStartError,
+                          privsep_lvm.execute, 'fake-vg', {}, 'lvs')
+
+        # Starting the shell is not retried for a while
+        self.mock_object(privsep_lvm, 'LVM_SHELL_CMD', cmd)
+        exc = self.assertRaises(privsep_lvm.LVMShellUnavailable,
+                                privsep_lvm.execute, 'fake-vg', {}, 'lvs')
+        self.assertNotIsInstance(exc, privsep_lvm.LVMShellStartError)
+
+        privsep_lvm._start_failures[('fake-vg', ())] -= (
+            privsep_lvm.LVM_SHELL_RESTART_INTERVAL)
+        out, _err = privsep_lvm.execute('fake-vg', {}, 'lvs')
+        self.assertIn('lv0', out)
+        self.assertEqual({}, privsep_lvm._start_failures)
+
+    @mock.patch('subprocess.Popen', side_effect=ValueError('bad env'))
+    def test_execute_cannot_start_error(self, popen_mock):
+        exc = self.assertRaises(privsep_lvm.LVMShellStartError,
+                                privsep_lvm.execute, 'fake-vg', {}, 'lvs')
+        self.assertIn('bad env', str(exc))
+        popen_mock.assert_called_once()
+
+    def test_quoting(self):
+        out, _err = privsep_lvm.execute('fake-vg', {}, 'echo', 'a"b', "c'd",
+                                        '#e', '', "f g'")
+        self.assertEqual(['a"b', "c'd", '#e', '', "f g'"],
+                         out.splitlines()[:5])
+
+    def test_invalid_argument(self):
+        self.assertRaises(privsep_lvm.LVMShellUnavailable,
+                          privsep_lvm.execute, 'fake-vg', {}, 'lvs', 'a"b \'c')
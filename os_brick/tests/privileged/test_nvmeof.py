@@ -14,9 +14,11 @@
 #    under the License.
 import builtins
 import errno
+import os
 from unittest import mock
 
 import ddt
+import fixtures
 from oslo_concurrency import processutils as putils
 
 import os_brick.privileged as privsep_brick
@@ -125,3 +127,48 @@ class PrivNVMeTestCase(base.TestCase):
                                             exist_ok=True)
         mock_exec.assert_called_once_with('nvme', 'show-hostnqn')
         self.assertEqual('', res)
+
+    def _fake_fabrics(self, reply):
+        """Regular file standing in for /dev/nvme-fabrics.
+
+        The file starts with enough padding for the options we write so that
+        the following read returns the reply.
+        """
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'nvme-fabrics')
+        options = 'transport=tcp,traddr=10.0.0.1,trsvcid=4420,nqn=nqn.1'
+        with open(path, 'w') as f:
+            f.write(' ' * len(options) + reply)
+        self.mock_object(privsep_nvme, 'NVME_FABRICS', path)
+        return path, options
+
+    def test_connect_ctrl(self):
+        path, options = self._fake_fabrics('instance=3,cntlid=1\n')
+        res = privsep_nvme.connect_ctrl({'transport': 'tcp',
+                                         'traddr': '10.0.0.1',
+                                         'trsvcid': 4420,
+                                         'nqn': 'nqn.1',
+                                         'hostnqn': None})
+        self.assertEqual('nvme3', res)
+        with open(path) as f:
+            self.assertEqual(options, f.read(len(options)))
+
+    def test_connect_ctrl_bad_reply(self):
+        self._fake_fabrics('\n')
+        exc = self.assertRaises(OSError, privsep_nvme.connect_ctrl,
+                                {'transport': 'tcp', 'traddr': '10.0.0.1',
+                                 'trsvcid': 4420, 'nqn': 'nqn.1'})
+        self.assertEqual(errno.EIO, exc.errno)
+
+    def test_connect_ctrl_no_device(self):
+        self.mock_object(privsep_nvme, 'NVME_FABRICS', '/nonexistent')
+        self.assertRaises(FileNotFoundError, privsep_nvme.connect_ctrl,
+                          {'transport': 'tcp'})
+
+    def test_delete_ctrl(self):
+        sysfs = self.useFixture(fixtures.TempDir()).path
+        os.mkdir(os.path.join(sysfs, 'nvme3'))
+        self.mock_object(privsep_nvme, 'NVME_CTRL_SYSFS_PATH', sysfs)
+        privsep_nvme.delete_ctrl('nvme3')
+        with open(os.path.join(sysfs, 'nvme3', 'delete_controller')) as f:
+            self.assertEqual('1', f.read())
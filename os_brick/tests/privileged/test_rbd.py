@@ -14,11 +14,14 @@
 #    under the License.
 from unittest import mock
 
+import ddt
+
 import os_brick.privileged as privsep_brick
 import os_brick.privileged.rbd as privsep_rbd
 from os_brick.tests import base
 
 
+@ddt.ddt
 class PrivRBDTestCase(base.TestCase):
     def setUp(self):
         super(PrivRBDTestCase, self).setUp()
@@ -66,6 +69,34 @@ class PrivRBDTestCase(base.TestCase):
             s.monitor_ips, s.monitor_ports, s.cluster_name, s.user, s.keyring)
         self.assertIs(mock_connector._create_ceph_conf.return_value, res)
 
+    @mock.patch.object(privsep_rbd, 'get_rbd_class')
+    @mock.patch.object(privsep_rbd, 'RBDConnector')
+    def test_root_release_ceph_conf(self, mock_connector, mock_get_class):
+        res = privsep_rbd.root_release_ceph_conf(mock.sentinel.path)
+
+        mock_get_class.assert_called_once_with()
+        mock_connector._release_ceph_conf.assert_called_once_with(
+            mock.sentinel.path)
+        self.assertIs(mock_connector._release_ceph_conf.return_value, res)
+
+    @mock.patch.object(privsep_rbd, 'get_rbd_class')
+    @mock.patch.object(privsep_rbd, 'RBDConnector')
+    def test_root_get_rbd_map_options(self, mock_connector, mock_get_class):
+        res = privsep_rbd.root_get_rbd_map_options('/dev/rbd12')
+
+        mock_get_class.assert_called_once_with()
+        mock_connector.get_rbd_map_options.assert_called_once_with(
+            '/dev/rbd12')
+        self.assertIs(mock_connector.get_rbd_map_options.return_value, res)
+
+    @ddt.data('/dev/rbd', '/dev/rbd0/../../etc', '/dev/rbd1p1', '/dev/sda',
+              'rbd0', '/dev/rbd0\n')
+    @mock.patch.object(privsep_rbd, 'RBDConnector')
+    def test_root_get_rbd_map_options_invalid(self, device, mock_connector):
+        self.assertRaises(ValueError, privsep_rbd.root_get_rbd_map_options,
+                          device)
+        mock_connector.get_rbd_map_options.assert_not_called()
+
     @mock.patch.object(privsep_rbd, 'get_rbd_class')
     @mock.patch.object(privsep_rbd, 'open')
     @mock.patch.object(privsep_rbd, 'RBDConnector')
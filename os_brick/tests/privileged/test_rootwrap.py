@@ -191,3 +191,35 @@ class PrivRootwrapTestCase(base.TestCase):
                           mock.sentinel.target, mock.sentinel.link_name)
         mock_remove.assert_called_once_with(mock.sentinel.link_name)
         mock_link.assert_not_called()
+
+    @mock.patch.object(priv_rootwrap.write_sys.privsep_entrypoint,
+                       'client_mode', False)
+    @mock.patch('os.path.realpath',
+                return_value='/sys/devices/pci0000:00/host6/scsi_host/host6/'
+                             'scan')
+    @mock.patch('builtins.open', new_callable=mock.mock_open)
+    def test_write_sys(self, mock_open, mock_realpath):
+        priv_rootwrap.write_sys('/sys/class/scsi_host/host6/scan', '0 1 2')
+        mock_realpath.assert_called_once_with(
+            '/sys/class/scsi_host/host6/scan')
+        mock_open.assert_called_once_with(mock_realpath.return_value, 'w')
+        mock_open.return_value.write.assert_called_once_with('0 1 2')
+
+    @ddt.data('/etc/passwd', '/sys/../etc/passwd', '/sysfoo/bar',
+              'sys/block/sda/queue/scheduler')
+    @mock.patch.object(priv_rootwrap.write_sys.privsep_entrypoint,
+                       'client_mode', False)
+    @mock.patch('builtins.open', new_callable=mock.mock_open)
+    def test_write_sys_not_sysfs(self, path, mock_open):
+        self.assertRaises(PermissionError, priv_rootwrap.write_sys, path, '1')
+        mock_open.assert_not_called()
+
+    @mock.patch.object(priv_rootwrap.write_sys.privsep_entrypoint,
+                       'client_mode', False)
+    @mock.patch('os.path.realpath', return_value='/etc/passwd')
+    @mock.patch('builtins.open', new_callable=mock.mock_open)
+    def test_write_sys_symlink_out_of_sysfs(self, mock_open, mock_realpath):
+        self.assertRaises(PermissionError, priv_rootwrap.write_sys,
+                          '/sys/class/fake/link', '1')
+        mock_realpath.assert_called_once_with('/sys/class/fake/link')
+        mock_open.assert_not_called()
@@ -295,27 +295,38 @@ def connect_volume_prepare_result(
     @functools.wraps(func)
     def change_encrypted(self, connection_properties):
         res = func(self, connection_properties)
-        # Decode if path is bytes, otherwise leave it as it is
-        device_path = convert_str(res['path'])
-        # There are connectors that sometimes return file descriptors (rbd)
-        if (connection_properties.get('encrypted') and
-                isinstance(device_path, str)):
-            symlink = _symlink_name_from_device_path(device_path)
-            try:
-                priv_rootwrap.link_root(os.path.realpath(device_path),
-                                        symlink,
-                                        force=True)
-                res['path'] = symlink
-            except Exception as exc:
-                LOG.debug('Failed to create symlink, cleaning connection: %s',
-                          exc)
-                self.disconnect_volume(res, force=True, ignore_errors=True)
-                raise
-
-        return res
+        return prepare_connect_volume_result(self, connection_properties, res)
     return change_encrypted
 
 
+def prepare_connect_volume_result(connector, connection_properties: dict,
+                                  res: dict) -> dict:
+    """Prepare the result of a connect_volume call for encrypted volumes.
+
+    This is what the connect_volume_prepare_result decorator does, available
+    for connectors that attach multiple volumes in a single call.  It must be
+    called outside of any connect_volume locking.
+    """
+    # Decode if path is bytes, otherwise leave it as it is
+    device_path = convert_str(res['path'])
+    # There are connectors that sometimes return file descriptors (rbd)
+    if (connection_properties.get('encrypted') and
+            isinstance(device_path, str)):
+        symlink = _symlink_name_from_device_path(device_path)
+        try:
+            priv_rootwrap.link_root(os.path.realpath(device_path),
+                                    symlink,
+                                    force=True)
+            res['path'] = symlink
+        except Exception as exc:
+            LOG.debug('Failed to create symlink, cleaning connection: %s',
+                      exc)
+            connector.disconnect_volume(res, force=True, ignore_errors=True)
+            raise
+
+    return res
+
+
 def get_dev_path(connection_properties, device_info):
     """Return the device that was returned when connecting a volume."""
     if device_info and device_info.get('path'):